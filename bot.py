@@ -16,7 +16,8 @@ from handlers.parent import ParentHandler
 from handlers.admin import AdminHandler
 from handlers.common import CommonHandler
 
-from database.db_manager import init_db, get_session, engine
+from database.db_manager import init_db, get_session
+from utils.chat_queue import queued
 from services.notification import NotificationService
 
 # Настройка логирования
@@ -56,6 +57,9 @@ class HistoryBot:
             self.quiz_service = QuizService()
             self.parent_service = ParentService()
 
+            # Загружаем темы в память до приема первых запросов
+            self.quiz_service.reload_topics()
+
             # Восстанавливаем состояние активных тестов
             self.quiz_service.restore_active_quizzes()
 
@@ -133,8 +137,10 @@ class HistoryBot:
 
         # Команды для родителей
         self.application.add_handler(CommandHandler("link", self.parent_handler.link_student))
-        self.application.add_handler(CommandHandler("report", self.parent_handler.get_report))
-        self.application.add_handler(CommandHandler("settings", self.parent_handler.settings))
+        # /report и /settings работают с тем же кэшем в user_data, что и кнопки родителя,
+        # поэтому выполняются в общей очереди чата
+        self.application.add_handler(CommandHandler("report", queued(self.parent_handler.get_report)))
+        self.application.add_handler(CommandHandler("settings", queued(self.parent_handler.settings)))
 
         # Команды для администраторов
         self.application.add_handler(CommandHandler("admin", self.admin_handler.admin_panel))
@@ -143,7 +149,8 @@ class HistoryBot:
 
         # Обработчики кнопок
         self.application.add_handler(CallbackQueryHandler(self.common_handler.handle_common_button, pattern="^common_"))
-        self.application.add_handler(CallbackQueryHandler(self.student_handler.handle_test_button, pattern="^quiz_"))
+        self.application.add_handler(CallbackQueryHandler(
+            self.student_handler.handle_test_button, pattern="^(quiz_|student_recommendations$)"))
         self.application.add_handler(CallbackQueryHandler(self.parent_handler.handle_parent_button, pattern="^parent_"))
 
 
@@ -203,6 +210,10 @@ class HistoryBot:
                 await self.application.stop()
                 await self.application.shutdown()
 
+            # Записываем накопленные обновления времени активности пользователей
+            if self.common_handler:
+                await self.common_handler.stop()
+
             logger.info("Bot shutdown complete")
 
         except Exception as e:
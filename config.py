@@ -9,11 +9,41 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 
 # Идентификаторы администраторов (список строк с ID)
 ADMINS = [admin_id.strip() for admin_id in os.getenv('ADMINS', '').split(',') if admin_id.strip()]
+# Те же идентификаторы, приведенные к int один раз при загрузке конфигурации
+ADMIN_IDS = tuple(int(admin_id) for admin_id in ADMINS if admin_id.lstrip('-').isdigit())
 
 # Настройки подключения к базе данных
 db_path = os.path.join('data', 'history_bot.db')
 DB_ENGINE = os.getenv('DB_ENGINE', f'sqlite:///{db_path}')
 
+# Пул соединений для PostgreSQL и других серверных СУБД (движок создается один раз
+# на процесс, поэтому размер пула ограничивает число одновременных запросов)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '20'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '900'))
+
+# Режим журнала SQLite: WAL (по умолчанию) или WAL2. WAL2 и BEGIN CONCURRENT доступны только
+# в SQLite, собранном из исходников ветки begin-concurrent-pnu-wal2 (библиотека должна
+# подменять системную libsqlite3, с которой работает модуль sqlite3)
+DB_JOURNAL_MODE = os.getenv('DB_JOURNAL_MODE', 'WAL').upper()
+
+# Начинать транзакции SQLite с BEGIN CONCURRENT (требует сборку из ветки выше)
+SQLITE_BEGIN_CONCURRENT = os.getenv('SQLITE_BEGIN_CONCURRENT', 'False').lower() == 'true'
+
+# Размер страницы и режим автоочистки SQLite: применяются только к новой базе
+# (до создания первой таблицы), для существующей базы эти PRAGMA ничего не меняют
+SQLITE_PAGE_SIZE = int(os.getenv('SQLITE_PAGE_SIZE', '8192'))
+SQLITE_AUTO_VACUUM = os.getenv('SQLITE_AUTO_VACUUM', 'INCREMENTAL').upper()
+
+# Дополнительные PRAGMA, выполняемые для каждого нового соединения SQLite (через ';')
+SQLITE_PRAGMAS = [
+    pragma.strip() for pragma in os.getenv(
+        'SQLITE_PRAGMAS',
+        'synchronous=NORMAL;cache_size=-64000;'
+        'temp_store=MEMORY;mmap_size=268435456;busy_timeout=5000'
+    ).split(';') if pragma.strip()
+]
+
 # Настройки бота
 ENABLE_PARENT_REPORTS = os.getenv('ENABLE_PARENT_REPORTS', 'True').lower() == 'true'
 
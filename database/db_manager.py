@@ -1,167 +1,311 @@
+import asyncio
+import importlib.util
 import logging
 import os
-import traceback
+import time
 from contextlib import contextmanager
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from config import ADMINS
-
-from config import DB_ENGINE, DATA_DIR
-from database.models import Base
+from functools import lru_cache
+from cachetools import TTLCache
+from sqlalchemy import bindparam, create_engine, event, insert, literal, or_, select, union_all
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from config import (
+    ADMIN_IDS, DB_ENGINE, SQLITE_PRAGMAS, DB_JOURNAL_MODE, SQLITE_BEGIN_CONCURRENT,
+    SQLITE_PAGE_SIZE, SQLITE_AUTO_VACUUM,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE
+)
+from database.models import Base, User
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
 # Проверяем тип базы данных (SQLite или PostgreSQL)
 is_sqlite = DB_ENGINE.startswith('sqlite:///')
-is_postgres = DB_ENGINE.startswith('postgresql://')
+is_postgres = DB_ENGINE.startswith('postgresql')
 
-# Для SQLite создаем директорию, если она не существует
+# Путь к файлу SQLite вычисляем один раз (без обращений к файловой системе)
 if is_sqlite:
-    sqlite_path = DB_ENGINE.replace('sqlite:///', '')
-    os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
-
-    # Создаем движок базы данных с настройками для SQLite
-    engine = create_engine(
-        DB_ENGINE,
-        connect_args={"check_same_thread": False},  # Только для SQLite
-        echo=False  # Установите True для отладки SQL-запросов
-    )
-# Для PostgreSQL или других СУБД
-else:
-    engine = create_engine(
-        DB_ENGINE,
-        echo=False,  # Установите True для отладки SQL-запросов
-        pool_size=10,  # Увеличиваем размер пула соединений
-        max_overflow=20,  # Увеличиваем максимальное количество дополнительных соединений
-        pool_timeout=60,  # Увеличиваем тайм-аут для получения соединения из пула
-        pool_recycle=900,  # Пересоздание соединений старше 15 минут
-        pool_pre_ping=True  # Добавляем проверку соединения перед использованием
-    )
-
-# Создаем фабрику сессий
-Session = scoped_session(sessionmaker(bind=engine, autoflush=True, autocommit=False))
+    SQLITE_PATH = DB_ENGINE[len('sqlite:///'):]
+    SQLITE_DIR = os.path.dirname(os.path.abspath(SQLITE_PATH))
+
+# Создаем фабрику сессий. get_session() открывает и закрывает сессию на каждый вызов,
+# поэтому scoped_session (thread-local реестр) не нужен. autoflush отключен, чтобы
+# каждый query() не вызывал неявный flush, а expire_on_commit=False позволяет читать
+# атрибуты объектов после commit без повторного SELECT.
+# Обратная сторона: объекты, сохраненные после выхода из get_session(), не обновляются
+# и могут содержать устаревшие данные, если запись изменена в другой сессии. Для бота,
+# где данные в основном читаются, это приемлемо; если нужны свежие значения,
+# загружайте объект заново в новой сессии.
+# Движок привязывается лениво при первом вызове get_engine().
+Session = sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False)
+
+# Флаг того, что таблицы уже созданы в текущем процессе
+_schema_ready = False
+
+# Количество попыток init_db при блокировке SQLite (SQLITE_BUSY)
+_INIT_DB_RETRIES = 3
+
+# Начальные темы, добавляемые в пустую базу
+_DEFAULT_TOPICS = (
+    {"name": "Древняя Русь IX-XII вв.",
+     "description": "Вопросы по истории Древней Руси в период IX-XII веков"},
+)
+
+# Кэш идентификатора и роли пользователя по telegram_id (только неизменяемые поля)
+_USER_CACHE = TTLCache(maxsize=4096, ttl=60)
+
+# Размер кэша скомпилированных SQL-выражений движка (по умолчанию в SQLAlchemy - 500)
+_QUERY_CACHE_SIZE = 1200
+
+# Запрос id и роли пользователя строится один раз; telegram_id передается параметром,
+# поэтому каждый вызов попадает в кэш скомпилированных выражений
+_USER_BY_TELEGRAM_ID = select(User.id, User.role).where(User.telegram_id == bindparam("telegram_id"))
+
+
+@lru_cache(maxsize=1)
+def get_engine():
+    """Ленивое создание движка базы данных при первом обращении
+
+    Движок и его пул соединений - единственные на процесс: все вызовы get_session()
+    берут соединения из одного пула, а не создают новый движок.
+    """
+    # Для SQLite создаем директорию, если она не существует
+    if is_sqlite:
+        os.makedirs(SQLITE_DIR, exist_ok=True)
+
+        # Создаем движок базы данных с настройками для SQLite
+        engine = create_engine(
+            DB_ENGINE,
+            connect_args={"check_same_thread": False},  # Только для SQLite
+            echo=False,  # Установите True для отладки SQL-запросов
+            query_cache_size=_QUERY_CACHE_SIZE
+        )
+
+        @event.listens_for(engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            """Настройка PRAGMA (WAL, synchronous и т.д.) для каждого нового соединения SQLite"""
+            cursor = dbapi_connection.cursor()
+            try:
+                # page_size и auto_vacuum должны быть заданы до перехода в WAL
+                # и до создания первой таблицы (create_all выполняется позже)
+                cursor.execute(f"PRAGMA page_size={SQLITE_PAGE_SIZE}")
+                cursor.execute(f"PRAGMA auto_vacuum={SQLITE_AUTO_VACUUM}")
+                cursor.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+                for pragma in SQLITE_PRAGMAS:
+                    cursor.execute(f"PRAGMA {pragma}")
+            finally:
+                cursor.close()
+
+            if SQLITE_BEGIN_CONCURRENT:
+                # Отключаем собственное управление транзакциями pysqlite,
+                # чтобы BEGIN выдавал обработчик события "begin"
+                dbapi_connection.isolation_level = None
+
+        if SQLITE_BEGIN_CONCURRENT:
+            @event.listens_for(engine, "begin")
+            def _begin_concurrent(conn):
+                """Запись конкурирует только на уровне страниц (BEGIN CONCURRENT)"""
+                conn.exec_driver_sql("BEGIN CONCURRENT")
+    # Для PostgreSQL или других СУБД
+    else:
+        db_url = DB_ENGINE
+        connect_args = {}
+        # Если установлен psycopg3, используем его вместо psycopg2: серверные
+        # prepared statements и многострочные INSERT (insertmanyvalues)
+        if db_url.startswith('postgresql://') and importlib.util.find_spec('psycopg') is not None:
+            db_url = 'postgresql+psycopg://' + db_url[len('postgresql://'):]
+            connect_args["prepare_threshold"] = 5
+
+        engine = create_engine(
+            db_url,
+            connect_args=connect_args,
+            echo=False,  # Установите True для отладки SQL-запросов
+            pool_size=DB_POOL_SIZE,  # Постоянные соединения пула
+            max_overflow=DB_MAX_OVERFLOW,  # Дополнительные соединения при пиковой нагрузке
+            pool_timeout=60,  # Увеличиваем тайм-аут для получения соединения из пула
+            pool_recycle=DB_POOL_RECYCLE,  # Пересоздание устаревших соединений (секунды)
+            pool_pre_ping=True,  # Добавляем проверку соединения перед использованием
+            pool_use_lifo=True,  # Повторно используем "горячие" соединения
+            query_cache_size=_QUERY_CACHE_SIZE
+        )
+
+    Session.configure(bind=engine)
+    return engine
 
 
 def init_db():
     """Инициализация базы данных"""
+    global _schema_ready
     try:
         # Проверка и настройка в зависимости от типа базы данных
         if is_sqlite:
-            # Для SQLite проверяем права на запись
-            db_path = DB_ENGINE.replace('sqlite:///', '')
-            db_dir = os.path.dirname(os.path.abspath(db_path))
-            test_file = os.path.join(db_dir, 'test_write.tmp')
-            try:
-                with open(test_file, 'w') as f:
-                    f.write('test')
-                os.remove(test_file)
-                logger.info(f"Проверка прав на запись в директорию {db_dir} успешна")
-            except Exception as e:
-                logger.error(f"Ошибка при проверке прав на запись в директорию {db_dir}: {e}")
-
-            logger.info(f"База данных SQLite будет создана по пути: {db_path}")
+            # Для SQLite проверяем права на запись (директорию создает get_engine)
+            get_engine()
+            if not os.access(SQLITE_DIR, os.W_OK):
+                logger.error("Нет прав на запись в директорию %s", SQLITE_DIR)
+
+            logger.info("База данных SQLite будет создана по пути: %s", SQLITE_PATH)
         elif is_postgres:
-            # Для PostgreSQL проверяем соединение
-            logger.info(f"Используется база данных PostgreSQL: {DB_ENGINE}")
-            try:
-                with engine.connect() as conn:
-                    logger.info("Соединение с PostgreSQL установлено успешно")
-            except Exception as e:
-                logger.error(f"Ошибка при подключении к PostgreSQL: {e}")
-                raise
+            # Отдельная проверка соединения не нужна: pool_pre_ping проверяет его при
+            # выдаче из пула, а ошибки подключения всплывут в engine.begin() ниже
+            logger.info("Используется база данных PostgreSQL: %s", DB_ENGINE)
         else:
-            logger.info(f"Используется база данных: {DB_ENGINE}")
+            logger.info("Используется база данных: %s", DB_ENGINE)
 
-        # Создаем все таблицы
-        Base.metadata.create_all(engine)
-        logger.info("Таблицы в базе данных созданы успешно")
-
-        # Проверяем, есть ли уже данные в базе
-        with get_session() as session:
-            from database.models import User
-            user_count = session.query(User).count()
-            logger.info(f"Количество пользователей в базе: {user_count}")
+        # DDL и начальные данные выполняются на одном соединении в одной транзакции.
+        # Если другой процесс держит блокировку дольше busy_timeout, повторяем попытку
+        for attempt in range(1, _INIT_DB_RETRIES + 1):
+            try:
+                with get_engine().begin() as conn:
+                    # Создаем все таблицы (один раз на процесс)
+                    if not _schema_ready:
+                        Base.metadata.create_all(conn)
+                        logger.info("Таблицы в базе данных созданы успешно")
 
-            # Если база пуста, добавляем начальные данные
-            if user_count == 0:
-                add_default_data()
-                logger.info("Начальные данные добавлены успешно")
-            else:
-                logger.info("База данных уже содержит данные, пропускаем добавление начальных данных")
+                    # Вставки идемпотентны, отдельная проверка наличия данных не нужна
+                    add_default_data(conn)
+                _schema_ready = True
+                break
+            except OperationalError as e:
+                if not is_sqlite or "locked" not in str(e).lower() or attempt == _INIT_DB_RETRIES:
+                    raise
+                logger.warning("База данных заблокирована, повторная попытка %d из %d",
+                               attempt, _INIT_DB_RETRIES)
+                time.sleep(attempt)
 
-    except Exception as e:
-        logger.error(f"Ошибка инициализации базы данных: {e}")
-        logger.error(traceback.format_exc())
+    except Exception:
+        logger.exception("Ошибка инициализации базы данных")
         raise
 
 
 @contextmanager
 def get_session():
     """Контекстный менеджер для работы с сессией базы данных"""
+    get_engine()  # Привязывает Session к движку при первом вызове
     session = Session()
+    debug = logger.isEnabledFor(logging.DEBUG)
     try:
-        logger.debug("Открыта новая сессия базы данных")
+        if debug:
+            logger.debug("Открыта новая сессия базы данных")
         yield session
-        if session.is_active:  # Проверка, что сессия все еще активна
-            session.commit()
+        session.commit()
+        if debug:
             logger.debug("Сессия успешно закрыта с commit")
-    except Exception as e:
+    except Exception:
         if session.is_active:  # Проверка, что сессия все еще активна
             session.rollback()
-            logger.error(f"Ошибка в сессии базы данных, выполнен rollback: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("Ошибка в сессии базы данных, выполнен rollback")
         raise
     finally:
         session.close()
-        logger.debug("Сессия закрыта в блоке finally")
+        if debug:
+            logger.debug("Сессия закрыта в блоке finally")
+
 
+async def run_db(func, *args, **kwargs):
+    """Выполнение синхронной работы с БД в пуле потоков, не блокируя цикл событий бота"""
+    return await asyncio.to_thread(func, *args, **kwargs)
 
-def add_default_data():
-    """Добавление начальных данных в базу данных"""
-    from database.models import User, Topic
 
+def incremental_vacuum(pages=100):
+    """Возврат свободных страниц SQLite (при auto_vacuum=INCREMENTAL) без блокировки на весь VACUUM"""
+    if not is_sqlite:
+        return
     try:
+        # Прагма освобождает по одной странице на каждый шаг выполнения, а execute()
+        # драйвера sqlite3 делает только первый шаг (строк она не возвращает, дочитать
+        # нечего). executescript() выполняет инструкцию до конца
+        raw = get_engine().raw_connection()
+        try:
+            raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        finally:
+            raw.close()
+    except Exception as e:
+        logger.error("Ошибка при выполнении incremental_vacuum: %s", e)
+
+
+def get_user_cached(telegram_id):
+    """Получение id и роли пользователя по telegram_id с кэшированием
+
+    Returns:
+        dict: {"id": ..., "role": ...} или None, если пользователь не найден
+    """
+    user = _USER_CACHE.get(telegram_id)
+    if user is None:
         with get_session() as session:
-            # Проверяем, есть ли уже администратор
-            admin_exists = session.query(User).filter(User.role == "admin").first() is not None
-
-            if not admin_exists:
-                # Добавляем администратора (ID нужно заменить на реальный)
-                # Если есть хотя бы один администратор в конфигурации, используем его
-                if ADMINS:
-                    try:
-                        admin_id = int(ADMINS[0])
-                        admin = User(
-                            telegram_id=admin_id,
-                            username="admin",
-                            full_name="Admin",
-                            role="admin"
-                        )
-                        session.add(admin)
-                        logger.info(f"Default admin user added with ID: {admin_id}")
-                    except (ValueError, IndexError) as e:
-                        logger.error(f"Error adding default admin: {e}")
-                else:
-                    logger.warning("No admin IDs found in configuration. Skipping admin creation.")
-
-            # Проверяем, есть ли уже темы
-            topics_exist = session.query(Topic).first() is not None
-
-            if not topics_exist:
-                # Добавляем несколько начальных тем
-                topics = [
-                    Topic(name="Древняя Русь IX-XII вв.",
-                          description="Вопросы по истории Древней Руси в период IX-XII веков"),
-
-                ]
-
-                session.add_all(topics)
-                logger.info("Default topics added")
-
-            session.commit()
-            logger.info("Default data added successfully")
+            # Выбираем только нужные столбцы, а не всю строку пользователя
+            row = session.execute(_USER_BY_TELEGRAM_ID, {"telegram_id": telegram_id}).one_or_none()
+        if row is None:
+            # Отсутствие пользователя не кэшируем - он может зарегистрироваться в любой момент
+            return None
+        user = {"id": row.id, "role": row.role}
+        _USER_CACHE[telegram_id] = user
+    return user
+
+
+def invalidate_user_cache(telegram_id=None):
+    """Сброс кэша пользователей (для одного telegram_id или полностью)"""
+    if telegram_id is None:
+        _USER_CACHE.clear()
+    else:
+        _USER_CACHE.pop(telegram_id, None)
+
+
+def dialect_insert(table):
+    """Конструктор INSERT с поддержкой ON CONFLICT для текущей СУБД"""
+    if is_sqlite:
+        from sqlalchemy.dialects.sqlite import insert as on_conflict_insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert as on_conflict_insert
+    return on_conflict_insert(table)
+
+
+def add_default_data(conn=None):
+    """Добавление начальных данных в базу данных
+
+    Args:
+        conn: Открытое соединение с транзакцией (если не передано, открывается новое)
+    """
+    from database.models import Topic
+
+    if conn is None:
+        with get_engine().begin() as conn:
+            return add_default_data(conn)
+
+    try:
+        # Каждая вставка - один INSERT ... SELECT ... WHERE NOT EXISTS: проверка и запись
+        # выполняются одним запросом, без гонки между отдельными SELECT и INSERT
+        if ADMIN_IDS:
+            admin_id = ADMIN_IDS[0]
+            admin_row = select(
+                literal(admin_id), literal("admin"), literal("Admin"), literal("admin")
+            ).where(
+                ~select(User.id).where(or_(User.role == "admin", User.telegram_id == admin_id)).exists()
+            )
+            result = conn.execute(
+                insert(User.__table__).from_select(
+                    ["telegram_id", "username", "full_name", "role"], admin_row
+                )
+            )
+            if result.rowcount:
+                logger.info("Default admin user added with ID: %s", admin_id)
+        else:
+            logger.warning("No admin IDs found in configuration. Skipping admin creation.")
+
+        # Начальные темы добавляются, только если таблица тем пуста
+        no_topics = ~select(Topic.id).exists()
+        topic_rows = union_all(*(
+            select(literal(topic["name"]), literal(topic["description"])).where(no_topics)
+            for topic in _DEFAULT_TOPICS
+        ))
+        result = conn.execute(
+            insert(Topic.__table__).from_select(["name", "description"], topic_rows)
+        )
+        if result.rowcount:
+            logger.info("Default topics added")
+
+        logger.info("Default data added successfully")
 
     except Exception as e:
-        logger.error(f"Error adding default data: {e}")
-        raise
\ No newline at end of file
+        logger.error("Error adding default data: %s", e)
+        raise
@@ -3,6 +3,7 @@ import json
 import os
 import asyncio
 import traceback
+from itertools import islice
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
@@ -13,7 +14,7 @@ from database.models import User, Topic, Question, TestResult, Achievement, Noti
 from config import ADMINS
 import logging
 from database.models import BotSettings
-from database.db_manager import get_session
+from database.db_manager import get_session, invalidate_user_cache
 
 # Импортируем клавиатуры
 from keyboards.admin_kb import (
@@ -147,6 +148,11 @@ class AdminHandler:
         if parent_service_inst:
             self.parent_service = parent_service_inst
 
+    def _topics_changed(self):
+        """Сброс кэша тем в сервисе тестирования после изменения тем"""
+        if self.quiz_service:
+            self.quiz_service.invalidate_topics_cache()
+
     async def handle_topic_edit_action(self, update, context, action_type, topic_id):
         """Общая логика обработки действий редактирования темы"""
         query = update.callback_query
@@ -608,6 +614,7 @@ class AdminHandler:
                 # Удаляем самого пользователя
                 session.delete(user)
                 session.commit()
+                invalidate_user_cache(user.telegram_id)
                 success = True
 
             if success and user_name:
@@ -861,7 +868,7 @@ class AdminHandler:
                 text += f"• *{topic_name}*: {avg_error:.1f}% ошибок (всего вопросов: {questions_count})\n"
 
             text += "\n*Топ-10 самых проблемных вопросов:*\n"
-            for i, question in enumerate(problematic_questions[:10], 1):
+            for i, question in enumerate(islice(problematic_questions, 10), 1):
                 short_question = question["question_text"][:50] + "..." if len(question["question_text"]) > 50 else \
                 question["question_text"]
                 text += f"{i}. *{short_question}*\n"
@@ -1336,6 +1343,7 @@ class AdminHandler:
                         # Затем удаляем саму тему
                         session.delete(topic)
                         session.commit()
+                    self._topics_changed()
                     if topic_name:
                         await query.edit_message_text(f"✅ Тема '{topic_name}' и все связанные вопросы успешно удалены.")
                         # Пауза перед показом списка тем
@@ -1433,6 +1441,8 @@ class AdminHandler:
 
             # Импортируем вопросы
             result = self.import_questions_from_json(data)
+            if result.get("success"):
+                self._topics_changed()
 
             # Удаляем временный файл
             os.remove(file_path)
@@ -1496,6 +1506,7 @@ class AdminHandler:
                     old_name = topic.name
                     topic.name = new_name
                     session.commit()
+                self._topics_changed()
 
                 await update.message.reply_text(f"✅ Название темы успешно изменено с '{old_name}' на '{new_name}'.")
 
@@ -1543,6 +1554,7 @@ class AdminHandler:
                     session.commit()
 
                     logger.info(f"Описание темы {topic_id} успешно обновлено")
+                self._topics_changed()
 
                 await update.message.reply_text(
                     f"✅ Описание темы '{topic_name}' успешно обновлено."
@@ -1791,6 +1803,8 @@ class AdminHandler:
 
             # Создаем новую тему
             result = self.add_topic_to_db(topic_name, topic_description)
+            if result.get("success"):
+                self._topics_changed()
 
             if result["success"]:
                 await update.message.reply_text(
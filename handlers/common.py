@@ -1,76 +1,233 @@
 import logging
-import traceback
 import asyncio
 import json
+import re
+import time
 from datetime import datetime, timezone
 
+from sqlalchemy import case, func, update as sql_update
+
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
 from database.models import User
-from database.db_manager import get_session
+from database.db_manager import (
+    get_session, run_db, get_user_cached, invalidate_user_cache, dialect_insert
+)
 from services.quiz_service import QuizService
 from services.parent_service import ParentService
+from services.stats_service import generate_leaderboard
+from handlers.student import StudentHandler
+from handlers.parent import ParentHandler, LINK_INSTRUCTIONS
+from handlers.admin import AdminHandler
+from handlers.start import StartHandler
+from keyboards.student_kb import student_main_keyboard, leaderboard_period_keyboard
+from keyboards.parent_kb import parent_main_keyboard
+from keyboards.admin_kb import admin_main_keyboard
+from utils.chat_queue import chat_queue
 
 logger = logging.getLogger(__name__)
 
+# Названия периодов для таблицы лидеров
+_PERIOD_NAMES = {"week": "неделю", "month": "месяц", "year": "год", "all": "всё время"}
+
+# Время жизни кэша таблицы лидеров (в секундах)
+_LEADERBOARD_TTL = 30
+
+# Префиксы callback_data, проверяемые одним проходом регулярного выражения;
+# имя сработавшей группы - ключ в CommonHandler._prefix_routes
+_PREFIX_ROUTE_RE = re.compile(
+    r"(?P<stats>common_stats_)"
+    r"|(?P<leaderboard>common_leaderboard_)"
+    r"|(?P<start_test>common_start_test)"
+)
+
+# Интервал записи накопленных last_active в базу (в секундах)
+_LAST_ACTIVE_FLUSH_INTERVAL = 2
+
+# Точность отметок last_active (в секундах)
+_ACTIVE_CLOCK_RESOLUTION = 0.05
+_active_clock = [0.0, None]  # [monotonic-время обновления, закэшированное datetime]
+
+
+def _coarse_now() -> datetime:
+    """Текущее время UTC с точностью до _ACTIVE_CLOCK_RESOLUTION
+
+    Достаточно для last_active и избавляет от создания datetime на каждое нажатие при всплесках.
+    """
+    now = time.monotonic()
+    if now - _active_clock[0] >= _ACTIVE_CLOCK_RESOLUTION or _active_clock[1] is None:
+        _active_clock[0] = now
+        _active_clock[1] = datetime.now(timezone.utc)
+    return _active_clock[1]
+
+
+# Неизменяемые тексты ответов
+STUDENT_WELCOME = (
+    "✅ Вы успешно зарегистрированы как ученик!\n\n"
+    "Вы можете проходить тесты, отслеживать свою успеваемость и получать достижения.\n\n"
+    "Выберите действие:"
+)
+PARENT_WELCOME = (
+    "✅ Вы успешно зарегистрированы как родитель!\n\n"
+    "Вы можете привязать аккаунт ученика, используя команду /link с кодом, который вам предоставит ученик.\n\n"
+    "Выберите действие:"
+)
+# Сообщения пользователю для типовых ошибок Telegram API
+_ERROR_MESSAGES = {
+    telegram.error.BadRequest: "Произошла ошибка при отправке сообщения. Пожалуйста, попробуйте еще раз.",
+    telegram.error.Forbidden: "Бот не имеет доступа. Возможно, вы его заблокировали?",
+    telegram.error.TimedOut: "Истекло время ожидания ответа от серверов Telegram. Пожалуйста, попробуйте снова.",
+}
+_DEFAULT_ERROR_MESSAGE = (
+    "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз или обратитесь к администратору."
+)
+UNKNOWN_CMD_TMPL = "Неизвестная команда: {}\n\nИспользуйте /help для получения списка доступных команд."
+
 class CommonHandler:
     def __init__(self, quiz_service: QuizService, parent_service: ParentService):
         self.quiz_service = quiz_service
         self.parent_service = parent_service
 
+        # Вложенные обработчики создаются один раз, а не при каждом нажатии кнопки
+        self.student = StudentHandler(quiz_service)
+        self.parent = ParentHandler(parent_service)
+        self.admin = AdminHandler()
+        self.admin.init_services(quiz_service, parent_service)
+        self.start = StartHandler()
+
+        # Кэш таблицы лидеров: {period: (время, версия результатов, текст, есть ли данные)}
+        self._leaderboard_cache = {}
+
+        # Накопленные отметки активности {telegram_id: время}, записываются пакетом
+        self._pending_active = {}
+        self._flush_task = None
+
+        # Таблицы маршрутизации callback_data -> обработчик
+        # Кнопки, не требующие проверки регистрации пользователя
+        self._pre_role_routes = {
+            "common_role_student": self._register_student,
+            "common_role_parent": self._register_parent,
+        }
+        # Кнопки зарегистрированного пользователя, которым роль не нужна:
+        # для них не выполняется запрос роли к базе
+        self._role_free_routes = {
+            "common_link_student": self._route_link_student,
+        }
+        # Точные совпадения (требуют роль пользователя)
+        self._exact_routes = {
+            "common_start_test": self._route_start_test,
+            "common_stats": self._route_stats,
+            "common_achievements": self._route_achievements,
+            "common_help": self._route_help,
+            "common_reports": self._route_reports,
+            "common_parent_settings": self._route_parent_settings,
+            "common_admin_panel": self._route_admin_panel,
+            "common_leaderboard": self._route_leaderboard,
+            "common_back_to_main": self._route_back_to_main,
+        }
+        # Совпадения по префиксу: имя группы _PREFIX_ROUTE_RE -> обработчик
+        self._prefix_routes = {
+            "stats": self._route_stats,
+            "leaderboard": self._route_leaderboard,
+            "start_test": self._route_start_test,
+        }
+
     async def check_and_create_user(self, user_id: int, username: str, full_name: str, role: str) -> bool:
         """Проверка и создание пользователя, если он не существует"""
+        # Запросы к БД выполняются в пуле потоков, чтобы не блокировать другие чаты
+        return await run_db(self._create_or_update_user, user_id, username, full_name, role)
+
+    def _create_or_update_user(self, user_id: int, username: str, full_name: str, role: str) -> bool:
+        """Синхронное создание или обновление пользователя"""
         try:
-            from database.models import User
-            from database.db_manager import get_session
+            # Один UPSERT вместо SELECT + UPDATE/INSERT + проверочного SELECT
+            now = datetime.now(timezone.utc)
+            stmt = dialect_insert(User.__table__).values(
+                telegram_id=user_id,
+                username=username,
+                full_name=full_name,
+                role=role,
+                created_at=now,
+                last_active=now,
+                settings='{}' if role == 'parent' else None
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["telegram_id"],
+                set_={
+                    "username": stmt.excluded.username,
+                    "full_name": stmt.excluded.full_name,
+                    "role": stmt.excluded.role,
+                    "last_active": stmt.excluded.last_active,
+                    # Пустые настройки существующего пользователя заменяем на '{}'
+                    "settings": func.coalesce(func.nullif(User.settings, ''), '{}'),
+                }
+            ).returning(User.id)
 
             with get_session() as session:
-                # Проверяем существование пользователя
-                existing_user = session.query(User).filter(User.telegram_id == user_id).first()
-
-                if existing_user:
-                    # Обновляем существующего пользователя
-                    existing_user.username = username
-                    existing_user.full_name = full_name
-                    existing_user.role = role
-                    existing_user.last_active = datetime.now(timezone.utc)
-                    if not existing_user.settings:
-                        existing_user.settings = '{}'
-
-                    logger.info(f"Обновлен пользователь: id={existing_user.id}, роль={role}")
-                    session.commit()
-                    return True
-                else:
-                    # Создаем нового пользователя
-                    new_user = User(
-                        telegram_id=user_id,
-                        username=username,
-                        full_name=full_name,
-                        role=role,
-                        created_at=datetime.now(timezone.utc),
-                        last_active=datetime.now(timezone.utc),
-                        settings='{}' if role == 'parent' else None
-                    )
+                db_user_id = session.execute(stmt).scalar_one()
 
-                    session.add(new_user)
-                    session.commit()
+            # Роль могла измениться - сбрасываем закэшированные данные пользователя. Только
+            # после commit: иначе параллельное чтение успеет закэшировать старую роль
+            invalidate_user_cache(user_id)
 
-                    # Проверяем создание
-                    check_user = session.query(User).filter(User.telegram_id == user_id).first()
-                    if check_user:
-                        logger.info(f"Создан новый пользователь: id={check_user.id}, роль={role}")
-                        return True
-                    else:
-                        logger.error(f"Не удалось создать пользователя с telegram_id={user_id}")
-                        return False
+            logger.info(f"Сохранен пользователь: id={db_user_id}, роль={role}")
+            return True
 
         except Exception as e:
-            logger.error(f"Ошибка при проверке/создании пользователя: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Ошибка при проверке/создании пользователя: %s", e)
             return False
 
+    def _get_user_role(self, user_id: int):
+        """Получение роли пользователя из кэша (None, если пользователь не найден)"""
+        user = get_user_cached(user_id)
+        return user["role"] if user else None
+
+    async def _touch_user(self, user_id: int):
+        """Отметка активности и получение роли пользователя"""
+        role = await run_db(self._get_user_role, user_id)
+        if role is None:
+            return None
+
+        # Время последней активности записывается в базу пакетом (_flush_last_active)
+        self._pending_active[user_id] = _coarse_now()
+        return role
+
+    async def _flush_last_active(self) -> None:
+        """Передача накопленных отметок активности на запись в базу"""
+        if not self._pending_active:
+            return
+        # Обмен словаря выполняется в цикле событий, поэтому отметки не теряются
+        batch, self._pending_active = self._pending_active, {}
+        await run_db(self._write_last_active, batch)
+
+    def _write_last_active(self, batch: dict) -> None:
+        """Запись отметок активности одним UPDATE ... SET last_active = CASE ..."""
+        try:
+            with get_session() as session:
+                session.execute(
+                    sql_update(User)
+                    .where(User.telegram_id.in_(list(batch)))
+                    .values(last_active=case(batch, value=User.telegram_id))
+                    .execution_options(synchronize_session=False)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при записи времени активности пользователей: {e}")
+
+    async def _last_active_flush_loop(self) -> None:
+        """Фоновая периодическая запись отметок активности"""
+        while True:
+            await asyncio.sleep(_LAST_ACTIVE_FLUSH_INTERVAL)
+            await self._flush_last_active()
+
+    async def stop(self) -> None:
+        """Остановка фоновой записи и финальный сброс отметок активности"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._flush_last_active()
+
     async def handle_common_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик нажатий на общие кнопки интерфейса"""
         query = update.callback_query
@@ -81,307 +238,61 @@ class CommonHandler:
 
         await query.answer()
 
-        logger.info(f"Обработка нажатия кнопки: {callback_data} пользователем {user_id}")
-
-        # Если это выбор роли, обрабатываем особым образом
-        if callback_data == "common_role_student":
-            logger.info(f"Начало регистрации пользователя {user_id} как ученика")
-            try:
-                telegram_user = update.effective_user
-                full_name = f"{telegram_user.first_name} {telegram_user.last_name or ''}"
-
-                # Создаем или обновляем пользователя
-                success = await self.check_and_create_user(
-                    user_id=user_id,
-                    username=telegram_user.username,
-                    full_name=full_name,
-                    role="student"
-                )
+        # Основную работу выполняем в очереди чата, чтобы не задерживать получение обновлений
+        chat_queue.submit(update.effective_chat.id, self._process_button(update, context), update, context)
 
-                if not success:
-                    raise Exception("Не удалось создать/обновить пользователя")
-
-                # Отправляем сообщение о успешной регистрации
-                await query.edit_message_text(
-                    "✅ Вы успешно зарегистрированы как ученик!\n\n"
-                    "Вы можете проходить тесты, отслеживать свою успеваемость и получать достижения."
-                )
-
-                # Небольшая пауза перед отображением меню
-                await asyncio.sleep(1)
-
-                # Отправляем главное меню
-                from keyboards.student_kb import student_main_keyboard
-                reply_markup = student_main_keyboard()
-
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Выберите действие:",
-                    reply_markup=reply_markup
-                )
-                return
-            except Exception as e:
-                logger.error(f"Ошибка при регистрации ученика: {e}")
-                logger.error(traceback.format_exc())
-                await query.edit_message_text(
-                    "Произошла ошибка при регистрации. Пожалуйста, попробуйте еще раз или обратитесь к администратору."
-                )
-                return
-
-        elif callback_data == "student_recommendations":
-            logger.info(f"Перенаправление обработки student_recommendations на StudentHandler")
-            try:
-                # Вместо создания нового экземпляра, используем существующий обработчик
-                # из контекста
-                from handlers.student import StudentHandler
-                # Получаем существующий quiz_service
-                if hasattr(self, 'quiz_service'):
-                    # Создаем StudentHandler только если нужно
-                    if not hasattr(context, '_student_handler'):
-                        context._student_handler = StudentHandler(self.quiz_service)
-                    # Вызываем метод show_recommendations
-                    await context._student_handler.show_recommendations(update, context)
-                else:
-                    logger.error("quiz_service не найден в CommonHandler")
-                    await query.edit_message_text(
-                        "Произошла ошибка при формировании рекомендаций. Пожалуйста, попробуйте позже."
-                    )
-            except Exception as e:
-                logger.error(f"Ошибка при обработке student_recommendations в CommonHandler: {e}")
-                logger.error(traceback.format_exc())
-                await query.edit_message_text(
-                    "Произошла ошибка при формировании рекомендаций. Пожалуйста, попробуйте позже."
-                )
-
-
-        elif callback_data == "admin_problematic_questions":
-            from handlers.admin import AdminHandler
-            admin_handler = AdminHandler()
-            await admin_handler.show_problematic_questions(update, context)
-
-        elif callback_data == "common_role_parent":
-            logger.info(f"Начало регистрации пользователя {user_id} как родителя")
-            try:
-                telegram_user = update.effective_user
-                full_name = f"{telegram_user.first_name} {telegram_user.last_name or ''}"
-
-                # Создаем или обновляем пользователя
-                success = await self.check_and_create_user(
-                    user_id=user_id,
-                    username=telegram_user.username,
-                    full_name=full_name,
-                    role="parent"
-                )
-
-                if not success:
-                    raise Exception("Не удалось создать/обновить пользователя")
-
-                # Отправляем сообщение о успешной регистрации
-                await query.edit_message_text(
-                    "✅ Вы успешно зарегистрированы как родитель!\n\n"
-                    "Вы можете привязать аккаунт ученика, используя команду /link с кодом, который вам предоставит ученик."
-                )
+    async def _process_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработка нажатия кнопки (выполняется в очереди чата)"""
+        query = update.callback_query
+        callback_data = query.data
+        user_id = update.effective_user.id
 
-                # Небольшая пауза перед отображением меню
-                await asyncio.sleep(1)
+        logger.info(f"Обработка нажатия кнопки: {callback_data} пользователем {user_id}")
 
-                # Отправляем главное меню
-                from keyboards.parent_kb import parent_main_keyboard
-                reply_markup = parent_main_keyboard()
+        # Кнопки, которые обрабатываются до проверки регистрации (выбор роли и т.п.)
+        pre_route = self._pre_role_routes.get(callback_data)
+        if pre_route is not None:
+            await pre_route(update, context)
+            return
 
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Выберите действие:",
-                    reply_markup=reply_markup
-                )
-                return
-            except Exception as e:
-                logger.error(f"Ошибка при регистрации родителя: {e}")
-                logger.error(traceback.format_exc())
-                await query.edit_message_text(
-                    "Произошла ошибка при регистрации. Пожалуйста, попробуйте еще раз или обратитесь к администратору."
-                )
-                return
+        # Фоновая запись last_active запускается при первом обращении (нужен работающий цикл событий)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._last_active_flush_loop())
 
         # Проверяем, зарегистрирован ли пользователь
         try:
-            # Получаем роль пользователя
-            with get_session() as session:
-                user = session.query(User).filter(User.telegram_id == user_id).first()
-                if not user:
-                    logger.warning(f"Пользователь {user_id} не найден в базе при нажатии на кнопку {callback_data}")
-                    await query.edit_message_text(
-                        "Кажется, вы еще не зарегистрированы. Пожалуйста, используйте команду /start"
-                    )
-                    return
-
-                # Обновляем время последней активности
-                user.last_active = datetime.now(timezone.utc)
-                session.commit()
-
-                role = user.role
-                logger.info(f"Роль пользователя {user_id}: {role}")
-
-            # Обработка кнопок в зависимости от callback_data
-            if callback_data.startswith("common_start_test") or callback_data == "common_start_test":
-                logger.debug(f"Перенаправление на start_test")
-                from handlers.student import StudentHandler
-                student_handler = StudentHandler(self.quiz_service)
-                context.user_data["from_button"] = True  # Флаг для функции, что вызов из кнопки
-                await student_handler.start_test(update, context)
-
-            elif callback_data.startswith("common_stats") or callback_data == "common_stats":
-                logger.debug(f"Перенаправление на show_stats")
-
-                # Определяем период для статистики
-                if callback_data == "common_stats":
-                    period = "all"
-                else:
-                    period = callback_data.replace("common_stats_", "")
-
-                # Устанавливаем период в качестве аргумента
-                context.args = [period]
-                context.user_data["from_button"] = True  # Флаг для функции
-
-                from handlers.student import StudentHandler
-                student_handler = StudentHandler(self.quiz_service)
-                await student_handler.show_stats(update, context)
-
-            elif callback_data == "common_achievements":
-                logger.debug(f"Перенаправление на show_achievements")
-
-                context.user_data["from_button"] = True  # Флаг для функции
-                from handlers.student import StudentHandler
-                student_handler = StudentHandler(self.quiz_service)
-                await student_handler.show_achievements(update, context)
-
-            elif callback_data == "common_help":
-                logger.debug(f"Перенаправление на help_command")
-
-                from handlers.start import StartHandler
-                start_handler = StartHandler()
-                # Получаем текст справки в зависимости от роли
-                help_text = start_handler.get_help_text(role)
-
-                # И просто редактируем сообщение
-                await query.edit_message_text(
-                    help_text,
-                    parse_mode="Markdown"
-                )
+            role_free_route = self._role_free_routes.get(callback_data)
+            if role_free_route is not None:
+                await role_free_route(update, context, callback_data, None)
+                return
 
-            # Обработчики для кнопок в тестах
-            elif callback_data.startswith("quiz_start_"):
-                logger.debug(f"Перенаправление на handle_test_button")
-                from handlers.student import StudentHandler
-                student_handler = StudentHandler(self.quiz_service)
-                await student_handler.handle_test_button(update, context)
-
-            elif (callback_data.startswith("quiz_answer_") or
-                  callback_data.startswith("quiz_seq_") or
-                  callback_data.startswith("quiz_reset_") or
-                  callback_data.startswith("quiz_confirm_") or
-                  callback_data == "quiz_skip"):
-                logger.debug(f"Перенаправление на handle_test_button")
-                from handlers.student import StudentHandler
-                student_handler = StudentHandler(self.quiz_service)
-                await student_handler.handle_test_button(update, context)
-
-            elif callback_data == "common_link_student":
-                logger.debug(f"Перенаправление на инструкцию по привязке ученика")
+            # Получаем роль пользователя
+            role = await self._touch_user(user_id)
+            if role is None:
+                logger.warning(f"Пользователь {user_id} не найден в базе при нажатии на кнопку {callback_data}")
                 await query.edit_message_text(
-                    "Для привязки аккаунта ученика используйте команду /link с кодом ученика.\n\n"
-                    "Пример: /link 123456\n\n"
-                    "Код можно получить у ученика, который должен выполнить команду /mycode"
+                    "Кажется, вы еще не зарегистрированы. Пожалуйста, используйте команду /start"
                 )
+                return
 
-            elif callback_data == "common_reports":
-                logger.debug(f"Перенаправление на get_report")
-                # Создаем пустой список аргументов для команды
-                context.args = []
-                from handlers.parent import ParentHandler
-                parent_handler = ParentHandler(self.parent_service)
-                await parent_handler.get_report(update, context)
-
-            elif callback_data == "common_parent_settings":
-                logger.debug(f"Перенаправление на settings")
-                # Создаем пустой список аргументов для команды
-                context.args = []
-                from handlers.parent import ParentHandler
-                parent_handler = ParentHandler(self.parent_service)
-                await parent_handler.settings(update, context)
-
-            elif callback_data == "common_help":
-                logger.debug(f"Перенаправление на help_command")
-                # Удаляем текущее сообщение с кнопками, чтобы не было конфликта
-                await query.delete_message()
-                from handlers.start import StartHandler
-                start_handler = StartHandler()
-                await start_handler.help_command(update, context)
-
-            elif callback_data == "common_admin_panel":
-                logger.debug(f"Перенаправление на admin_panel")
-                # Удаляем текущее сообщение с кнопками, чтобы не было конфликта
-                await query.delete_message()
-                from handlers.admin import AdminHandler
-                admin_handler = AdminHandler()
-                await admin_handler.admin_panel(update, context)
-
-            elif callback_data.startswith("common_leaderboard"):
-                logger.debug(f"Перенаправление на show_leaderboard")
-
-                # Определяем период для лидерборда
-                if callback_data == "common_leaderboard":
-                    period = "week"
-                else:
-                    period = callback_data.replace("common_leaderboard_", "")
-
-                # Устанавливаем период в качестве аргумента
-                context.args = [period]
-                await self.show_leaderboard(update, context, period)
-
-            elif callback_data == "common_back_to_main":
-                logger.debug(f"Возврат к главному меню")
-                # Получаем роль пользователя для отображения соответствующего главного меню
-                with get_session() as session:
-                    user = session.query(User).filter(User.telegram_id == user_id).first()
-                    if not user:
-                        await query.edit_message_text(
-                            "Произошла ошибка. Пожалуйста, используйте команду /start для начала работы с ботом."
-                        )
-                        return
-
-                    role = user.role
-
-                # Отображаем соответствующее главное меню
-                if role == "student":
-                    from keyboards.student_kb import student_main_keyboard
-                    reply_markup = student_main_keyboard()
-                elif role == "parent":
-                    from keyboards.parent_kb import parent_main_keyboard
-                    reply_markup = parent_main_keyboard()
-                elif role == "admin":
-                    from keyboards.admin_kb import admin_main_keyboard
-                    reply_markup = admin_main_keyboard()
-                else:
-                    # По умолчанию, если роль неизвестна
-                    from keyboards.student_kb import student_main_keyboard
-                    reply_markup = student_main_keyboard()
+            logger.info(f"Роль пользователя {user_id}: {role}")
 
-                # Отображаем главное меню
-                await query.edit_message_text(
-                    "Выберите действие:",
-                    reply_markup=reply_markup
-                )
+            # Обработка кнопок в зависимости от callback_data: сначала точное совпадение,
+            # затем поиск по префиксу
+            route = self._exact_routes.get(callback_data)
+            if route is None:
+                match = _PREFIX_ROUTE_RE.match(callback_data)
+                if match:
+                    route = self._prefix_routes[match.lastgroup]
 
+            if route is not None:
+                await route(update, context, callback_data, role)
             else:
                 logger.warning(f"Неизвестный callback_data: {callback_data}")
-                await query.edit_message_text(
-                    f"Неизвестная команда: {callback_data}\n\nИспользуйте /help для получения списка доступных команд."
-                )
+                await query.edit_message_text(UNKNOWN_CMD_TMPL.format(callback_data))
 
         except Exception as e:
-            logger.error(f"Error in handle_common_button: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error in handle_common_button: %s", e)
             try:
                 await query.edit_message_text(
                     "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте еще раз."
@@ -397,103 +308,261 @@ class CommonHandler:
                 except Exception:
                     pass  # Если и это не удалось, просто игнорируем
 
+    async def _register_student(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Регистрация пользователя как ученика"""
+        query = update.callback_query
+        telegram_user = update.effective_user
+        user_id = telegram_user.id
+        logger.info(f"Начало регистрации пользователя {user_id} как ученика")
+        try:
+            full_name = f"{telegram_user.first_name} {telegram_user.last_name or ''}"
+
+            # Создаем или обновляем пользователя
+            success = await self.check_and_create_user(
+                user_id=user_id,
+                username=telegram_user.username,
+                full_name=full_name,
+                role="student"
+            )
+
+            if not success:
+                raise Exception("Не удалось создать/обновить пользователя")
+
+            # Сообщение об успешной регистрации и главное меню - одним сообщением
+            await query.edit_message_text(STUDENT_WELCOME, reply_markup=student_main_keyboard())
+        except Exception as e:
+            logger.exception("Ошибка при регистрации ученика: %s", e)
+            await query.edit_message_text(
+                "Произошла ошибка при регистрации. Пожалуйста, попробуйте еще раз или обратитесь к администратору."
+            )
+
+    async def _register_parent(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Регистрация пользователя как родителя"""
+        query = update.callback_query
+        telegram_user = update.effective_user
+        user_id = telegram_user.id
+        logger.info(f"Начало регистрации пользователя {user_id} как родителя")
+        try:
+            full_name = f"{telegram_user.first_name} {telegram_user.last_name or ''}"
+
+            # Создаем или обновляем пользователя
+            success = await self.check_and_create_user(
+                user_id=user_id,
+                username=telegram_user.username,
+                full_name=full_name,
+                role="parent"
+            )
+
+            if not success:
+                raise Exception("Не удалось создать/обновить пользователя")
+
+            # Сообщение об успешной регистрации и главное меню - одним сообщением
+            await query.edit_message_text(PARENT_WELCOME, reply_markup=parent_main_keyboard())
+        except Exception as e:
+            logger.exception("Ошибка при регистрации родителя: %s", e)
+            await query.edit_message_text(
+                "Произошла ошибка при регистрации. Пожалуйста, попробуйте еще раз или обратитесь к администратору."
+            )
+
+    async def _route_start_test(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопка начала теста"""
+        logger.debug(f"Перенаправление на start_test")
+        context.user_data["from_button"] = True  # Флаг для функции, что вызов из кнопки
+        await self.student.start_test(update, context)
+
+    async def _route_stats(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопки статистики ученика"""
+        logger.debug(f"Перенаправление на show_stats")
+
+        # Определяем период для статистики
+        if callback_data == "common_stats":
+            period = "all"
+        else:
+            period = callback_data.replace("common_stats_", "")
+
+        # Устанавливаем период в качестве аргумента
+        context.args = [period]
+        context.user_data["from_button"] = True  # Флаг для функции
+
+        await self.student.show_stats(update, context)
+
+    async def _route_achievements(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопка достижений"""
+        logger.debug(f"Перенаправление на show_achievements")
+
+        context.user_data["from_button"] = True  # Флаг для функции
+        await self.student.show_achievements(update, context)
+
+    async def _route_help(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопка справки"""
+        logger.debug(f"Перенаправление на help_command")
+
+        # Получаем текст справки в зависимости от роли
+        help_text = self.start.get_help_text(role)
+
+        # И просто редактируем сообщение
+        await update.callback_query.edit_message_text(
+            help_text,
+            parse_mode="Markdown"
+        )
+
+    async def _route_link_student(self, update, context, callback_data: str, role: str) -> None:
+        """Инструкция по привязке ученика"""
+        logger.debug(f"Перенаправление на инструкцию по привязке ученика")
+        await update.callback_query.edit_message_text(LINK_INSTRUCTIONS)
+
+    async def _route_reports(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопка отчетов родителя"""
+        logger.debug(f"Перенаправление на get_report")
+        # Создаем пустой список аргументов для команды
+        context.args = []
+        await self.parent.get_report(update, context)
+
+    async def _route_parent_settings(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопка настроек родителя"""
+        logger.debug(f"Перенаправление на settings")
+        # Создаем пустой список аргументов для команды
+        context.args = []
+        await self.parent.settings(update, context)
+
+    async def _route_admin_panel(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопка панели администратора"""
+        logger.debug(f"Перенаправление на admin_panel")
+        # Удаляем текущее сообщение с кнопками, чтобы не было конфликта
+        await update.callback_query.delete_message()
+        await self.admin.admin_panel(update, context)
+
+    async def _route_leaderboard(self, update, context, callback_data: str, role: str) -> None:
+        """Кнопки таблицы лидеров"""
+        logger.debug(f"Перенаправление на show_leaderboard")
+
+        # Определяем период для лидерборда
+        if callback_data == "common_leaderboard":
+            period = "week"
+        else:
+            period = callback_data.replace("common_leaderboard_", "")
+
+        # Устанавливаем период в качестве аргумента
+        context.args = [period]
+        await self.show_leaderboard(update, context, period)
+
+    async def _route_back_to_main(self, update, context, callback_data: str, role: str) -> None:
+        """Возврат к главному меню"""
+        logger.debug(f"Возврат к главному меню")
+        query = update.callback_query
+
+        # Роль уже получена в _process_button - повторный запрос не нужен
+        # Отображаем соответствующее главное меню
+        if role == "student":
+            reply_markup = student_main_keyboard()
+        elif role == "parent":
+            reply_markup = parent_main_keyboard()
+        elif role == "admin":
+            reply_markup = admin_main_keyboard()
+        else:
+            # По умолчанию, если роль неизвестна
+            reply_markup = student_main_keyboard()
+
+        # Отображаем главное меню
+        await query.edit_message_text(
+            "Выберите действие:",
+            reply_markup=reply_markup
+        )
+
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик текстовых сообщений, которые не являются командами"""
+        # Сообщения обрабатываются в той же очереди чата, что и кнопки
+        chat_queue.submit(update.effective_chat.id, self._process_message(update, context), update, context)
+
+    async def _process_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработка текстового сообщения (выполняется в очереди чата)"""
         user_id = update.effective_user.id
-        message_text = update.message.text
+        message = update.message
+        user_data = context.user_data
+        message_text = message.text
         logger.debug(f"Получено сообщение от пользователя {user_id}: {message_text[:20]}...")
 
         # Получаем роль пользователя
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == user_id).first()
-            if not user:
-                await update.message.reply_text(
-                    "Кажется, вы еще не зарегистрированы. Пожалуйста, используйте команду /start"
-                )
-                return
-
-            user_role = user.role
+        user_role = await run_db(self._get_user_role, user_id)
+        if user_role is None:
+            await message.reply_text(
+                "Кажется, вы еще не зарегистрированы. Пожалуйста, используйте команду /start"
+            )
+            return
 
         # Проверяем наличие состояния пользователя
         user_state = None
-        if "admin_state" in context.user_data:
+        if "admin_state" in user_data:
             user_state = "admin"
-            state_value = context.user_data["admin_state"]
-        elif "student_state" in context.user_data:
+            state_value = user_data["admin_state"]
+        elif "student_state" in user_data:
             user_state = "student"
-            state_value = context.user_data["student_state"]
-        elif "parent_state" in context.user_data:
+            state_value = user_data["student_state"]
+        elif "parent_state" in user_data:
             user_state = "parent"
-            state_value = context.user_data["parent_state"]
+            state_value = user_data["parent_state"]
 
         logger.debug(f"Состояние пользователя {user_id}: {user_state}, значение: {state_value if user_state else None}")
 
         # Перенаправляем ввод в зависимости от состояния
         if user_state == "admin":
             if user_role != "admin":
-                await update.message.reply_text("У вас нет прав администратора для выполнения этого действия.")
-                context.user_data.pop("admin_state", None)
+                await message.reply_text("У вас нет прав администратора для выполнения этого действия.")
+                user_data.pop("admin_state", None)
                 return
 
-            from handlers.admin import AdminHandler
-            admin_handler = AdminHandler()
-            logger.debug(f"Перенаправление ввода администратора в состоянии {context.user_data['admin_state']}")
-            await admin_handler.handle_admin_input(update, context)
+            logger.debug(f"Перенаправление ввода администратора в состоянии {state_value}")
+            await self.admin.handle_admin_input(update, context)
         elif user_state == "student":
             # Обработка состояний ученика
-            logger.debug(f"Обрабатываем ввод ученика в состоянии {context.user_data['student_state']}")
+            logger.debug(f"Обрабатываем ввод ученика в состоянии {state_value}")
             # Добавить обработчик для состояний ученика, если есть
-            await update.message.reply_text(
+            await message.reply_text(
                 "Функционал в разработке. Пожалуйста, используйте кнопки для взаимодействия."
             )
         elif user_state == "parent":
             # Обработка состояний родителя
-            logger.debug(f"Обрабатываем ввод родителя в состоянии {context.user_data['parent_state']}")
+            logger.debug(f"Обрабатываем ввод родителя в состоянии {state_value}")
             # Добавить обработчик для состояний родителя, если есть
-            await update.message.reply_text(
+            await message.reply_text(
                 "Функционал в разработке. Пожалуйста, используйте кнопки для взаимодействия."
             )
         else:
             # Стандартный ответ, если нет активного состояния
             # Можно показать подсказку в зависимости от роли пользователя
             if user_role == "admin":
-                await update.message.reply_text(
+                await message.reply_text(
                     "Я не понимаю ваше сообщение. Используйте команду /admin для доступа к панели администратора."
                 )
             elif user_role == "student":
-                await update.message.reply_text(
+                await message.reply_text(
                     "Я не понимаю ваше сообщение. Используйте команду /test для начала тестирования или кнопки меню."
                 )
             elif user_role == "parent":
-                await update.message.reply_text(
+                await message.reply_text(
                     "Я не понимаю ваше сообщение. Используйте команду /link для привязки аккаунта ученика или кнопки меню."
                 )
             else:
-                await update.message.reply_text(
+                await message.reply_text(
                     "Я не понимаю ваше сообщение. Пожалуйста, используйте команды или кнопки для взаимодействия."
                     "\n\nДля получения справки введите /help"
                 )
 
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик ошибок для логирования и информирования пользователя"""
-        logger.error(f"Exception while handling an update: {context.error}")
-
-        # Логируем трассировку ошибки
-        tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-        tb_string = "".join(tb_list)
-        logger.error(f"Exception traceback: {tb_string}")
+        # Трассировка форматируется логгером только если запись действительно будет выведена
+        logger.error("Exception while handling an update: %s", context.error, exc_info=context.error)
 
         # Отправляем сообщение пользователю
         if update and hasattr(update, "effective_chat"):
-            # Разные типы ошибок - разные сообщения
-            if isinstance(context.error, telegram.error.BadRequest):
-                message = "Произошла ошибка при отправке сообщения. Пожалуйста, попробуйте еще раз."
-            elif isinstance(context.error, telegram.error.Unauthorized):
-                message = "Бот не имеет доступа. Возможно, вы его заблокировали?"
-            elif isinstance(context.error, telegram.error.TimedOut):
-                message = "Истекло время ожидания ответа от серверов Telegram. Пожалуйста, попробуйте снова."
-            else:
-                message = "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз или обратитесь к администратору."
+            # Разные типы ошибок - разные сообщения: сначала точный тип, затем базовые классы
+            error = context.error
+            message = _ERROR_MESSAGES.get(type(error))
+            if message is None:
+                message = next(
+                    (msg for cls, msg in _ERROR_MESSAGES.items() if isinstance(error, cls)),
+                    _DEFAULT_ERROR_MESSAGE
+                )
 
             try:
                 await context.bot.send_message(
@@ -511,63 +580,62 @@ class CommonHandler:
         try:
             # Получаем период, если указан
             period = context.args[0] if context.args else "week"
-            if period not in ["week", "month", "year", "all"]:
+            if period not in _PERIOD_NAMES:
                 period = "week"
+            period_name = self.get_period_name(period)
+
+            # Таблица лидеров кэшируется на короткое время; кэш сбрасывается,
+            # как только сохраняется новый результат теста
+            version = self.quiz_service.results_version
+            cached = self._leaderboard_cache.get(period)
+            if cached and cached[1] == version and time.monotonic() - cached[0] < _LEADERBOARD_TTL:
+                message, has_data = cached[2], cached[3]
+            else:
+                # Получаем таблицу лидеров
+                leaderboard_result = await run_db(generate_leaderboard, period, limit=10)
+                logger.debug(f"Получены данные таблицы лидеров: {leaderboard_result}")
+
+                if not leaderboard_result["success"]:
+                    error_message = f"Ошибка получения таблицы лидеров: {leaderboard_result['message']}"
+                    if query:
+                        await query.edit_message_text(error_message)
+                    else:
+                        await update.message.reply_text(error_message)
+                    return
 
-            # Получаем таблицу лидеров
-            from services.stats_service import generate_leaderboard
-            leaderboard_result = generate_leaderboard(period, limit=10)
-            logger.debug(f"Получены данные таблицы лидеров: {leaderboard_result}")
-
-            if not leaderboard_result["success"]:
-                error_message = f"Ошибка получения таблицы лидеров: {leaderboard_result['message']}"
-                if query:
-                    await query.edit_message_text(error_message)
-                else:
-                    await update.message.reply_text(error_message)
-                return
-
-            if not leaderboard_result.get("has_data", False):
-                # Используем готовую клавиатуру
-                from keyboards.student_kb import leaderboard_period_keyboard
-                reply_markup = leaderboard_period_keyboard()
-
-                message = f"За выбранный период ({self.get_period_name(period)}) нет данных для составления таблицы лидеров."
-                if query:
-                    await query.edit_message_text(message, reply_markup=reply_markup)
+                has_data = leaderboard_result.get("has_data", False)
+                if not has_data:
+                    message = f"За выбранный период ({period_name}) нет данных для составления таблицы лидеров."
                 else:
-                    await update.message.reply_text(message, reply_markup=reply_markup)
-                return
-
-            # Формируем сообщение с таблицей лидеров
-            message = f"🏆 *Таблица лидеров за {self.get_period_name(period)}*\n\n"
-
-            for i, user_data in enumerate(leaderboard_result["leaderboard"], 1):
-                name = user_data.get("full_name") or user_data.get("username") or f"Ученик {user_data.get('id')}"
-                score = user_data.get("avg_score", 0)
-                tests = user_data.get("tests_count", 0)
+                    # Формируем сообщение с таблицей лидеров одной склейкой строк
+                    rows = [f"🏆 *Таблица лидеров за {period_name}*", ""]
+                    rows.extend(
+                        f"{i}. {self._leader_name(user_data)} - {user_data.get('avg_score', 0):.2f} баллов "
+                        f"({user_data.get('tests_count', 0)} тестов)"
+                        for i, user_data in enumerate(leaderboard_result["leaderboard"], 1)
+                    )
+                    message = "\n".join(rows)
 
-                message += f"{i}. {name} - {score:.2f} баллов ({tests} тестов)\n"
+                self._leaderboard_cache[period] = (time.monotonic(), version, message, has_data)
 
             # Используем готовую клавиатуру
-            from keyboards.student_kb import leaderboard_period_keyboard
             reply_markup = leaderboard_period_keyboard()
+            parse_mode = "Markdown" if has_data else None
 
             if query:
                 await query.edit_message_text(
                     message,
                     reply_markup=reply_markup,
-                    parse_mode="Markdown"
+                    parse_mode=parse_mode
                 )
             else:
                 await update.message.reply_text(
                     message,
                     reply_markup=reply_markup,
-                    parse_mode="Markdown"
+                    parse_mode=parse_mode
                 )
         except Exception as e:
-            logger.error(f"Ошибка в show_leaderboard: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Ошибка в show_leaderboard: %s", e)
 
             error_message = "Произошла ошибка при отображении таблицы лидеров."
             if query:
@@ -578,15 +646,11 @@ class CommonHandler:
             else:
                 await update.message.reply_text(error_message)
 
+    @staticmethod
+    def _leader_name(user_data: dict) -> str:
+        """Отображаемое имя участника таблицы лидеров"""
+        return user_data.get("full_name") or user_data.get("username") or f"Ученик {user_data.get('id')}"
+
     def get_period_name(self, period: str) -> str:
         """Получение названия периода на русском языке"""
-        if period == "week":
-            return "неделю"
-        elif period == "month":
-            return "месяц"
-        elif period == "year":
-            return "год"
-        elif period == "all":
-            return "всё время"
-        else:
-            return "неизвестный период"
+        return _PERIOD_NAMES.get(period, "неизвестный период")
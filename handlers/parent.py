@@ -1,43 +1,115 @@
+import asyncio
 import logging
 import json
-import traceback
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update
 from telegram.ext import ContextTypes
 
-from database.models import User
-from database.db_manager import get_session
+from database.db_manager import get_user_cached, run_db
 from keyboards.parent_kb import (
     parent_main_keyboard, parent_students_keyboard,
-    parent_report_period_keyboard, parent_settings_keyboard
+    parent_report_period_keyboard, parent_settings_keyboard, REPORT_PERIODS_BY_CODE
 )
 from services.parent_service import ParentService
+from utils.chat_queue import chat_queue
+from utils.file_id_cache import send_photo_cached
+from utils.formatters import get_period_name, format_minutes
+from utils.send_queue import message_key, send_queue
 
 logger = logging.getLogger(__name__)
 
+# Максимальная длина подписи к фото в Telegram
+_CAPTION_LIMIT = 1024
+
+# Неизменяемые тексты ответов
+NOT_PARENT_COMMAND = (
+    "Эта команда доступна только для родителей. "
+    "Пожалуйста, обратитесь к администратору для изменения роли."
+)
+NOT_PARENT_FEATURE = (
+    "Эта функция доступна только для родителей. "
+    "Пожалуйста, обратитесь к администратору для изменения роли."
+)
+NOT_REGISTERED = "Кажется, вы еще не зарегистрированы. Пожалуйста, используйте команду /start"
+LINK_INSTRUCTIONS = (
+    "Для привязки аккаунта ученика используйте команду /link с кодом ученика.\n\n"
+    "Пример: /link 123456\n\n"
+    "Код можно получить у ученика, который должен выполнить команду /mycode"
+)
+NO_STUDENTS = "У вас нет привязанных учеников. Используйте команду /link с кодом ученика для привязки."
+STUDENT_NOT_FOUND = "Указанный ученик не найден среди привязанных к вашему аккаунту."
+CHOOSE_STUDENT_REPORT = "Выберите ученика для просмотра отчета:"
+CHOOSE_STUDENT_SETTINGS = "Выберите ученика для настройки уведомлений:"
+
+
+def _students_by_id(students) -> dict:
+    """Индекс привязанных учеников по id"""
+    return {student["id"]: student for student in students}
+
+
+def _student_name(student: dict) -> str:
+    """Отображаемое имя ученика"""
+    return student["full_name"] or student["username"] or f"Ученик {student['id']}"
+
+
+def _edit_message(query, *args, **kwargs):
+    """
+    Правка сообщения с кнопкой через общую очередь отправки
+
+    Все правки одного сообщения идут под одним ключом объединения, поэтому применяются
+    по порядку. Возвращается future запроса: ожидая его, обработчик получает ошибку
+    отправки и может сообщить о ней пользователю.
+    """
+    return send_queue.submit(query.edit_message_text(*args, **kwargs), key=message_key(query))
+
+
 class ParentHandler:
     def __init__(self, parent_service: ParentService):
         self.parent_service = parent_service
 
+        # Таблица маршрутизации кнопок: действие из parent_<действие>_... -> обработчик
+        self._button_routes = {
+            "student": self._on_student,
+            "report": self._on_report,
+            "back": self._on_back,
+            "settings": self._on_settings,
+            "toggle": self._on_toggle,
+            "threshold": self._on_threshold,
+        }
+
+    async def _get_role(self, user_id: int):
+        """Роль пользователя из общего кэша пользователей (None, если пользователь не найден)"""
+        # Запросы к БД выполняются в пуле потоков, чтобы не блокировать другие чаты
+        user = await run_db(get_user_cached, user_id)
+        return user["role"] if user else None
+
+    async def _get_linked_students(self, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> dict:
+        """Список привязанных учеников, запрашиваемый не более одного раза за обработку обновления"""
+        cache = context.user_data.setdefault("_students_cache", {})
+        if user_id not in cache:
+            cache[user_id] = await run_db(self.parent_service.get_linked_students, user_id)
+        return cache[user_id]
+
+    async def _get_parent_context(self, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> dict:
+        """Настройки родителя и список учеников за один запрос; список попадает в кэш нажатия"""
+        result = await run_db(self.parent_service.get_parent_context, user_id)
+        if result["success"]:
+            context.user_data.setdefault("_students_cache", {})[user_id] = {
+                "success": True, "students": result["students"]
+            }
+        return result
+
     async def check_parent_role(self, update: Update) -> bool:
         """Проверка, является ли пользователь родителем"""
         user_id = update.effective_user.id
 
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == user_id).first()
-            if not user or user.role != "parent":
-                # Проверяем, откуда был вызов
-                if update.callback_query:
-                    await update.callback_query.edit_message_text(
-                        "Эта команда доступна только для родителей. "
-                        "Пожалуйста, обратитесь к администратору для изменения роли."
-                    )
-                elif update.message:
-                    await update.message.reply_text(
-                        "Эта команда доступна только для родителей. "
-                        "Пожалуйста, обратитесь к администратору для изменения роли."
-                    )
-                return False
+        if await self._get_role(user_id) != "parent":
+            # Проверяем, откуда был вызов
+            if update.callback_query:
+                await _edit_message(update.callback_query, NOT_PARENT_COMMAND)
+            elif update.message:
+                await update.message.reply_text(NOT_PARENT_COMMAND)
+            return False
         return True
 
     async def link_student(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -46,20 +118,14 @@ class ParentHandler:
 
         # Проверяем, является ли пользователь родителем
         try:
-            with get_session() as session:
-                user = session.query(User).filter(User.telegram_id == user_id).first()
-                if not user:
-                    await update.message.reply_text(
-                        "Кажется, вы еще не зарегистрированы. Пожалуйста, используйте команду /start"
-                    )
-                    return
+            role = await self._get_role(user_id)
+            if role is None:
+                await update.message.reply_text(NOT_REGISTERED)
+                return
 
-                if user.role != "parent":
-                    await update.message.reply_text(
-                        "Эта команда доступна только для родителей. "
-                        "Пожалуйста, обратитесь к администратору для изменения роли."
-                    )
-                    return
+            if role != "parent":
+                await update.message.reply_text(NOT_PARENT_COMMAND)
+                return
         except Exception as e:
             logger.error(f"Error checking parent role: {e}")
             await update.message.reply_text(
@@ -69,17 +135,13 @@ class ParentHandler:
 
         # Проверяем, есть ли у команды аргумент с кодом ученика
         if not context.args:
-            await update.message.reply_text(
-                "Для привязки аккаунта ученика используйте команду /link с кодом ученика.\n\n"
-                "Пример: /link 123456\n\n"
-                "Код можно получить у ученика, который должен выполнить команду /mycode"
-            )
+            await update.message.reply_text(LINK_INSTRUCTIONS)
             return
 
         student_code = context.args[0]
 
         # Привязываем ученика
-        result = self.parent_service.link_student(user_id, student_code)
+        result = await run_db(self.parent_service.link_student, user_id, student_code)
 
         if result["success"]:
             await update.message.reply_text(
@@ -94,6 +156,7 @@ class ParentHandler:
 
     async def get_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /report для получения отчета об успеваемости ученика"""
+        context.user_data.pop("_students_cache", None)
 
         # Определяем, вызвана ли функция из сообщения или из callback_query
         if update.callback_query:
@@ -108,12 +171,12 @@ class ParentHandler:
             query = None
 
         # Получаем список привязанных учеников
-        students_result = self.parent_service.get_linked_students(user_id)
+        students_result = await self._get_linked_students(context, user_id)
 
         if not students_result["success"]:
             message_text = f"Ошибка: {students_result['message']}"
             if query:
-                await query.edit_message_text(message_text)
+                await _edit_message(query, message_text)
             else:
                 await update.message.reply_text(message_text)
             return
@@ -121,9 +184,9 @@ class ParentHandler:
         students = students_result["students"]
 
         if not students:
-            message_text = "У вас нет привязанных учеников. Используйте команду /link с кодом ученика для привязки."
+            message_text = NO_STUDENTS
             if query:
-                await query.edit_message_text(message_text)
+                await _edit_message(query, message_text)
             else:
                 await update.message.reply_text(message_text)
             return
@@ -137,16 +200,10 @@ class ParentHandler:
                     period = "week"
 
                 # Проверяем, есть ли такой ученик среди привязанных
-                student_found = False
-                for student in students:
-                    if student["id"] == student_id:
-                        student_found = True
-                        break
-
-                if not student_found:
-                    message_text = "Указанный ученик не найден среди привязанных к вашему аккаунту."
+                if student_id not in _students_by_id(students):
+                    message_text = STUDENT_NOT_FOUND
                     if query:
-                        await query.edit_message_text(message_text)
+                        await _edit_message(query, message_text)
                     else:
                         await update.message.reply_text(message_text)
                     return
@@ -162,14 +219,15 @@ class ParentHandler:
         # Показываем меню выбора ученика
         reply_markup = parent_students_keyboard(students)
 
-        message_text = "Выберите ученика для просмотра отчета:"
+        message_text = CHOOSE_STUDENT_REPORT
         if query:
-            await query.edit_message_text(message_text, reply_markup=reply_markup)
+            await _edit_message(query, message_text, reply_markup=reply_markup)
         else:
             await update.message.reply_text(message_text, reply_markup=reply_markup)
 
     async def settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /settings для настройки уведомлений и прочих параметров"""
+        context.user_data.pop("_students_cache", None)
 
         # Определяем, вызвана ли функция из сообщения или из callback_query
         if update.callback_query:
@@ -183,34 +241,23 @@ class ParentHandler:
             user_id = update.effective_user.id
             query = None
 
-        # Получаем текущие настройки
-        settings_result = self.parent_service.get_parent_settings(user_id)
-
-        if not settings_result["success"]:
-            message_text = f"Ошибка получения настроек: {settings_result['message']}"
-            if query:
-                await query.edit_message_text(message_text)
-            else:
-                await update.message.reply_text(message_text)
-            return
-
-        # Получаем список привязанных учеников
-        students_result = self.parent_service.get_linked_students(user_id)
+        # Получаем текущие настройки и список привязанных учеников одним обращением к базе
+        parent_context = await self._get_parent_context(context, user_id)
 
-        if not students_result["success"]:
-            message_text = f"Ошибка: {students_result['message']}"
+        if not parent_context["success"]:
+            message_text = f"Ошибка получения настроек: {parent_context['message']}"
             if query:
-                await query.edit_message_text(message_text)
+                await _edit_message(query, message_text)
             else:
                 await update.message.reply_text(message_text)
             return
 
-        students = students_result["students"]
+        students = parent_context["students"]
 
         if not students:
-            message_text = "У вас нет привязанных учеников. Используйте команду /link с кодом ученика для привязки."
+            message_text = NO_STUDENTS
             if query:
-                await query.edit_message_text(message_text)
+                await _edit_message(query, message_text)
             else:
                 await update.message.reply_text(message_text)
             return
@@ -221,24 +268,19 @@ class ParentHandler:
                 student_id = int(context.args[0])
 
                 # Проверяем, есть ли такой ученик среди привязанных
-                student_found = False
-                student_name = ""
-                for student in students:
-                    if student["id"] == student_id:
-                        student_found = True
-                        student_name = student["full_name"] or student["username"] or f"Ученик {student['id']}"
-                        break
-
-                if not student_found:
-                    message_text = "Указанный ученик не найден среди привязанных к вашему аккаунту."
+                student = _students_by_id(students).get(student_id)
+
+                if student is None:
+                    message_text = STUDENT_NOT_FOUND
                     if query:
-                        await query.edit_message_text(message_text)
+                        await _edit_message(query, message_text)
                     else:
                         await update.message.reply_text(message_text)
                     return
 
                 # Показываем настройки для ученика
-                await self.show_student_settings(update, context, student_id, student_name, query=query)
+                await self.show_student_settings(update, context, student_id, _student_name(student),
+                                                 settings=parent_context["settings"], query=query)
                 return
 
             except (ValueError, IndexError):
@@ -248,9 +290,9 @@ class ParentHandler:
         # Показываем меню выбора ученика
         reply_markup = parent_students_keyboard(students)
 
-        message_text = "Выберите ученика для настройки уведомлений:"
+        message_text = CHOOSE_STUDENT_SETTINGS
         if query:
-            await query.edit_message_text(message_text, reply_markup=reply_markup)
+            await _edit_message(query, message_text, reply_markup=reply_markup)
         else:
             await update.message.reply_text(message_text, reply_markup=reply_markup)
 
@@ -264,201 +306,147 @@ class ParentHandler:
 
         await query.answer()
 
-        # Проверяем роль пользователя
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == user_id).first()
-            if not user or user.role != "parent":
-                await query.edit_message_text(
-                    "Эта функция доступна только для родителей. "
-                    "Пожалуйста, обратитесь к администратору для изменения роли."
-                )
-                return
+        # Долгие операции (например, построение графика отчета) не задерживают других чатов.
+        # Очередь общая с остальными обработчиками чата, поэтому работа с context.user_data
+        # (кэш учеников) не пересекается с командами /report и /settings
+        chat_queue.submit(update.effective_chat.id, self._process_button(update, context), update, context)
 
-        try:
-            if query.data.startswith("parent_student_"):
-                # Выбор ученика для отчета
-                student_id = int(query.data.replace("parent_student_", ""))
+    async def _process_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработка нажатия кнопки родителя (выполняется в очереди пользователя)"""
+        query = update.callback_query
+        callback_data = query.data
+        user_id = update.effective_user.id
 
-                # Показываем меню выбора периода
-                reply_markup = parent_report_period_keyboard(student_id)
+        # Список учеников кэшируется только в пределах одного нажатия
+        context.user_data.pop("_students_cache", None)
 
-                await query.edit_message_text(
-                    "Выберите период для отчета:",
-                    reply_markup=reply_markup
-                )
-
-            elif query.data.startswith("parent_report_"):
-                # Показ отчета об успеваемости
-                parts = query.data.split("_")
-                student_id = int(parts[2])
-                period = parts[3]
+        # Проверяем роль пользователя (повторные нажатия обслуживаются из кэша)
+        if await self._get_role(user_id) != "parent":
+            await _edit_message(query, NOT_PARENT_FEATURE)
+            return
 
-                # Генерируем и показываем отчет
-                await self.show_student_report(update, context, student_id, period)
+        try:
+            # callback_data имеет вид parent_<действие>_<аргументы>: разбираем один раз
+            # и выбираем обработчик по действию
+            _, action, args = (callback_data.split("_", 2) + [""])[:3]
+            route = self._button_routes.get(action)
+            if route is not None:
+                await route(update, context, user_id, args)
+            else:
+                logger.warning(f"Неизвестный callback_data: {callback_data}")
 
-            elif query.data == "parent_back_main":
-                # Возврат в главное меню
-                reply_markup = parent_main_keyboard()
-                await query.edit_message_text(
-                    "Выберите действие:",
-                    reply_markup=reply_markup
+        except Exception as e:
+            logger.exception("Error in handle_parent_button for user %s cb=%s", user_id, callback_data)
+            try:
+                await _edit_message(query,
+                    "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте еще раз."
                 )
+            except Exception:
+                pass
 
-            elif query.data.startswith("parent_settings_"):
-                # Настройки для ученика
-                student_id = int(query.data.replace("parent_settings_", ""))
-
-                # Получаем информацию об ученике
-                students_result = self.parent_service.get_linked_students(user_id)
-                if not students_result["success"]:
-                    await query.edit_message_text(f"Ошибка: {students_result['message']}")
-                    return
-
-                students = students_result["students"]
-                student_name = ""
-                for student in students:
-                    if student["id"] == student_id:
-                        student_name = student["full_name"] or student["username"] or f"Ученик {student['id']}"
-                        break
-
-                # Показываем настройки для ученика
-                await self.show_student_settings(update, context, student_id, student_name, query=query)
-
-            elif query.data.startswith("parent_toggle_"):
-                # Переключение настроек уведомлений
-                parts = query.data.split("_")
-                setting_type = parts[2]
-                student_id = int(parts[3])
-
-                # Получаем текущие настройки
-                settings_result = self.parent_service.get_parent_settings(user_id)
-
-                if not settings_result["success"]:
-                    await query.edit_message_text(f"Ошибка получения настроек: {settings_result['message']}")
-                    return
-
-                settings = settings_result["settings"]
+    async def _on_student(self, update, context, user_id: int, args: str) -> None:
+        """Выбор ученика для отчета: parent_student_<id ученика>"""
+        student_id = int(args)
 
-                # Убеждаемся, что структура настроек существует
-                if "student_notifications" not in settings:
-                    settings["student_notifications"] = {}
+        # Показываем меню выбора периода
+        reply_markup = parent_report_period_keyboard(student_id)
 
-                if str(student_id) not in settings["student_notifications"]:
-                    settings["student_notifications"][str(student_id)] = {}
+        await _edit_message(update.callback_query,
+            "Выберите период для отчета:",
+            reply_markup=reply_markup
+        )
 
-                student_settings = settings["student_notifications"][str(student_id)]
+    async def _on_report(self, update, context, user_id: int, args: str) -> None:
+        """Показ отчета об успеваемости: parent_report_<id ученика>_<код периода>"""
+        student_id, period = args.split("_", 1)
+        # Полные названия периодов принимаются для кнопок в ранее отправленных сообщениях
+        period = REPORT_PERIODS_BY_CODE.get(period, period)
 
-                # Переключаем настройку
-                current_value = student_settings.get(setting_type, False)
-                student_settings[setting_type] = not current_value
+        # Генерируем и показываем отчет
+        await self.show_student_report(update, context, int(student_id), period)
 
-                # Сохраняем настройки
-                result = self.parent_service.setup_notifications(user_id, student_id, student_settings)
+    async def _on_back(self, update, context, user_id: int, args: str) -> None:
+        """Возврат в главное меню (parent_back_main) или к списку учеников (parent_back_students)"""
+        query = update.callback_query
 
-                if not result["success"]:
-                    await query.edit_message_text(f"Ошибка сохранения настроек: {result['message']}")
-                    return
+        if args == "main":
+            reply_markup = parent_main_keyboard()
+            await _edit_message(query,
+                "Выберите действие:",
+                reply_markup=reply_markup
+            )
 
-                # Получаем имя ученика
-                students_result = self.parent_service.get_linked_students(user_id)
-                student_name = ""
-                if students_result["success"]:
-                    for student in students_result["students"]:
-                        if student["id"] == student_id:
-                            student_name = student["full_name"] or student["username"] or f"Ученик {student['id']}"
-                            break
-
-                # Показываем обновленные настройки
-                await self.show_student_settings(update, context, student_id, student_name, query=query)
-
-            elif query.data.startswith("parent_threshold_"):
-                # Изменение порогового значения
-                parts = query.data.split("_")
-                threshold_type = parts[2]
-                student_id = int(parts[3])
-                action = parts[4]  # up или down
-
-                # Получаем текущие настройки
-                settings_result = self.parent_service.get_parent_settings(user_id)
-
-                if not settings_result["success"]:
-                    await query.edit_message_text(f"Ошибка получения настроек: {settings_result['message']}")
-                    return
+        elif args == "students":
+            students_result = await self._get_linked_students(context, user_id)
 
-                settings = settings_result["settings"]
+            if not students_result["success"]:
+                await _edit_message(query, f"Ошибка: {students_result['message']}")
+                return
 
-                # Убеждаемся, что структура настроек существует
-                if "student_notifications" not in settings:
-                    settings["student_notifications"] = {}
+            # Используем готовую клавиатуру
+            reply_markup = parent_students_keyboard(students_result["students"])
 
-                if str(student_id) not in settings["student_notifications"]:
-                    settings["student_notifications"][str(student_id)] = {}
+            await _edit_message(query,
+                CHOOSE_STUDENT_REPORT,
+                reply_markup=reply_markup
+            )
 
-                student_settings = settings["student_notifications"][str(student_id)]
+    async def _on_settings(self, update, context, user_id: int, args: str) -> None:
+        """Настройки для ученика: parent_settings_<id ученика>"""
+        query = update.callback_query
+        student_id = int(args)
 
-                # Устанавливаем значения по умолчанию
-                if threshold_type == "low_score_threshold" and threshold_type not in student_settings:
-                    student_settings[threshold_type] = 60
-                elif threshold_type == "high_score_threshold" and threshold_type not in student_settings:
-                    student_settings[threshold_type] = 90
+        # Получаем информацию об ученике и настройки одним обращением к базе
+        parent_context = await self._get_parent_context(context, user_id)
+        if not parent_context["success"]:
+            await _edit_message(query, f"Ошибка: {parent_context['message']}")
+            return
 
-                # Изменяем пороговое значение
-                current_value = student_settings.get(threshold_type,
-                                                    60 if threshold_type == "low_score_threshold" else 90)
+        student = _students_by_id(parent_context["students"]).get(student_id)
+        student_name = _student_name(student) if student else ""
 
-                if action == "up":
-                    new_value = min(current_value + 5, 100)
-                else:  # down
-                    new_value = max(current_value - 5, 0)
+        # Показываем настройки для ученика
+        await self.show_student_settings(update, context, student_id, student_name,
+                                         settings=parent_context["settings"], query=query)
 
-                student_settings[threshold_type] = new_value
+    async def _on_toggle(self, update, context, user_id: int, args: str) -> None:
+        """Переключение настроек уведомлений: parent_toggle_<тип настройки>_<id ученика>"""
+        setting_type, student_id = args.rsplit("_", 1)
+        student_id = int(student_id)
 
-                # Сохраняем настройки
-                result = self.parent_service.setup_notifications(user_id, student_id, student_settings)
+        # Чтение, изменение и сохранение настроек - одним обращением к сервису
+        result = await run_db(self.parent_service.toggle_notification, user_id, student_id, setting_type)
+        await self._show_updated_settings(update, context, user_id, student_id, result)
 
-                if not result["success"]:
-                    await query.edit_message_text(f"Ошибка сохранения настроек: {result['message']}")
-                    return
+    async def _on_threshold(self, update, context, user_id: int, args: str) -> None:
+        """Изменение порогового значения: parent_threshold_<тип порога>_<id ученика>_<up|down|none>"""
+        threshold_type, student_id, action = args.rsplit("_", 2)
+        student_id = int(student_id)
 
-                # Получаем имя ученика
-                students_result = self.parent_service.get_linked_students(user_id)
-                student_name = ""
-                if students_result["success"]:
-                    for student in students_result["students"]:
-                        if student["id"] == student_id:
-                            student_name = student["full_name"] or student["username"] or f"Ученик {student['id']}"
-                            break
-
-                # Показываем обновленные настройки
-                await self.show_student_settings(update, context, student_id, student_name, query=query)
+        # Кнопка с текущим значением порога ничего не меняет
+        if action not in ("up", "down"):
+            return
 
-            elif query.data == "parent_back_students":
-                # Возврат к списку учеников
-                students_result = self.parent_service.get_linked_students(user_id)
+        # Чтение, изменение и сохранение настроек - одним обращением к сервису
+        result = await run_db(self.parent_service.adjust_threshold, user_id, student_id, threshold_type, action)
+        await self._show_updated_settings(update, context, user_id, student_id, result)
 
-                if not students_result["success"]:
-                    await query.edit_message_text(f"Ошибка: {students_result['message']}")
-                    return
+    async def _show_updated_settings(self, update, context, user_id: int, student_id: int, result: dict) -> None:
+        """Показ настроек ученика после их изменения"""
+        query = update.callback_query
 
-                students = students_result["students"]
+        if not result["success"]:
+            await _edit_message(query, f"Ошибка сохранения настроек: {result['message']}")
+            return
 
-                # Используем готовую клавиатуру
-                reply_markup = parent_students_keyboard(students)
+        # Настройки не изменились (порог уже на границе) - экран остается прежним, а правку
+        # с тем же содержимым Telegram отклонил бы ошибкой "Message is not modified"
+        if not result.get("changed", True):
+            return
 
-                await query.edit_message_text(
-                    "Выберите ученика для просмотра отчета:",
-                    reply_markup=reply_markup
-                )
-
-        except Exception as e:
-            logger.error(f"Error in handle_parent_button: {e}")
-            logger.error(traceback.format_exc())
-            try:
-                await query.edit_message_text(
-                    "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте еще раз."
-                )
-            except Exception:
-                pass
+        # Имя ученика и настройки уже получены сервисом - повторно к базе не обращаемся
+        await self.show_student_settings(update, context, student_id, result["student_name"],
+                                         settings=result["settings"], query=query)
 
     async def show_student_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE, student_id: int, period: str) -> None:
         """Показ отчета об успеваемости ученика"""
@@ -466,32 +454,21 @@ class ParentHandler:
         query = update.callback_query
 
         # Генерируем отчет
-        report_result = self.parent_service.generate_student_report(user_id, student_id, period)
+        report_result = await run_db(self.parent_service.generate_student_report, user_id, student_id, period)
 
         if not report_result["success"]:
             if query:
-                await query.edit_message_text(f"Ошибка: {report_result['message']}")
+                await _edit_message(query, f"Ошибка: {report_result['message']}")
             else:
                 await update.message.reply_text(f"Ошибка: {report_result['message']}")
             return
 
         if not report_result["has_data"]:
-            # Кнопки для выбора другого периода и возврата
-            keyboard = [
-                [
-                    InlineKeyboardButton("За неделю", callback_data=f"parent_report_{student_id}_week"),
-                    InlineKeyboardButton("За месяц", callback_data=f"parent_report_{student_id}_month")
-                ],
-                [
-                    InlineKeyboardButton("За год", callback_data=f"parent_report_{student_id}_year"),
-                    InlineKeyboardButton("Назад к списку учеников", callback_data="parent_back_students")
-                ]
-            ]
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Кнопки для выбора другого периода и возврата (одна и та же клавиатура для ученика)
+            reply_markup = parent_report_period_keyboard(student_id)
 
             if query:
-                await query.edit_message_text(
+                await _edit_message(query,
                     f"{report_result['message']}\n\nВыберите другой период или вернитесь к списку учеников.",
                     reply_markup=reply_markup
                 )
@@ -504,92 +481,83 @@ class ParentHandler:
 
         # Форматируем отчет
         student_name = report_result["student_name"]
-        period_name = self.get_period_name(period)
+        period_name = get_period_name(period)
         stats = report_result["stats"]
 
-        report_text = f"📊 *Отчет об успеваемости ученика {student_name}*\n"
-        report_text += f"*Период:* {period_name}\n\n"
+        best = stats['best_result']
+        worst = stats['worst_result']
+        topics = stats['topics_studied']
+
+        # Текст отчета собирается одним шаблоном, список тем - одной склейкой
+        report_text = (
+            f"📊 *Отчет об успеваемости ученика {student_name}*\n"
+            f"*Период:* {period_name}\n\n"
+            f"*Общие данные:*\n"
+            f"• Пройдено тестов: {stats['total_tests']}\n"
+            f"• Средний результат: {stats['average_score']}%\n"
+            f"• Лучший результат: {best['score']}% ({best['topic']}, {best['date']})\n"
+            f"• Худший результат: {worst['score']}% ({worst['topic']}, {worst['date']})\n"
+            f"• Общее время: {format_minutes(stats['total_time_spent'])}\n\n"
+            f"*Изученные темы ({len(topics)}):\n*"
+            + "".join(f"• {topic}\n" for topic in topics)
+        )
 
-        report_text += f"*Общие данные:*\n"
-        report_text += f"• Пройдено тестов: {stats['total_tests']}\n"
-        report_text += f"• Средний результат: {stats['average_score']}%\n"
-        report_text += f"• Лучший результат: {stats['best_result']['score']}% "
-        report_text += f"({stats['best_result']['topic']}, {stats['best_result']['date']})\n"
-        report_text += f"• Худший результат: {stats['worst_result']['score']}% "
-        report_text += f"({stats['worst_result']['topic']}, {stats['worst_result']['date']})\n"
-        report_text += f"• Общее время: {self.format_time(stats['total_time_spent'])}\n\n"
+        # Кнопки для выбора другого периода и возврата
+        reply_markup = parent_report_period_keyboard(student_id)
 
-        report_text += f"*Изученные темы ({len(stats['topics_studied'])}):\n*"
-        for topic in stats['topics_studied']:
-            report_text += f"• {topic}\n"
+        chart = report_result.get("chart")
+        chart_caption = f"📈 Динамика успеваемости ученика {student_name} {period_name}"
 
-        # Кнопки для выбора другого периода и возврата
-        keyboard = [
-            [
-                InlineKeyboardButton("За неделю", callback_data=f"parent_report_{student_id}_week"),
-                InlineKeyboardButton("За месяц", callback_data=f"parent_report_{student_id}_month")
-            ],
-            [
-                InlineKeyboardButton("За год", callback_data=f"parent_report_{student_id}_year"),
-                InlineKeyboardButton("Назад к списку учеников", callback_data="parent_back_students")
-            ]
-        ]
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        # Отправляем отчет
+        # Отправляем отчет и график
         if query:
-            await query.edit_message_text(
+            # Редактируется существующее сообщение, а график приходит новым, поэтому
+            # порядок запросов не важен - выполняем их одновременно
+            requests = [_edit_message(query,
                 report_text,
                 reply_markup=reply_markup,
                 parse_mode="Markdown"
+            )]
+            if chart:
+                requests.append(send_photo_cached(context.bot.send_photo, chart, chat_id=user_id, caption=chart_caption))
+        elif chart and len(report_text) <= _CAPTION_LIMIT:
+            # Отчет помещается в подпись - отправляем его вместе с графиком одним запросом
+            await send_photo_cached(
+                update.message.reply_photo,
+                chart,
+                caption=report_text,
+                reply_markup=reply_markup,
+                parse_mode="Markdown"
             )
+            return
         else:
-            await update.message.reply_text(
+            # Длинный отчет и график - два независимых сообщения, отправляем их одновременно
+            requests = [update.message.reply_text(
                 report_text,
                 reply_markup=reply_markup,
                 parse_mode="Markdown"
-            )
-
-        # Отправляем график
-        if "chart" in report_result:
-            if query:
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=report_result["chart"],
-                    caption=f"📈 Динамика успеваемости ученика {student_name} {period_name}"
-                )
-            else:
-                await update.message.reply_photo(
-                    photo=report_result["chart"],
-                    caption=f"📈 Динамика успеваемости ученика {student_name} {period_name}"
-                )
+            )]
+            if chart:
+                requests.append(send_photo_cached(update.message.reply_photo, chart, caption=chart_caption))
+
+        # Ошибка отправки графика не отменяет отчет; ошибка самого отчета уходит вызывающему
+        message_result, *chart_results = await asyncio.gather(*requests, return_exceptions=True)
+        for chart_result in chart_results:
+            if isinstance(chart_result, Exception):
+                logger.error(f"Ошибка при отправке графика отчета: {chart_result}")
+        if isinstance(message_result, Exception):
+            raise message_result
 
     async def show_student_settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE, student_id: int, student_name: str,
-                                query=None) -> None:
-        """Показ и редактирование настроек для ученика"""
-        user_id = update.effective_user.id
-
-        # Получаем текущие настройки
-        settings_result = self.parent_service.get_parent_settings(user_id)
-
-        if not settings_result["success"]:
-            if query:
-                await query.edit_message_text(f"Ошибка получения настроек: {settings_result['message']}")
-            else:
-                await update.message.reply_text(f"Ошибка получения настроек: {settings_result['message']}")
-            return
-
-        settings = settings_result["settings"]
+                                settings: dict, query=None) -> None:
+        """Показ и редактирование настроек для ученика
 
+        settings - настройки родителя, уже полученные вызывающим кодом
+        """
         # Получаем настройки для конкретного ученика
-        if "student_notifications" not in settings:
-            settings["student_notifications"] = {}
-
-        if str(student_id) not in settings["student_notifications"]:
-            settings["student_notifications"][str(student_id)] = {}
-
-        student_settings = settings["student_notifications"][str(student_id)]
+        student_notifications = settings.get("student_notifications")
+        if not isinstance(student_notifications, dict):
+            student_notifications = {}
+        student_settings = student_notifications.get(str(student_id), {})
 
         # Значения по умолчанию
         weekly_reports = student_settings.get("weekly_reports", False)
@@ -616,7 +584,7 @@ class ParentHandler:
 
         # Отправляем или обновляем сообщение
         if query:
-            await query.edit_message_text(
+            await _edit_message(query,
                 settings_text,
                 reply_markup=reply_markup,
                 parse_mode="Markdown"
@@ -627,23 +595,3 @@ class ParentHandler:
                 reply_markup=reply_markup,
                 parse_mode="Markdown"
             )
-
-    def get_period_name(self, period: str) -> str:
-        """Получение читаемого названия периода"""
-        periods = {
-            "week": "за неделю",
-            "month": "за месяц",
-            "year": "за год",
-            "all": "за всё время"
-        }
-        return periods.get(period, "за всё время")
-
-    def format_time(self, minutes: int) -> str:
-        """Форматирование времени из минут в часы и минуты"""
-        hours = minutes // 60
-        mins = minutes % 60
-
-        if hours > 0:
-            return f"{hours} ч {mins} мин"
-        else:
-            return f"{mins} мин"
\ No newline at end of file
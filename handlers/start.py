@@ -12,6 +12,59 @@ from keyboards.admin_kb import admin_main_keyboard
 
 logger = logging.getLogger(__name__)
 
+# Тексты справки по ролям пользователей
+_HELP_TEXTS = {
+    "student": (
+        "🔍 *Справка для ученика*\n\n"
+        "*Основные команды:*\n"
+        "• /start - Начать работу с ботом\n"
+        "• /help - Показать эту справку\n"
+        "• /test - Начать тестирование\n"
+        "• /stats - Показать вашу статистику\n"
+        "• /achievements - Показать ваши достижения\n"
+        "• /mycode - Получить код для привязки родителя\n\n"
+        "*Как проходить тесты:*\n"
+        "1. Выберите тему с помощью команды /test\n"
+        "2. Отвечайте на вопросы, выбирая варианты ответов\n"
+        "3. После завершения теста вы получите результаты и объяснения\n\n"
+        "*Система достижений:*\n"
+        "Получайте баллы и достижения за правильные ответы и регулярное прохождение тестов!"
+    ),
+    "parent": (
+        "🔍 *Справка для родителя*\n\n"
+        "*Основные команды:*\n"
+        "• /start - Начать работу с ботом\n"
+        "• /help - Показать эту справку\n"
+        "• /link - Привязать аккаунт ученика (требуется код)\n"
+        "• /report - Получить отчет об успеваемости ученика\n"
+        "• /settings - Настроить уведомления\n\n"
+        "*Как привязать аккаунт ученика:*\n"
+        "1. Попросите ученика выполнить команду /mycode\n"
+        "2. Используйте команду /link с полученным кодом (например, /link 123456)\n"
+        "3. После успешной привязки вы сможете получать отчеты и настраивать уведомления\n\n"
+        "*Система уведомлений:*\n"
+        "Настройте получение уведомлений о завершении тестов и еженедельных отчетов"
+    ),
+    "admin": (
+        "🔍 *Справка для администратора*\n\n"
+        "*Основные команды:*\n"
+        "• /start - Начать работу с ботом\n"
+        "• /help - Показать эту справку\n"
+        "• /admin - Открыть панель администратора\n"
+        "• /add_question - Добавить новый вопрос\n"
+        "• /import - Импортировать вопросы из JSON файла\n\n"
+        "*Панель администратора позволяет:*\n"
+        "• Управлять темами и вопросами\n"
+        "• Просматривать статистику пользователей\n"
+        "• Настраивать параметры бота\n\n"
+        "*Структура JSON для импорта вопросов:*\n"
+        "Используйте команду /import для получения информации о формате файла"
+    ),
+}
+
+_DEFAULT_HELP_TEXT = "Пожалуйста, используйте команду /start для начала работы с ботом"
+
+
 class StartHandler:
     def __init__(self):
         pass
@@ -99,59 +152,7 @@ class StartHandler:
 
     def get_help_text(self, role: str) -> str:
         """Возвращает текст справки в зависимости от роли пользователя"""
-        if role == "student":
-            return (
-                "🔍 *Справка для ученика*\n\n"
-                "*Основные команды:*\n"
-                "• /start - Начать работу с ботом\n"
-                "• /help - Показать эту справку\n"
-                "• /test - Начать тестирование\n"
-                "• /stats - Показать вашу статистику\n"
-                "• /achievements - Показать ваши достижения\n"
-                "• /mycode - Получить код для привязки родителя\n\n"
-                "*Как проходить тесты:*\n"
-                "1. Выберите тему с помощью команды /test\n"
-                "2. Отвечайте на вопросы, выбирая варианты ответов\n"
-                "3. После завершения теста вы получите результаты и объяснения\n\n"
-                "*Система достижений:*\n"
-                "Получайте баллы и достижения за правильные ответы и регулярное прохождение тестов!"
-            )
-        elif role == "parent":
-            return (
-                "🔍 *Справка для родителя*\n\n"
-                "*Основные команды:*\n"
-                "• /start - Начать работу с ботом\n"
-                "• /help - Показать эту справку\n"
-                "• /link - Привязать аккаунт ученика (требуется код)\n"
-                "• /report - Получить отчет об успеваемости ученика\n"
-                "• /settings - Настроить уведомления\n\n"
-                "*Как привязать аккаунт ученика:*\n"
-                "1. Попросите ученика выполнить команду /mycode\n"
-                "2. Используйте команду /link с полученным кодом (например, /link 123456)\n"
-                "3. После успешной привязки вы сможете получать отчеты и настраивать уведомления\n\n"
-                "*Система уведомлений:*\n"
-                "Настройте получение уведомлений о завершении тестов и еженедельных отчетов"
-            )
-        elif role == "admin":
-            return (
-                "🔍 *Справка для администратора*\n\n"
-                "*Основные команды:*\n"
-                "• /start - Начать работу с ботом\n"
-                "• /help - Показать эту справку\n"
-                "• /admin - Открыть панель администратора\n"
-                "• /add_question - Добавить новый вопрос\n"
-                "• /import - Импортировать вопросы из JSON файла\n\n"
-                "*Панель администратора позволяет:*\n"
-                "• Управлять темами и вопросами\n"
-                "• Просматривать статистику пользователей\n"
-                "• Настраивать параметры бота\n\n"
-                "*Структура JSON для импорта вопросов:*\n"
-                "Используйте команду /import для получения информации о формате файла"
-            )
-        else:
-            return (
-                "Пожалуйста, используйте команду /start для начала работы с ботом"
-            )
+        return _HELP_TEXTS.get(role, _DEFAULT_HELP_TEXT)
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /help для получения справки"""
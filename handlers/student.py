@@ -1,15 +1,25 @@
+import asyncio
 import logging
-import traceback
+import random
+import re
 from datetime import datetime
+from typing import Optional
 
+from cachetools import TTLCache
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from io import BytesIO
+from sqlalchemy import func
 
-from services.quiz_service import QuizService
+from services.quiz_service import QuizService, QUESTION_TYPE_HINTS
 from services.stats_service import get_user_stats
+from services.settings_service import get_quiz_settings
 from database.models import User, TestResult, Topic, Achievement
-from database.db_manager import get_session
+from database.db_manager import get_session, run_db
+from utils.file_id_cache import send_photo_cached, send_photo_file_cached
+from utils.image_utils import get_image_path
+from utils.formatters import format_date, format_datetime, format_minutes, get_period_name
+from utils.send_queue import message_key, send_queue
 from keyboards.student_kb import (
     student_main_keyboard, topic_selection_keyboard, single_question_keyboard,
     multiple_question_keyboard, sequence_question_keyboard, test_results_keyboard,
@@ -18,9 +28,69 @@ from keyboards.student_kb import (
 
 logger = logging.getLogger(__name__)
 
+# Разбор callback_data кнопок теста: ключ маршрута и до двух аргументов
+# (quiz_answer_<question_id>_<option>, quiz_confirm_start_<topic_id>, quiz_skip и т.п.)
+_QUIZ_CALLBACK_RE = re.compile(
+    r"(student_recommendations|quiz_confirm_start|quiz_[a-z]+)(?:_([^_]+))?(?:_([^_]+))?"
+)
+
+# Время жизни кэша готовых рекомендаций (в секундах)
+_RECOMMENDATIONS_TTL = 60
+
+# Неизменяемые части сообщения с рекомендациями
+_RECOMMENDATIONS_HEADER = "🔍 *Персональные рекомендации*\n\n"
+_NO_WEAK_TOPICS = "👍 *Отлично!* У вас нет тем с низкими результатами.\n\n"
+_GENERAL_TIPS = (
+    "*Общие советы:*\n"
+    "• Занимайтесь регулярно, хотя бы 3-4 раза в неделю\n"
+    "• Проходите тесты несколько раз для лучшего запоминания\n"
+    "• Используйте детальный анализ для изучения своих ошибок\n"
+)
+# Те же советы с дополнительным пунктом для ученика со слабыми темами
+_GENERAL_TIPS_WITH_WEAK_TOPICS = (
+    "*Общие советы:*\n"
+    "• Занимайтесь регулярно, хотя бы 3-4 раза в неделю\n"
+    "• Уделяйте особое внимание темам с низкими результатами\n"
+    "• Проходите тесты несколько раз для лучшего запоминания\n"
+    "• Используйте детальный анализ для изучения своих ошибок\n"
+)
+_NO_DATA_RECOMMENDATIONS = (
+    "📊 *Рекомендации*\n\n"
+    "У вас пока недостаточно данных для формирования персональных рекомендаций.\n\n"
+    "Общие советы:\n"
+    "• Старайтесь проходить тесты регулярно, 2-3 раза в неделю\n"
+    "• Начинайте с тем, которые вам интересны\n"
+    "• Для лучшего запоминания, возвращайтесь к пройденным темам\n"
+    "• Обращайте внимание на объяснения к вопросам\n\n"
+    "Пройдите больше тестов, чтобы получить персональные рекомендации!"
+)
+# Постоянные строки клавиатуры рекомендаций (кнопки неизменяемы, их можно переиспользовать)
+_RECOMMENDATIONS_ACTION_ROW = (
+    InlineKeyboardButton("📊 Статистика", callback_data="common_stats"),
+    InlineKeyboardButton("📝 Начать тест", callback_data="common_start_test"),
+)
+_RECOMMENDATIONS_BACK_ROW = (
+    InlineKeyboardButton("🔙 Назад к меню", callback_data="common_back_to_main"),
+)
+
 class StudentHandler:
     def __init__(self, quiz_service: QuizService):
         self.quiz_service = quiz_service
+        # Обработчики кнопок теста по префиксу callback_data
+        self._button_routes = {
+            "student_recommendations": self._on_recommendations,
+            "quiz_start": self._on_start,
+            "quiz_confirm_start": self._on_begin_quiz,
+            "quiz_repeat": self._on_begin_quiz,
+            "quiz_details": self._on_details,
+            "quiz_answer": self._on_answer,
+            "quiz_seq": self._on_sequence,
+            "quiz_reset": self._on_reset,
+            "quiz_confirm": self._on_confirm,
+            "quiz_skip": self._on_skip,
+        }
+        # Готовые рекомендации по пользователю: (версия результатов, текст, клавиатура)
+        self._recommendations_cache = TTLCache(maxsize=1024, ttl=_RECOMMENDATIONS_TTL)
 
     async def start_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /test для начала тестирования"""
@@ -28,8 +98,8 @@ class StudentHandler:
             user_id = update.effective_user.id
             logger.info(f"Запуск теста для пользователя {user_id}")
 
-            # Получаем список доступных тем
-            topics = self.quiz_service.get_topics()
+            # Получаем список доступных тем (при промахе кэша - в пуле потоков)
+            topics = await self.quiz_service.get_topics_async()
 
             if not topics:
                 # Проверяем, откуда был вызов - из сообщения или кнопки
@@ -58,9 +128,8 @@ class StudentHandler:
                     reply_markup=reply_markup
                 )
 
-        except Exception as e:
-            logger.error(f"Error in start_test: {e}")
-            logger.error(traceback.format_exc())
+        except Exception:
+            logger.exception("Error in start_test")
 
             error_message = "Произошла ошибка при запуске теста. Пожалуйста, попробуйте еще раз позже."
 
@@ -80,181 +149,153 @@ class StudentHandler:
         callback_data = query.data
         user_id = update.effective_user.id
 
-        logger.debug(f"Processing button {callback_data} from user {user_id}")
-
-        await query.answer()
+        logger.debug("Processing button %s from user %s", callback_data, user_id)
 
+        # Обработчик может вернуть текст уведомления для ответа на нажатие
+        notice = None
         try:
-            if query.data == "student_recommendations":
-                try:
-                    logger.info(f"Обработка кнопки student_recommendations в StudentHandler: user_id={user_id}")
-                    await self.show_recommendations(update, context)
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке кнопки student_recommendations: {e}")
-                    logger.error(traceback.format_exc())
-                    await query.edit_message_text(
-                        "Произошла ошибка при формировании рекомендаций. Пожалуйста, попробуйте позже."
-                    )
-
-            elif query.data.startswith("quiz_start_"):
-                # Начало теста по выбранной теме
-                topic_id_str = query.data.replace("quiz_start_", "")
-                # Обрабатываем случайную тему
-                if topic_id_str == "random":
-                    import random
-                    topics = self.quiz_service.get_topics()
-                    if not topics:
-                        await query.edit_message_text("К сожалению, доступных тем нет.")
+            # Маршрут и аргументы извлекаются одним заранее скомпилированным выражением
+            match = _QUIZ_CALLBACK_RE.fullmatch(callback_data)
+            handler = self._button_routes.get(match.group(1)) if match else None
 
-                        return
-                    topic = random.choice(topics)
-                    topic_id = topic["id"]
-
-                else:
-                    topic_id = int(topic_id_str)
-                # Вместо немедленного начала теста, показываем предупреждение
-                await self.start_test_with_topic(update, context, topic_id)
-
-            elif query.data.startswith("quiz_confirm_start_"):
-                # Подтверждение начала теста
-                topic_id = int(query.data.replace("quiz_confirm_start_", ""))
-                # Начинаем тест
-                quiz_data = self.quiz_service.start_quiz(user_id, topic_id)
-                if not quiz_data["success"]:
-                    await query.edit_message_text(quiz_data["message"])
-
-                    return
-                # Показываем первый вопрос
-                await self.show_question(update, context)
-
-            elif query.data == "quiz_details":
-                # Показ детального отчета о результатах последнего теста
-                await self.show_detailed_results(update, context)
-
-            elif query.data.startswith("quiz_repeat_"):
-                # Повторное прохождение теста
-                topic_id = int(query.data.replace("quiz_repeat_", ""))
-                # Начинаем тест
-                quiz_data = self.quiz_service.start_quiz(user_id, topic_id)
-                if not quiz_data["success"]:
-                    await query.edit_message_text(quiz_data["message"])
-                    return
-                # Показываем первый вопрос
-                await self.show_question(update, context)
-
-            elif query.data.startswith("quiz_answer_"):
-                # Обработка ответа на вопрос
-                parts = query.data.split("_")
-                question_id = int(parts[2])
-                option_index = int(parts[3])
-
-                current_question = self.quiz_service.get_current_question(user_id)
-
-                if current_question and current_question["id"] == question_id:
-                    if current_question["question_type"] == "single":
-                        # Для вопроса с одиночным выбором сразу отправляем ответ
-                        result = self.quiz_service.submit_answer(user_id, question_id, option_index)
-
-                        if result["success"]:
-                            if result["is_completed"]:
-                                # Тест завершен
-                                await self.show_test_results(update, context, result["result"])
-                            else:
-                                # Показываем следующий вопрос
-                                await self.show_question(update, context)
-                        else:
-                            await query.edit_message_text(result["message"])
-
-                    elif current_question["question_type"] == "multiple":
-                        # Для вопроса с множественным выбором обновляем выбранные варианты
-                        selected_options = self.quiz_service.active_quizzes[user_id]["answers"].get(str(question_id), [])
-
-                        if option_index in selected_options:
-                            selected_options.remove(option_index)
-                        else:
-                            selected_options.append(option_index)
-
-                        self.quiz_service.active_quizzes[user_id]["answers"][str(question_id)] = selected_options
-
-                        # Обновляем вопрос с отмеченными вариантами
-                        await self.show_question(update, context, edit=True)
-
-            elif query.data.startswith("quiz_seq_"):
-                # Обработка выбора для вопроса с последовательностью
-                parts = query.data.split("_")
-                question_id = int(parts[2])
-                option_index = int(parts[3])
-                current_question = self.quiz_service.get_current_question(user_id)
-                if current_question and current_question["id"] == question_id:
-                    # Проверяем, что этот вариант еще не выбран
-                    sequence = self.quiz_service.active_quizzes[user_id]["answers"].get(str(question_id), [])
-                    if str(option_index) not in sequence:
-                        # Добавляем вариант к последовательности
-                        sequence.append(str(option_index))
-                        self.quiz_service.active_quizzes[user_id]["answers"][str(question_id)] = sequence
-                        # Обновляем вопрос с текущей последовательностью
-                        await self.show_question(update, context, edit=True)
-                    else:
-                        # Если вариант уже выбран, показываем уведомление
-                        await query.answer("Этот вариант уже выбран в последовательности")
-
-            elif query.data.startswith("quiz_reset_"):
-                # Сброс текущей последовательности
-                parts = query.data.split("_")
-                question_id = int(parts[2])
-
-                current_question = self.quiz_service.get_current_question(user_id)
-
-                if current_question and current_question["id"] == question_id:
-                    # Сбрасываем последовательность
-                    self.quiz_service.active_quizzes[user_id]["answers"][str(question_id)] = []
-
-                    # Обновляем вопрос
-                    await self.show_question(update, context, edit=True)
-
-            elif query.data.startswith("quiz_confirm_"):
-                # Подтверждение ответа для вопроса с множественным выбором или последовательностью
-                parts = query.data.split("_")
-                question_id = int(parts[2])
-
-                current_question = self.quiz_service.get_current_question(user_id)
-
-                if current_question and current_question["id"] == question_id:
-                    answer = self.quiz_service.active_quizzes[user_id]["answers"].get(str(question_id), [])
-
-                    # Отправляем ответ
-                    result = self.quiz_service.submit_answer(user_id, question_id, answer)
-
-                    if result["success"]:
-                        if result["is_completed"]:
-                            # Тест завершен
-                            await self.show_test_results(update, context, result["result"])
-                        else:
-                            # Показываем следующий вопрос
-                            await self.show_question(update, context)
-                    else:
-                        await query.edit_message_text(result["message"])
-
-            elif query.data == "quiz_skip":
-                # Пропуск текущего вопроса
-                result = self.quiz_service.skip_question(user_id)
-
-                if result["success"]:
-                    if result["is_completed"]:
-                        # Тест завершен
-                        await self.show_test_results(update, context, result["result"])
-                    else:
-                        # Показываем следующий вопрос
-                        await self.show_question(update, context)
-                else:
-                    await query.edit_message_text(result["message"])
+            if handler is not None:
+                notice = await handler(update, context, user_id, match.groups()[1:])
+            else:
+                logger.warning(f"Неизвестная кнопка теста: {callback_data}")
 
         except Exception as e:
             logger.error(f"Error in handle_test_button: {e}")
-            await query.edit_message_text(
-                "Произошла ошибка при обработке вашего ответа. Пожалуйста, попробуйте еще раз."
+            await self._queue_edit(
+                query,
+                text="Произошла ошибка при обработке вашего ответа. Пожалуйста, попробуйте еще раз."
+            )
+        finally:
+            # Ровно один ответ на нажатие - после обработки и вместе с уведомлением, если оно
+            # есть (раньше кнопка последовательности отвечала повторно, и Telegram отклонял ответ).
+            # Правки переключателей ставятся в очередь, поэтому ответ не задерживается
+            try:
+                await query.answer(notice)
+            except Exception as e:
+                logger.debug("Не удалось ответить на нажатие кнопки: %s", e)
+
+    async def _on_recommendations(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                                  args: tuple) -> None:
+        """Кнопка рекомендаций ученика"""
+        try:
+            logger.info(f"Обработка кнопки student_recommendations в StudentHandler: user_id={user_id}")
+            await self.show_recommendations(update, context)
+        except Exception:
+            logger.exception("Ошибка при обработке кнопки student_recommendations")
+            await update.callback_query.edit_message_text(
+                "Произошла ошибка при формировании рекомендаций. Пожалуйста, попробуйте позже."
             )
 
+    async def _on_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, args: tuple) -> None:
+        """Начало теста по выбранной теме (или по случайной теме)"""
+        if args[0] == "random":
+            topics = await self.quiz_service.get_topics_async()
+            if not topics:
+                await update.callback_query.edit_message_text("К сожалению, доступных тем нет.")
+                return
+            topic_id = random.choice(topics)["id"]
+        else:
+            topic_id = int(args[0])
+        # Вместо немедленного начала теста, показываем предупреждение
+        await self.start_test_with_topic(update, context, topic_id)
+
+    async def _on_begin_quiz(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                             args: tuple) -> None:
+        """Подтверждение начала теста или повторное прохождение"""
+        topic_id = int(args[0])
+        quiz_data = await run_db(self.quiz_service.start_quiz, user_id, topic_id)
+        if not quiz_data["success"]:
+            await update.callback_query.edit_message_text(quiz_data["message"])
+            return
+        # Показываем первый вопрос
+        await self.show_question(update, context)
+
+    async def _on_details(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                          args: tuple) -> None:
+        """Детальный отчет о результатах последнего теста"""
+        await self.show_detailed_results(update, context)
+
+    async def _on_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, args: tuple) -> None:
+        """Ответ на вопрос с одиночным или множественным выбором"""
+        question_id = int(args[0])
+        option_index = int(args[1])
+
+        current_question = self.quiz_service.get_current_question(user_id)
+        if not current_question or current_question["id"] != question_id:
+            return
+
+        if current_question["question_type"] == "single":
+            # Для вопроса с одиночным выбором сразу отправляем ответ
+            result = self.quiz_service.submit_answer(user_id, question_id, option_index)
+            await self._after_submit(update, context, result)
+
+        elif current_question["question_type"] == "multiple":
+            # Для вопроса с множественным выбором обновляем выбранные варианты
+            self.quiz_service.toggle_option(user_id, question_id, option_index)
+
+            # Обновляем вопрос с отмеченными вариантами
+            await self.show_question(update, context, edit=True)
+
+    async def _on_sequence(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                           args: tuple) -> Optional[str]:
+        """Выбор очередного варианта в вопросе с последовательностью"""
+        question_id = int(args[0])
+        option_index = int(args[1])
+
+        current_question = self.quiz_service.get_current_question(user_id)
+        if not current_question or current_question["id"] != question_id:
+            return
+
+        # Добавляем вариант к последовательности, если он еще не выбран
+        if self.quiz_service.add_to_sequence(user_id, question_id, option_index):
+            # Обновляем вопрос с текущей последовательностью
+            await self.show_question(update, context, edit=True)
+        else:
+            # Если вариант уже выбран, показываем уведомление в ответе на нажатие
+            return "Этот вариант уже выбран в последовательности"
+        return None
+
+    async def _on_reset(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, args: tuple) -> None:
+        """Сброс текущей последовательности"""
+        question_id = int(args[0])
+
+        current_question = self.quiz_service.get_current_question(user_id)
+        if current_question and current_question["id"] == question_id:
+            self.quiz_service.reset_sequence(user_id, question_id)
+            await self.show_question(update, context, edit=True)
+
+    async def _on_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                          args: tuple) -> None:
+        """Подтверждение ответа для вопроса с множественным выбором или последовательностью"""
+        question_id = int(args[0])
+
+        current_question = self.quiz_service.get_current_question(user_id)
+        if current_question and current_question["id"] == question_id:
+            answer = self.quiz_service.get_pending_answer(
+                user_id, question_id, current_question["question_type"])
+            result = self.quiz_service.submit_answer(user_id, question_id, answer)
+            await self._after_submit(update, context, result)
+
+    async def _on_skip(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, args: tuple) -> None:
+        """Пропуск текущего вопроса"""
+        result = self.quiz_service.skip_question(user_id)
+        await self._after_submit(update, context, result)
+
+    async def _after_submit(self, update: Update, context: ContextTypes.DEFAULT_TYPE, result: dict) -> None:
+        """Показ следующего вопроса или результатов после ответа"""
+        if not result["success"]:
+            await update.callback_query.edit_message_text(result["message"])
+        elif result["is_completed"]:
+            # Тест завершен
+            await self.show_test_results(update, context, result["result"])
+        else:
+            # Показываем следующий вопрос
+            await self.show_question(update, context)
+
     async def show_question(self, update: Update, context: ContextTypes.DEFAULT_TYPE, edit: bool = False) -> None:
         """Отображение текущего вопроса"""
         query = update.callback_query
@@ -269,13 +310,15 @@ class StudentHandler:
             await self.show_test_results(update, context, result)
             return
 
+        # Состояние теста получаем один раз и дальше работаем с локальными ссылками
+        quiz_data = self.quiz_service.active_quizzes[user_id]
+
         # Форматируем вопрос
-        question_num = self.quiz_service.active_quizzes[user_id]["current_question"] + 1
-        total_questions = len(self.quiz_service.active_quizzes[user_id]["questions"])
+        question_num = quiz_data["current_question"] + 1
+        total_questions = len(quiz_data["questions"])
 
         # Вычисляем оставшееся время
         remaining_time = "Неизвестно"
-        quiz_data = self.quiz_service.active_quizzes[user_id]
         if "end_time" in quiz_data:
             time_left = quiz_data["end_time"] - datetime.now()
             if time_left.total_seconds() > 0:
@@ -293,65 +336,74 @@ class StudentHandler:
         if question_type == "single":
             reply_markup = single_question_keyboard(question_id, options)
         elif question_type == "multiple":
-            selected_options = self.quiz_service.active_quizzes[user_id]["answers"].get(str(question_id), [])
+            selected_options = quiz_data.get("selected", {}).get(question_id, set())
             reply_markup = multiple_question_keyboard(question_id, options, selected_options)
         elif question_type == "sequence":
-            current_sequence = self.quiz_service.active_quizzes[user_id]["answers"].get(str(question_id), [])
+            current_sequence = quiz_data.get("sequences", {}).get(question_id, [])
             reply_markup = sequence_question_keyboard(question_id, options, current_sequence)
         else:
             # Fallback
             reply_markup = single_question_keyboard(question_id, options)
 
+        # Заголовок и текст с подсказкой по типу вопроса готовятся в start_quiz;
+        # для тестов, восстановленных из старых файлов состояния, собираем их здесь
+        title = current_question.get("title") or f"*Вопрос {question_num}/{total_questions}*"
+        body = current_question.get("body") or (
+            f"\n\n{current_question['text']}{QUESTION_TYPE_HINTS.get(question_type, '')}"
+        )
+
         # Форматируем текст вопроса с указанием оставшегося времени
-        question_text = f"*Вопрос {question_num}/{total_questions}* | ⏱️ *{remaining_time}*\n\n{current_question['text']}"
+        question_text = f"{title} | ⏱️ *{remaining_time}*{body}"
 
-        # Добавляем информацию о типе вопроса
-        if question_type == "multiple":
-            question_text += "\n\n_Выберите все правильные варианты ответов_"
-        elif question_type == "sequence":
-            question_text += "\n\n_Расположите варианты в правильном порядке_"
-            # Если уже есть выбранная последовательность, отображаем её
-            if current_sequence:
-                sequence_text = "\n".join(
-                    [f"{i + 1}. {options[int(opt)]}" for i, opt in enumerate(current_sequence)]
-                )
-                question_text += f"\n\nТекущая последовательность:\n{sequence_text}"
+        # Если уже есть выбранная последовательность, отображаем её
+        if question_type == "sequence" and current_sequence:
+            sequence_text = "\n".join(
+                f"{i + 1}. {options[int(opt)]}" for i, opt in enumerate(current_sequence)
+            )
+            question_text += f"\n\nТекущая последовательность:\n{sequence_text}"
 
         # Определяем медиа-файл, если есть
         media_file = None
         if current_question.get("media_url"):
             try:
-                from utils.image_utils import get_image_path
                 media_file = get_image_path(current_question["media_url"])
             except Exception as e:
                 logger.error(f"Error getting media file: {e}")
                 media_file = None
 
+        # Отпечаток показанного содержимого: текст и кнопки (подпись и callback_data)
+        render_hash = hash((
+            question_text,
+            tuple((button.text, button.callback_data) for row in reply_markup.inline_keyboard for button in row)
+        ))
+        last_render_hash = quiz_data.get("last_render_hash")
+        # Отпечаток запоминается сразу, чтобы повторные нажатия до отправки правки тоже
+        # пропускались; если отправка не удалась, он сбрасывается (_forget_render)
+        quiz_data["last_render_hash"] = render_hash
+
         # Отправляем или обновляем сообщение с вопросом
         if edit and query:
-            await query.edit_message_text(
-                text=question_text,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
+            # Повторное нажатие, не изменившее вопрос, не отправляем: Telegram все равно
+            # отклонит правку с тем же содержимым
+            if render_hash != last_render_hash:
+                self._queue_render(query, quiz_data, render_hash,
+                                   text=question_text, reply_markup=reply_markup, parse_mode="Markdown")
+        elif query and not media_file:
+            self._queue_render(query, quiz_data, render_hash,
+                               text=question_text, reply_markup=reply_markup, parse_mode="Markdown")
         else:
-            # Если есть медиа-файл, отправляем его
-            if media_file:
-                with open(media_file, 'rb') as photo:
-                    await context.bot.send_photo(
+            try:
+                # Если есть медиа-файл, отправляем его
+                if media_file:
+                    # После первой загрузки файл отправляется по file_id без чтения с диска
+                    await send_photo_file_cached(
+                        context.bot.send_photo,
+                        media_file,
                         chat_id=user_id,
-                        photo=photo,
                         caption=question_text,
                         reply_markup=reply_markup,
                         parse_mode="Markdown"
                     )
-            else:
-                if query:
-                    await query.edit_message_text(
-                        text=question_text,
-                        reply_markup=reply_markup,
-                        parse_mode="Markdown"
-                    )
                 else:
                     await context.bot.send_message(
                         chat_id=user_id,
@@ -359,6 +411,9 @@ class StudentHandler:
                         reply_markup=reply_markup,
                         parse_mode="Markdown"
                     )
+            except Exception:
+                self._forget_render(quiz_data, render_hash)
+                raise
 
     async def show_test_results(self, update: Update, context: ContextTypes.DEFAULT_TYPE, result: dict) -> None:
         """Отображение результатов теста"""
@@ -383,35 +438,67 @@ class StudentHandler:
         else:
             time_str = "Не определено"
 
-        result_text = f"📊 *Результаты теста*\n\n"
-        result_text += f"✅ Правильных ответов: {correct_count} из {total_questions}\n"
-        result_text += f"📈 Процент успеха: {percentage}%\n"
-        result_text += f"⏱️ Затраченное время: {time_str}\n\n"
+        # Текст собирается из частей одной склейкой
+        parts = [
+            "📊 *Результаты теста*\n\n",
+            f"✅ Правильных ответов: {correct_count} из {total_questions}\n",
+            f"📈 Процент успеха: {percentage}%\n",
+            f"⏱️ Затраченное время: {time_str}\n\n",
+        ]
 
         # Добавляем эмодзи в зависимости от результата
         if percentage >= 90:
-            result_text += "🏆 Отличный результат! Так держать! 🏆"
+            parts.append("🏆 Отличный результат! Так держать! 🏆")
         elif percentage >= 70:
-            result_text += "👍 Хороший результат! Продолжай в том же духе!"
+            parts.append("👍 Хороший результат! Продолжай в том же духе!")
         elif percentage >= 50:
-            result_text += "💪 Неплохо, но есть куда расти!"
+            parts.append("💪 Неплохо, но есть куда расти!")
         else:
-            result_text += "📚 Стоит повторить материал и попробовать еще раз."
+            parts.append("📚 Стоит повторить материал и попробовать еще раз.")
 
         # Добавляем информацию о новых достижениях
         if "new_achievements" in result and result["new_achievements"]:
-            result_text += "\n\n🏅 *Новые достижения:*\n"
-            for achievement in result["new_achievements"]:
-                result_text += f"• {achievement['name']} - {achievement['description']} (+{achievement['points']} очков)\n"
+            parts.append("\n\n🏅 *Новые достижения:*\n")
+            parts.extend(
+                f"• {achievement['name']} - {achievement['description']} (+{achievement['points']} очков)\n"
+                for achievement in result["new_achievements"]
+            )
+        result_text = "".join(parts)
 
         # Используем готовую клавиатуру
         reply_markup = test_results_keyboard(topic_id)
 
-        await query.edit_message_text(
-            text=result_text,
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
-        )
+        # Ждем отправки: ошибка правки уходит вызывающему и превращается в сообщение пользователю
+        await self._queue_edit(query, text=result_text, reply_markup=reply_markup, parse_mode="Markdown")
+
+    @staticmethod
+    def _queue_edit(query, **kwargs) -> asyncio.Future:
+        """
+        Правка сообщения с кнопкой через общую очередь отправки
+
+        Правки одного сообщения объединяются: если пользователь быстро нажимает кнопки,
+        в Telegram уходит только последняя версия вопроса. Возвращается future запроса.
+        """
+        return send_queue.submit(query.edit_message_text(**kwargs), key=message_key(query))
+
+    def _queue_render(self, query, quiz_data: dict, render_hash: int, **kwargs) -> None:
+        """Правка сообщения с вопросом; если она не удалась, отпечаток показа сбрасывается"""
+        def on_done(future: asyncio.Future) -> None:
+            if future.cancelled() or future.exception() is not None:
+                self._forget_render(quiz_data, render_hash)
+
+        self._queue_edit(query, **kwargs).add_done_callback(on_done)
+
+    @staticmethod
+    def _forget_render(quiz_data: dict, render_hash: int) -> None:
+        """
+        Сброс отпечатка неотправленного показа вопроса
+
+        Иначе следующий такой же показ был бы пропущен, и у пользователя остались бы
+        устаревшие кнопки. Отпечаток более нового показа не трогаем.
+        """
+        if quiz_data.get("last_render_hash") == render_hash:
+            quiz_data.pop("last_render_hash", None)
 
     async def start_test_with_topic(self, update: Update, context: ContextTypes.DEFAULT_TYPE, topic_id: int) -> None:
         """Начать тест по конкретной теме"""
@@ -419,17 +506,17 @@ class StudentHandler:
         try:
             user_id = update.effective_user.id
 
-            # Получаем название темы
-            with get_session() as session:
-                topic = session.query(Topic).get(topic_id)
-                if not topic:
-                    await update.callback_query.edit_message_text("Тема не найдена.")
-                    return
-                topic_name = topic.name
+            # Получаем название темы из кэша тем сервиса
+            # Темы из кэша (при промахе кэша загрузка выполняется в пуле потоков)
+            await self.quiz_service.get_topics_async()
+            topic = self.quiz_service.get_topic(topic_id)
+            if not topic:
+                await update.callback_query.edit_message_text("Тема не найдена.")
+                return
+            topic_name = topic["name"]
 
             # Получаем настройки теста
-            from services.settings_service import get_quiz_settings
-            quiz_settings = get_quiz_settings()
+            quiz_settings = await run_db(get_quiz_settings)
             question_count = quiz_settings["questions_count"]
             time_minutes = quiz_settings["time_minutes"]
 
@@ -471,7 +558,7 @@ class StudentHandler:
         if period not in ["week", "month", "year", "all"]:
             period = "all"
 
-        stats = get_user_stats(user_id, period)
+        stats = await run_db(get_user_stats, user_id, period)
 
         if not stats["success"]:
             error_message = f"Не удалось получить статистику: {stats['message']}"
@@ -500,32 +587,35 @@ class StudentHandler:
                 )
             return
 
-        # Форматируем текст статистики
-        stats_text = f"📊 *Статистика тестирования*\n"
-        stats_text += f"*Период:* {self.get_period_name(period)}\n\n"
-
-        # Общая статистика
+        # Форматируем текст статистики (части собираются одной склейкой)
         stats_data = stats["stats"]
-        stats_text += f"*Общие данные:*\n"
-        stats_text += f"• Пройдено тестов: {stats_data['total_tests']}\n"
-        stats_text += f"• Средний результат: {stats_data['average_score']}%\n"
-        stats_text += f"• Лучший результат: {stats_data['best_result']['score']}% "
-        stats_text += f"({stats_data['best_result']['topic']}, {stats_data['best_result']['date']})\n"
-        stats_text += f"• Общее время: {self.format_time(stats_data['total_time_spent'])}\n"
+        best_result = stats_data['best_result']
+        parts = [
+            "📊 *Статистика тестирования*\n",
+            f"*Период:* {get_period_name(period)}\n\n",
+            # Общая статистика
+            "*Общие данные:*\n",
+            f"• Пройдено тестов: {stats_data['total_tests']}\n",
+            f"• Средний результат: {stats_data['average_score']}%\n",
+            f"• Лучший результат: {best_result['score']}% ({best_result['topic']}, {best_result['date']})\n",
+            f"• Общее время: {format_minutes(stats_data['total_time_spent'])}\n",
+        ]
 
         # Динамика по времени
         if "time_stats" in stats and stats["time_stats"]:
             time_stats = stats["time_stats"]
-            stats_text += f"\n*Динамика за период:*\n"
             progress_sign = "+" if time_stats["progress"] >= 0 else ""
-            stats_text += f"• Изменение результата: {progress_sign}{time_stats['progress']}% "
-            stats_text += f"({progress_sign}{time_stats['progress_percentage']}%)\n"
+            parts.append("\n*Динамика за период:*\n")
+            parts.append(
+                f"• Изменение результата: {progress_sign}{time_stats['progress']}% "
+                f"({progress_sign}{time_stats['progress_percentage']}%)\n"
+            )
 
         # Статистика по темам
         if "tests_by_topic" in stats_data and stats_data["tests_by_topic"]:
-            stats_text += f"\n*Тесты по темам:*\n"
-            for topic, count in stats_data["tests_by_topic"].items():
-                stats_text += f"• {topic}: {count} тестов\n"
+            parts.append("\n*Тесты по темам:*\n")
+            parts.extend(f"• {topic}: {count} тестов\n" for topic, count in stats_data["tests_by_topic"].items())
+        stats_text = "".join(parts)
 
         # Используем готовую клавиатуру
         reply_markup = stats_period_keyboard()
@@ -544,23 +634,53 @@ class StudentHandler:
                 parse_mode="Markdown"
             )
 
-        # Отправляем графики, если они есть
-        if "charts" in stats and stats["charts"]:
-            charts = stats["charts"]
+        # Отправляем графики, если они есть (повторно - по file_id из кэша)
+        if charts := stats.get("charts"):
+            uploads = []
 
             if "progress_chart" in charts:
-                await context.bot.send_photo(
+                uploads.append(send_photo_cached(
+                    context.bot.send_photo,
+                    charts["progress_chart"],
                     chat_id=user_id,
-                    photo=charts["progress_chart"],
                     caption="📈 Динамика результатов по времени"
-                )
+                ))
 
             if "topics_chart" in charts:
-                await context.bot.send_photo(
+                uploads.append(send_photo_cached(
+                    context.bot.send_photo,
+                    charts["topics_chart"],
                     chat_id=user_id,
-                    photo=charts["topics_chart"],
                     caption="📊 Средний результат по темам"
+                ))
+
+            # Графики загружаются одновременно; ошибка одного не отменяет отправку другого
+            for upload_result in await asyncio.gather(*uploads, return_exceptions=True):
+                if isinstance(upload_result, Exception):
+                    logger.error(f"Ошибка при отправке графика статистики: {upload_result}")
+
+    def _fetch_last_test(self, user_id: int):
+        """Последний завершенный тест пользователя с названием темы (выполняется в пуле потоков)"""
+        # Пользователь, его последний завершенный тест и название темы - одним запросом.
+        # Внешние соединения сохраняют строку пользователя без тестов (поля теста - NULL)
+        with get_session() as session:
+            return (
+                session.query(
+                    User.id,
+                    TestResult.id.label("result_id"),
+                    TestResult.completed_at,
+                    TestResult.score,
+                    TestResult.max_score,
+                    TestResult.percentage,
+                    TestResult.time_spent,
+                    Topic.name.label("topic_name")
                 )
+                .outerjoin(TestResult, TestResult.user_id == User.id)
+                .outerjoin(Topic, Topic.id == TestResult.topic_id)
+                .filter(User.telegram_id == user_id)
+                .order_by(TestResult.completed_at.desc())
+                .first()
+            )
 
     async def show_detailed_results(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Показ детального отчета о результатах последнего теста"""
@@ -570,71 +690,58 @@ class StudentHandler:
         logger.info(f"Запрос детальных результатов от пользователя {user_id}")
 
         try:
-            # Получаем последний тест пользователя
-            with get_session() as session:
-                user = session.query(User).filter(User.telegram_id == user_id).first()
-                if not user:
-                    await query.edit_message_text(
-                        "Пользователь не найден. Пожалуйста, используйте /start для регистрации.")
-                    return
-
-                # Получаем последний завершенный тест
-                last_test = session.query(TestResult).filter(
-                    TestResult.user_id == user.id
-                ).order_by(TestResult.completed_at.desc()).first()
-
-                if not last_test:
-                    await query.edit_message_text(
-                        "У вас еще нет завершенных тестов. Используйте команду /test для начала тестирования.")
-                    return
-
-                # Получаем название темы
-                topic_name = "Неизвестная тема"
-                if last_test.topic_id:
-                    topic = session.query(Topic).get(last_test.topic_id)
-                    if topic:
-                        topic_name = topic.name
-
-                # Форматируем время
-                time_str = "Не определено"
-                if last_test.time_spent:
-                    minutes = last_test.time_spent // 60
-                    seconds = last_test.time_spent % 60
-                    time_str = f"{minutes} мин {seconds} сек"
-
-                # Формируем детальный отчет
-                detailed_text = f"📋 *Детальный анализ теста*\n\n"
-                detailed_text += f"*Тема:* {topic_name}\n"
-                detailed_text += f"*Дата:* {last_test.completed_at.strftime('%d.%m.%Y %H:%M')}\n"
-                detailed_text += f"*Результат:* {last_test.score} из {last_test.max_score} ({last_test.percentage}%)\n"
-                detailed_text += f"*Время:* {time_str}\n\n"
-
-                # Если есть данные о вопросах и ответах, можно их тоже показать
-                detailed_text += "*Вопросы и ответы:*\n"
-                detailed_text += "К сожалению, данные о конкретных вопросах и ответах недоступны для этого теста."
-
-                # Кнопки для возврата
-                keyboard = [
-                    [
-                        InlineKeyboardButton("🔙 Вернуться к статистике", callback_data="common_stats"),
-                        InlineKeyboardButton("📝 Пройти еще тест", callback_data="common_start_test")
-                    ]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+            last_test = await run_db(self._fetch_last_test, user_id)
 
-                # Отправляем отчет с использованием edit_message_text
+            if not last_test:
                 await query.edit_message_text(
-                    detailed_text,
-                    reply_markup=reply_markup,
-                    parse_mode="Markdown"
-                )
+                    "Пользователь не найден. Пожалуйста, используйте /start для регистрации.")
+                return
 
-        except Exception as e:
-            logger.error(f"Ошибка при показе детальных результатов: {e}")
-            logger.error(traceback.format_exc())
-            try:
+            if last_test.result_id is None:
                 await query.edit_message_text(
-                    "Произошла ошибка при получении детальных результатов. Пожалуйста, попробуйте позже.",
+                    "У вас еще нет завершенных тестов. Используйте команду /test для начала тестирования.")
+                return
+
+            topic_name = last_test.topic_name or "Неизвестная тема"
+
+            # Форматируем время
+            time_str = "Не определено"
+            if last_test.time_spent:
+                minutes = last_test.time_spent // 60
+                seconds = last_test.time_spent % 60
+                time_str = f"{minutes} мин {seconds} сек"
+
+            # Формируем детальный отчет
+            detailed_text = f"📋 *Детальный анализ теста*\n\n"
+            detailed_text += f"*Тема:* {topic_name}\n"
+            detailed_text += f"*Дата:* {format_datetime(last_test.completed_at)}\n"
+            detailed_text += f"*Результат:* {last_test.score} из {last_test.max_score} ({last_test.percentage}%)\n"
+            detailed_text += f"*Время:* {time_str}\n\n"
+
+            # Если есть данные о вопросах и ответах, можно их тоже показать
+            detailed_text += "*Вопросы и ответы:*\n"
+            detailed_text += "К сожалению, данные о конкретных вопросах и ответах недоступны для этого теста."
+
+            # Кнопки для возврата
+            keyboard = [
+                [
+                    InlineKeyboardButton("🔙 Вернуться к статистике", callback_data="common_stats"),
+                    InlineKeyboardButton("📝 Пройти еще тест", callback_data="common_start_test")
+                ]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+
+            # Отправляем отчет через очередь правок сообщения и ждем результата, чтобы
+            # ошибка отправки попала в обработку ниже
+            await self._queue_edit(query, text=detailed_text, reply_markup=reply_markup, parse_mode="Markdown")
+
+        except Exception:
+            logger.exception("Ошибка при показе детальных результатов")
+            try:
+                # Через ту же очередь, чтобы сообщение об ошибке не обогнало другие правки
+                await self._queue_edit(
+                    query,
+                    text="Произошла ошибка при получении детальных результатов. Пожалуйста, попробуйте позже.",
                     reply_markup=InlineKeyboardMarkup([[
                         InlineKeyboardButton("🔙 Назад", callback_data="common_stats")
                     ]])
@@ -648,7 +755,7 @@ class StudentHandler:
         logger.info(f"Запрос достижений от пользователя {user_id}")
 
         # Получаем статистику с достижениями
-        stats = get_user_stats(user_id)
+        stats = await run_db(get_user_stats, user_id)
 
         if not stats["success"]:
             error_message = f"Не удалось получить информацию о достижениях: {stats['message']}"
@@ -674,14 +781,15 @@ class StudentHandler:
             return
 
         # Форматируем текст с достижениями
-        achievements_text = f"🏆 *Ваши достижения*\n\n"
-        achievements_text += f"*Общее количество баллов:* {total_points}\n\n"
-
-        for achievement in achievements:
-            achievements_text += f"🏅 *{achievement['name']}*\n"
-            achievements_text += f"_{achievement['description']}_\n"
-            achievements_text += f"Получено: {achievement['achieved_at'].strftime('%d.%m.%Y')}\n"
-            achievements_text += f"Баллы: +{achievement['points']}\n\n"
+        parts = ["🏆 *Ваши достижения*\n\n", f"*Общее количество баллов:* {total_points}\n\n"]
+        parts.extend(
+            f"🏅 *{achievement['name']}*\n"
+            f"_{achievement['description']}_\n"
+            f"Получено: {format_date(achievement['achieved_at'])}\n"
+            f"Баллы: +{achievement['points']}\n\n"
+            for achievement in achievements
+        )
+        achievements_text = "".join(parts)
 
         # Используем готовую клавиатуру
         reply_markup = achievements_keyboard()
@@ -700,6 +808,73 @@ class StudentHandler:
                 parse_mode="Markdown"
             )
 
+    def _build_recommendations(self, user_id: int, stats_data: dict):
+        """Текст и клавиатура персональных рекомендаций (выполняется в пуле потоков)"""
+        # Определяем слабые темы пользователя
+        weak_topics = []
+
+        # Безопасный подход: используем session.query с явной обработкой запроса
+        with get_session() as session:
+            # Получаем темы, где процент ответов ниже 70%
+            # Используем join, чтобы объединить TestResult и Topic
+            query_result = session.query(
+                Topic.id,
+                Topic.name,
+                func.avg(TestResult.percentage).label('avg_score')
+            ).join(
+                TestResult, Topic.id == TestResult.topic_id
+            ).filter(
+                TestResult.user_id == session.query(User.id).filter(User.telegram_id == user_id).scalar_subquery()
+            ).group_by(
+                Topic.id, Topic.name
+            ).having(
+                func.avg(TestResult.percentage) < 70
+            ).all()
+
+            # Преобразуем результаты запроса в список словарей
+            for topic_id, topic_name, avg_score in query_result:
+                weak_topics.append({
+                    "id": topic_id,
+                    "name": topic_name,
+                    "avg_score": round(avg_score, 1)
+                })
+
+        # Сортируем слабые темы по возрастанию среднего балла
+        weak_topics.sort(key=lambda x: x["avg_score"])
+
+        # Формируем текст с рекомендациями
+        parts = [
+            _RECOMMENDATIONS_HEADER,
+            f"Ваш средний результат: *{stats_data['average_score']}%*\n\n",
+        ]
+
+        # Рекомендации по слабым темам и общие советы
+        if weak_topics:
+            parts.append("*Темы для улучшения:*\n")
+            parts.extend(f"• {topic['name']} - {topic['avg_score']}%\n" for topic in weak_topics)
+            parts.append("\n")
+            parts.append(_GENERAL_TIPS_WITH_WEAK_TOPICS)
+        else:
+            parts.append(_NO_WEAK_TOPICS)
+            parts.append(_GENERAL_TIPS)
+        text = "".join(parts)
+
+        # Клавиатура действий; если есть слабые темы, первой идет кнопка тренировки
+        if weak_topics:
+            weakest = weak_topics[0]
+            keyboard = (
+                (InlineKeyboardButton(
+                    f"🎯 Тренировать тему: {weakest['name']}",
+                    callback_data=f"quiz_start_{weakest['id']}"
+                ),),
+                _RECOMMENDATIONS_ACTION_ROW,
+                _RECOMMENDATIONS_BACK_ROW,
+            )
+        else:
+            keyboard = (_RECOMMENDATIONS_ACTION_ROW, _RECOMMENDATIONS_BACK_ROW)
+
+        return text, InlineKeyboardMarkup(keyboard)
+
     async def show_recommendations(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Показ персонализированных рекомендаций для ученика"""
         user_id = update.effective_user.id
@@ -707,9 +882,10 @@ class StudentHandler:
 
         try:
             logger.info(f"Запрос рекомендаций от пользователя {user_id}")
+            version = self.quiz_service.results_version
 
             # Получаем статистику пользователя за месяц
-            stats_result = get_user_stats(user_id, "month")
+            stats_result = await run_db(get_user_stats, user_id, "month")
 
             if not stats_result["success"]:
                 message = f"Ошибка при получении статистики: {stats_result['message']}"
@@ -721,19 +897,8 @@ class StudentHandler:
 
             if not stats_result.get("has_data", False):
                 # Если нет данных, показываем общее сообщение с рекомендациями
-                from keyboards.student_kb import student_main_keyboard
                 reply_markup = student_main_keyboard()
-
-                message = (
-                    "📊 *Рекомендации*\n\n"
-                    "У вас пока недостаточно данных для формирования персональных рекомендаций.\n\n"
-                    "Общие советы:\n"
-                    "• Старайтесь проходить тесты регулярно, 2-3 раза в неделю\n"
-                    "• Начинайте с тем, которые вам интересны\n"
-                    "• Для лучшего запоминания, возвращайтесь к пройденным темам\n"
-                    "• Обращайте внимание на объяснения к вопросам\n\n"
-                    "Пройдите больше тестов, чтобы получить персональные рекомендации!"
-                )
+                message = _NO_DATA_RECOMMENDATIONS
 
                 if query:
                     await query.edit_message_text(message, reply_markup=reply_markup, parse_mode="Markdown")
@@ -741,128 +906,42 @@ class StudentHandler:
                     await update.message.reply_text(message, reply_markup=reply_markup, parse_mode="Markdown")
                 return
 
-            # Определяем слабые темы пользователя
-            weak_topics = []
-
-            # Безопасный подход: используем session.query с явной обработкой запроса
-            with get_session() as session:
-                # Получаем темы, где процент ответов ниже 70%
-                # Используем join, чтобы объединить TestResult и Topic
-                from sqlalchemy import func, and_
-                from database.models import TestResult, Topic, User
-
-                query_result = session.query(
-                    Topic.id,
-                    Topic.name,
-                    func.avg(TestResult.percentage).label('avg_score')
-                ).join(
-                    TestResult, Topic.id == TestResult.topic_id
-                ).filter(
-                    TestResult.user_id == session.query(User.id).filter(User.telegram_id == user_id).scalar_subquery()
-                ).group_by(
-                    Topic.id, Topic.name
-                ).having(
-                    func.avg(TestResult.percentage) < 70
-                ).all()
-
-                # Преобразуем результаты запроса в список словарей
-                for topic_id, topic_name, avg_score in query_result:
-                    weak_topics.append({
-                        "id": topic_id,
-                        "name": topic_name,
-                        "avg_score": round(avg_score, 1)
-                    })
-
-            # Сортируем слабые темы по возрастанию среднего балла
-            weak_topics.sort(key=lambda x: x["avg_score"])
-
-            # Формируем текст с рекомендациями
-            stats_data = stats_result["stats"]
-
-            text = "🔍 *Персональные рекомендации*\n\n"
-            text += f"Ваш средний результат: *{stats_data['average_score']}%*\n\n"
-
-            # Рекомендации по слабым темам
-            if weak_topics:
-                text += "*Темы для улучшения:*\n"
-                for topic in weak_topics:
-                    text += f"• {topic['name']} - {topic['avg_score']}%\n"
-                text += "\n"
+            # Рекомендации кэшируются на короткое время; кэш сбрасывается, как только
+            # сохраняется новый результат теста (версия прочитана до получения статистики)
+            cached = self._recommendations_cache.get(user_id)
+            if cached is not None and cached[0] == version:
+                text, reply_markup = cached[1], cached[2]
             else:
-                text += "👍 *Отлично!* У вас нет тем с низкими результатами.\n\n"
-
-            # Общие советы
-            text += "*Общие советы:*\n"
-            text += "• Занимайтесь регулярно, хотя бы 3-4 раза в неделю\n"
-            if weak_topics:
-                text += "• Уделяйте особое внимание темам с низкими результатами\n"
-            text += "• Проходите тесты несколько раз для лучшего запоминания\n"
-            text += "• Используйте детальный анализ для изучения своих ошибок\n"
-
-            # Создаем клавиатуру с кнопками действий
-            keyboard = []
-
-            # Если есть слабые темы, добавляем кнопку для тренировки
-            if weak_topics and len(weak_topics) > 0:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"🎯 Тренировать тему: {weak_topics[0]['name']}",
-                        callback_data=f"quiz_start_{weak_topics[0]['id']}"
-                    )
-                ])
-
-            # Добавляем другие кнопки
-            keyboard.append([
-                InlineKeyboardButton("📊 Статистика", callback_data="common_stats"),
-                InlineKeyboardButton("📝 Начать тест", callback_data="common_start_test")
-            ])
+                text, reply_markup = await run_db(self._build_recommendations, user_id, stats_result["stats"])
+                self._recommendations_cache[user_id] = (version, text, reply_markup)
 
-            keyboard.append([
-                InlineKeyboardButton("🔙 Назад к меню", callback_data="common_back_to_main")
-            ])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            # Отправляем сообщение
+            # Сообщение и график прогресса - независимые запросы, отправляем их параллельно
             if query:
-                await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+                sends = [query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")]
             else:
-                await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+                sends = [update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")]
 
-            # Если есть график прогресса, отправляем его
-            if "charts" in stats_result and "progress_chart" in stats_result["charts"]:
-                await context.bot.send_photo(
+            # Если есть график прогресса, отправляем его (повторно - по сохраненному file_id)
+            if (charts := stats_result.get("charts")) and "progress_chart" in charts:
+                sends.append(send_photo_cached(
+                    context.bot.send_photo,
+                    charts["progress_chart"],
                     chat_id=user_id,
-                    photo=stats_result["charts"]["progress_chart"],
                     caption="📈 Динамика результатов за последний месяц"
-                )
+                ))
 
-        except Exception as e:
-            logger.error(f"Error showing recommendations: {e}")
-            logger.error(traceback.format_exc())
+            message_result, *chart_results = await asyncio.gather(*sends, return_exceptions=True)
+            for chart_result in chart_results:
+                if isinstance(chart_result, Exception):
+                    logger.error("Ошибка при отправке графика рекомендаций: %s", chart_result)
+            if isinstance(message_result, Exception):
+                raise message_result
+
+        except Exception:
+            logger.exception("Error showing recommendations")
             message = "Произошла ошибка при формировании рекомендаций. Пожалуйста, попробуйте позже."
 
             if query:
                 await query.edit_message_text(message)
             else:
                 await update.message.reply_text(message)
-
-    def get_period_name(self, period: str) -> str:
-        """Получение читаемого названия периода"""
-        periods = {
-            "week": "за неделю",
-            "month": "за месяц",
-            "year": "за год",
-            "all": "за всё время"
-        }
-        return periods.get(period, "за всё время")
-
-    def format_time(self, minutes: int) -> str:
-        """Форматирование времени из минут в часы и минуты"""
-        hours = minutes // 60
-        mins = minutes % 60
-
-        if hours > 0:
-            return f"{hours} ч {mins} мин"
-        else:
-            return f"{mins} мин"
@@ -1,6 +1,9 @@
+from functools import lru_cache
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 # keyboards/admin_kb.py - изменение в admin_main_keyboard
+@lru_cache(maxsize=1)
 def admin_main_keyboard() -> InlineKeyboardMarkup:
     """Главная клавиатура админ-панели"""
     keyboard = [
@@ -1,5 +1,12 @@
+from functools import lru_cache
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+# Короткие коды периодов отчета в callback_data (лимит Telegram - 64 байта)
+REPORT_PERIOD_CODES = {"week": "w", "month": "m", "year": "y"}
+REPORT_PERIODS_BY_CODE = {code: period for period, code in REPORT_PERIOD_CODES.items()}
+
+@lru_cache(maxsize=1)
 def parent_main_keyboard() -> InlineKeyboardMarkup:
     """Главная клавиатура для родителя"""
     keyboard = [
@@ -27,15 +34,16 @@ def parent_students_keyboard(students) -> InlineKeyboardMarkup:
         ])
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=4096)
 def parent_report_period_keyboard(student_id) -> InlineKeyboardMarkup:
     """Клавиатура выбора периода для отчёта"""
     keyboard = [
         [
-            InlineKeyboardButton("За неделю", callback_data=f"parent_report_{student_id}_week"),
-            InlineKeyboardButton("За месяц", callback_data=f"parent_report_{student_id}_month")
+            InlineKeyboardButton("За неделю", callback_data=f"parent_report_{student_id}_w"),
+            InlineKeyboardButton("За месяц", callback_data=f"parent_report_{student_id}_m")
         ],
         [
-            InlineKeyboardButton("За год", callback_data=f"parent_report_{student_id}_year"),
+            InlineKeyboardButton("За год", callback_data=f"parent_report_{student_id}_y"),
             InlineKeyboardButton("Назад к списку учеников", callback_data="parent_back_students")
         ]
     ]
@@ -1,7 +1,10 @@
+from functools import lru_cache
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 
 # keyboards/student_kb.py - изменение в student_main_keyboard
+@lru_cache(maxsize=1)
 def student_main_keyboard() -> InlineKeyboardMarkup:
     """Главная клавиатура для ученика"""
     keyboard = [
@@ -44,6 +47,12 @@ def topic_selection_keyboard(topics) -> InlineKeyboardMarkup:
 
 def single_question_keyboard(question_id, options) -> InlineKeyboardMarkup:
     """Клавиатура для вопроса с одиночным выбором"""
+    return _single_question_keyboard(question_id, tuple(options))
+
+
+@lru_cache(maxsize=2048)
+def _single_question_keyboard(question_id, options: tuple) -> InlineKeyboardMarkup:
+    """Клавиатура вопроса с одиночным выбором не зависит от ответов и строится один раз"""
     keyboard = []
     for i, option in enumerate(options):
         keyboard.append([
@@ -61,28 +70,39 @@ def single_question_keyboard(question_id, options) -> InlineKeyboardMarkup:
 def multiple_question_keyboard(question_id, options, selected_options=None) -> InlineKeyboardMarkup:
     """Клавиатура для вопроса с множественным выбором"""
     if selected_options is None:
-        selected_options = []
+        selected_options = ()
 
-    keyboard = []
-    for i, option in enumerate(options):
-        # Добавляем чекбоксы для выбранных вариантов
-        is_selected = i in selected_options
-        button_text = f"{'☑' if is_selected else '☐'} {option}"
-        keyboard.append([
-            InlineKeyboardButton(button_text, callback_data=f"quiz_answer_{question_id}_{i}")
-        ])
-
-    # Кнопка подтверждения и пропуска
-    keyboard.append([
-        InlineKeyboardButton("✅ Подтвердить выбор", callback_data=f"quiz_confirm_{question_id}")
-    ])
-    keyboard.append([
-        InlineKeyboardButton("⏩ Пропустить", callback_data="quiz_skip")
-    ])
+    # Кнопки создаются один раз на вопрос; при каждом нажатии меняется только выбор
+    # между готовыми строками с отметкой и без нее
+    option_rows, footer_rows = _multiple_question_rows(question_id, tuple(options))
+    keyboard = [rows[i in selected_options] for i, rows in enumerate(option_rows)]
+    keyboard.extend(footer_rows)
 
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=2048)
+def _multiple_question_rows(question_id, options: tuple) -> tuple:
+    """
+    Готовые строки кнопок вопроса с множественным выбором
+
+    Для каждого варианта - пара строк (без отметки, с отметкой); затем строки
+    подтверждения и пропуска.
+    """
+    option_rows = tuple(
+        (
+            (InlineKeyboardButton(f"☐ {option}", callback_data=f"quiz_answer_{question_id}_{i}"),),
+            (InlineKeyboardButton(f"☑ {option}", callback_data=f"quiz_answer_{question_id}_{i}"),),
+        )
+        for i, option in enumerate(options)
+    )
+    footer_rows = (
+        (InlineKeyboardButton("✅ Подтвердить выбор", callback_data=f"quiz_confirm_{question_id}"),),
+        (InlineKeyboardButton("⏩ Пропустить", callback_data="quiz_skip"),),
+    )
+    return option_rows, footer_rows
+
+
 def sequence_question_keyboard(question_id, options, current_sequence=None) -> InlineKeyboardMarkup:
     """Клавиатура для вопроса с последовательностью"""
     keyboard = []
@@ -97,7 +117,8 @@ def sequence_question_keyboard(question_id, options, current_sequence=None) -> I
             ])
     else:
         # Показываем оставшиеся варианты
-        remaining_options = [i for i in range(len(options)) if str(i) not in current_sequence]
+        chosen = set(current_sequence)
+        remaining_options = [i for i in range(len(options)) if i not in chosen]
         for i in remaining_options:
             keyboard.append([
                 InlineKeyboardButton(options[i], callback_data=f"quiz_seq_{question_id}_{i}")
@@ -162,6 +183,7 @@ def achievements_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=1)
 def leaderboard_period_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора периода для таблицы лидеров"""
     keyboard = [
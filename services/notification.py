@@ -10,7 +10,7 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application
 
 from database.models import User, Notification
-from database.db_manager import get_session
+from database.db_manager import get_session, incremental_vacuum, is_sqlite
 from services.parent_service import ParentService
 
 logger = logging.getLogger(__name__)
@@ -56,6 +56,14 @@ class NotificationService:
                 hour=18,
                 id='send_reminders'
             )
+            if is_sqlite:
+                # Постепенно возвращаем свободные страницы файла базы данных
+                self.scheduler.add_job(
+                    incremental_vacuum,
+                    'cron',
+                    hour=4,
+                    id='incremental_vacuum'
+                )
 
             # Запускаем планировщик
             self.scheduler.start()
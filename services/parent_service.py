@@ -1,5 +1,6 @@
 import json
 import logging
+import threading
 import pandas as pd
 import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
@@ -7,12 +8,34 @@ from io import BytesIO
 from typing import List, Dict, Any, Optional, Tuple
 import traceback
 
-from database.models import User, TestResult, Topic, Notification
+from cachetools import TTLCache
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен - без него используется стандартный json
+    orjson = None
+
+from database.models import User, TestResult, Topic, Notification, parent_student
 from database.db_manager import get_session
-from services.stats_service import get_user_stats
+from services.stats_service import get_user_stats, PLOT_LOCK
 
 logger = logging.getLogger(__name__)
 
+# Сериализация настроек родителя: orjson заметно быстрее стандартного json.
+# orjson.JSONDecodeError наследуется от json.JSONDecodeError, поэтому обработка ошибок не меняется
+if orjson is not None:
+    def _loads_settings(data):
+        return orjson.loads(data)
+
+    def _dumps_settings(settings):
+        return orjson.dumps(settings).decode()
+else:
+    _loads_settings = json.loads
+    _dumps_settings = json.dumps
+
+# Время жизни готовых отчетов об успеваемости (в секундах)
+_REPORT_TTL = 300
+
 
 class ParentService:
     _instance = None
@@ -25,6 +48,10 @@ class ParentService:
 
     def __init__(self):
         if not self.initialized:
+            # Кэш отчетов: {(parent_id, student_id, period): результат}; отчеты строятся
+            # в пуле потоков, поэтому доступ к кэшу защищен блокировкой
+            self._report_cache = TTLCache(maxsize=256, ttl=_REPORT_TTL)
+            self._report_lock = threading.Lock()
 
             self.initialized = True
 
@@ -247,25 +274,85 @@ class ParentService:
         """Получение списка привязанных учеников"""
         try:
             with get_session() as session:
-                parent = session.query(User).filter(User.telegram_id == parent_id).first()
+                # Выбираем только нужные столбцы, не создавая ORM-объекты родителя и учеников
+                parent = session.query(User.id).filter(User.telegram_id == parent_id).first()
                 if not parent:
                     return {"success": False, "message": "Аккаунт родителя не найден"}
 
-                students = []
-                for student in parent.children:
-                    students.append({
-                        "id": student.id,
-                        "telegram_id": student.telegram_id,
-                        "username": student.username,
-                        "full_name": student.full_name
-                    })
-
-                return {"success": True, "students": students}
+                return {"success": True, "students": self._linked_students(session, parent.id)}
         except Exception as e:
             logger.error(f"Error getting linked students: {e}")
             return {"success": False, "message": f"Произошла ошибка: {str(e)}"}
 
+    def get_parent_context(self, parent_id: int) -> Dict[str, Any]:
+        """Настройки родителя и список привязанных учеников за одну сессию"""
+        try:
+            with get_session() as session:
+                # Только id и настройки родителя - без загрузки ORM-объекта и его связей
+                parent = session.query(User.id, User.settings).filter(User.telegram_id == parent_id).first()
+                if not parent:
+                    return {"success": False, "message": "Аккаунт родителя не найден"}
+
+                settings = {}
+                if parent.settings:
+                    try:
+                        settings = _loads_settings(parent.settings)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Invalid JSON in parent settings for user {parent_id}")
+
+                return {
+                    "success": True,
+                    "settings": settings,
+                    "students": self._linked_students(session, parent.id)
+                }
+        except Exception as e:
+            logger.error(f"Error getting parent context: {e}")
+            return {"success": False, "message": f"Произошла ошибка: {str(e)}"}
+
+    @staticmethod
+    def _linked_students(session, parent_db_id: int) -> List[Dict[str, Any]]:
+        """Привязанные ученики родителя в виде словарей (выбираются только нужные столбцы)"""
+        rows = (
+            session.query(User.id, User.telegram_id, User.username, User.full_name)
+            .join(parent_student, parent_student.c.student_id == User.id)
+            .filter(parent_student.c.parent_id == parent_db_id)
+            .all()
+        )
+        return [
+            {
+                "id": row.id,
+                "telegram_id": row.telegram_id,
+                "username": row.username,
+                "full_name": row.full_name
+            }
+            for row in rows
+        ]
+
     def generate_student_report(self, parent_id: int, student_id: int, period: str = "week") -> Dict[str, Any]:
+        """Отчет об успеваемости ученика для родителя с кэшированием готового результата
+
+        Построение графика - самая дорогая операция, поэтому повторный выбор того же
+        периода в течение _REPORT_TTL отдает сохраненный текст и PNG-байты графика.
+        """
+        key = (parent_id, student_id, period)
+        with self._report_lock:
+            cached = self._report_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result = self._build_student_report(parent_id, student_id, period)
+        if result.get("success"):
+            with self._report_lock:
+                self._report_cache[key] = result
+        return result
+
+    def invalidate_student_reports(self, student_id: int) -> None:
+        """Сброс закэшированных отчетов по ученику (после нового результата теста)"""
+        with self._report_lock:
+            for key in [key for key in self._report_cache if key[1] == student_id]:
+                self._report_cache.pop(key, None)
+
+    def _build_student_report(self, parent_id: int, student_id: int, period: str = "week") -> Dict[str, Any]:
         """Генерация отчета о прогрессе ученика за указанный период"""
         try:
             with get_session() as session:
@@ -313,7 +400,7 @@ class ParentService:
                     }
 
                 # Собираем данные для отчета
-                topics = {topic.id: topic.name for topic in session.query(Topic).all()}
+                topics = dict(session.query(Topic.id, Topic.name).all())
 
                 # Преобразуем результаты в DataFrame для анализа
                 df = pd.DataFrame([
@@ -329,31 +416,34 @@ class ParentService:
                     for result in test_results
                 ])
 
-                # Создаем график успеваемости
-                fig = plt.figure(figsize=(10, 6))
-                for topic_id, group in df.groupby("topic_id"):
-                    plt.plot(
-                        group["date"],
-                        group["percentage"],
-                        "o-",
-                        label=group["topic_name"].iloc[0]
-                    )
-
-                plt.title(f"Успеваемость ученика {student.full_name or student.username}")
-                plt.xlabel("Дата")
-                plt.ylabel("Процент правильных ответов")
-                plt.grid(True)
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-
-                if len(df["topic_id"].unique()) > 1:
-                    plt.legend()
-
-                # Сохраняем график в буфер
-                img_buf = BytesIO()
-                plt.savefig(img_buf, format='png')
-                img_buf.seek(0)
-                plt.close(fig)  # Закрываем конкретную фигуру
+                # pyplot хранит глобальное состояние - строим графики по одному,
+                # так как отчеты формируются в пуле потоков
+                with PLOT_LOCK:
+                    # Создаем график успеваемости
+                    fig = plt.figure(figsize=(10, 6))
+                    for topic_id, group in df.groupby("topic_id"):
+                        plt.plot(
+                            group["date"],
+                            group["percentage"],
+                            "o-",
+                            label=group["topic_name"].iloc[0]
+                        )
+
+                    plt.title(f"Успеваемость ученика {student.full_name or student.username}")
+                    plt.xlabel("Дата")
+                    plt.ylabel("Процент правильных ответов")
+                    plt.grid(True)
+                    plt.xticks(rotation=45)
+                    plt.tight_layout()
+
+                    if len(df["topic_id"].unique()) > 1:
+                        plt.legend()
+
+                    # Сохраняем график в буфер
+                    img_buf = BytesIO()
+                    plt.savefig(img_buf, format='png')
+                    img_buf.seek(0)
+                    plt.close(fig)  # Закрываем конкретную фигуру
 
                 # Статистика
                 stats = {
@@ -379,7 +469,8 @@ class ParentService:
                     "student_name": student.full_name or student.username,
                     "period": period,
                     "stats": stats,
-                    "chart": img_buf
+                    # Байты PNG можно отправлять повторно, в отличие от прочитанного BytesIO
+                    "chart": img_buf.getvalue()
                 }
 
         except Exception as e:
@@ -408,7 +499,7 @@ class ParentService:
 
                 # Обновляем настройки уведомлений
                 try:
-                    parent_settings = json.loads(parent.settings) if parent.settings else {}
+                    parent_settings = _loads_settings(parent.settings) if parent.settings else {}
                 except json.JSONDecodeError:
                     logger.warning(f"Invalid settings JSON for user {parent_id}, resetting settings")
                     parent_settings = {}
@@ -429,7 +520,7 @@ class ParentService:
                 parent_settings["student_notifications"][str(student.id)] = settings
 
                 # Сохраняем настройки
-                parent.settings = json.dumps(parent_settings)
+                parent.settings = _dumps_settings(parent_settings)
                 session.commit()
 
                 return {
@@ -441,6 +532,77 @@ class ParentService:
             logger.error(f"Error setting up notifications: {e}")
             return {"success": False, "message": f"Произошла ошибка: {str(e)}"}
 
+    def _modify_student_notifications(self, parent_id: int, student_id: int, modifier) -> Dict[str, Any]:
+        """Чтение, изменение и сохранение настроек уведомлений ученика в одной транзакции
+
+        Args:
+            modifier: функция, изменяющая словарь настроек ученика на месте; если она
+                вернула False (значение не изменилось), настройки не сохраняются
+
+        Returns:
+            dict: результат с полным словарем настроек родителя после изменения, именем
+                ученика и признаком changed
+        """
+        try:
+            with get_session() as session:
+                parent = session.query(User).filter(User.telegram_id == parent_id).first()
+                if not parent:
+                    return {"success": False, "message": "Аккаунт родителя не найден"}
+
+                student = next((child for child in parent.children if child.id == student_id), None)
+                if student is None:
+                    return {"success": False, "message": "Ученик не найден среди привязанных учеников"}
+
+                try:
+                    parent_settings = _loads_settings(parent.settings) if parent.settings else {}
+                except json.JSONDecodeError:
+                    logger.warning(f"Invalid settings JSON for user {parent_id}, resetting settings")
+                    parent_settings = {}
+
+                if not isinstance(parent_settings, dict):
+                    parent_settings = {}
+                if not isinstance(parent_settings.get("student_notifications"), dict):
+                    parent_settings["student_notifications"] = {}
+
+                student_settings = parent_settings["student_notifications"].setdefault(str(student_id), {})
+                changed = modifier(student_settings) is not False
+                if changed:
+                    parent.settings = _dumps_settings(parent_settings)
+                    session.commit()
+
+                return {
+                    "success": True,
+                    "changed": changed,
+                    "settings": parent_settings,
+                    "student_name": student.full_name or student.username or f"Ученик {student.id}"
+                }
+
+        except Exception as e:
+            logger.error(f"Error updating notification settings: {e}")
+            return {"success": False, "message": f"Произошла ошибка: {str(e)}"}
+
+    def toggle_notification(self, parent_id: int, student_id: int, setting_type: str) -> Dict[str, Any]:
+        """Переключение уведомления для ученика; возвращает обновленные настройки родителя"""
+        def modifier(student_settings):
+            student_settings[setting_type] = not student_settings.get(setting_type, False)
+
+        return self._modify_student_notifications(parent_id, student_id, modifier)
+
+    def adjust_threshold(self, parent_id: int, student_id: int, threshold_type: str, action: str) -> Dict[str, Any]:
+        """Изменение порога результата на 5% (action: up или down); возвращает обновленные настройки родителя"""
+        default = 60 if threshold_type == "low_score_threshold" else 90
+        delta = {"up": 5, "down": -5}.get(action, 0)
+
+        def modifier(student_settings):
+            current_value = student_settings.get(threshold_type, default)
+            new_value = min(max(current_value + delta, 0), 100)
+            if new_value == current_value:
+                # Порог уже на границе 0-100 - сохранять нечего
+                return False
+            student_settings[threshold_type] = new_value
+
+        return self._modify_student_notifications(parent_id, student_id, modifier)
+
     def send_scheduled_reports(self) -> None:
         """Отправка запланированных отчетов родителям"""
         try:
@@ -453,7 +615,7 @@ class ParentService:
                     if not parent.settings:
                         continue
 
-                    settings = json.loads(parent.settings)
+                    settings = _loads_settings(parent.settings)
                     if "student_notifications" not in settings:
                         continue
 
@@ -492,6 +654,7 @@ class ParentService:
 
     def process_test_completion(self, student_id: int, test_result: Dict[str, Any]) -> None:
         """Обработка завершения теста учеником для уведомления родителей"""
+        self.invalidate_student_reports(student_id)
         try:
             with get_session() as session:
                 # Находим ученика
@@ -513,7 +676,7 @@ class ParentService:
                     if not parent.settings:
                         continue
 
-                    settings = json.loads(parent.settings)
+                    settings = _loads_settings(parent.settings)
                     if "student_notifications" not in settings:
                         continue
 
@@ -556,14 +719,15 @@ class ParentService:
         """Получение текущих настроек родителя"""
         try:
             with get_session() as session:
-                parent = session.query(User).filter(User.telegram_id == parent_id).first()
+                # Читаем только столбец настроек, а не всю строку пользователя
+                parent = session.query(User.settings).filter(User.telegram_id == parent_id).first()
                 if not parent:
                     return {"success": False, "message": "Аккаунт родителя не найден"}
 
                 settings = {}
                 if parent.settings:
                     try:
-                        settings = json.loads(parent.settings)
+                        settings = _loads_settings(parent.settings)
                     except json.JSONDecodeError:
                         logger.warning(f"Invalid JSON in parent settings for user {parent_id}")
                         settings = {}
@@ -590,7 +754,7 @@ class ParentService:
                         continue
 
                     try:
-                        settings = json.loads(parent.settings)
+                        settings = _loads_settings(parent.settings)
                     except json.JSONDecodeError:
                         logger.warning(f"Invalid JSON in parent settings for user {parent.id}")
                         continue
@@ -4,21 +4,39 @@ import os
 import logging
 import traceback
 import asyncio
+import time
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional, Tuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from database.models import Question, TestResult, User, Topic, Achievement
-from database.db_manager import get_session
-from services.stats_service import update_user_stats
+from database.db_manager import get_session, run_db
+from services.stats_service import update_user_stats, invalidate_user_stats
+from services.parent_service import ParentService
 from utils.formatters import format_question_text
 from utils.image_utils import get_image_path
 
 logger = logging.getLogger(__name__)
 
+# Время жизни кэша списка тем (секунды)
+_TOPICS_TTL = 300
+
+# Подсказки к тексту вопроса в зависимости от его типа
+QUESTION_TYPE_HINTS = {
+    "multiple": "\n\n_Выберите все правильные варианты ответов_",
+    "sequence": "\n\n_Расположите варианты в правильном порядке_",
+}
+
 class QuizService:
     def __init__(self):
         self.active_quizzes = {}  # словарь активных тестов: {user_id: quiz_data}
+        # Счетчик сохраненных результатов: кэши статистики сравнивают его, чтобы
+        # понять, что данные устарели
+        self.results_version = 0
+        # Кэш списка тем: темы меняются редко, а запрашиваются при каждом выборе теста
+        self._topics_cache: Optional[List[Dict[str, Any]]] = None
+        self._topics_by_id: Dict[int, Dict[str, Any]] = {}
+        self._topics_cache_ts = 0.0
 
     def save_active_quizzes(self):
         """Сохранить состояние активных тестов"""
@@ -48,6 +66,8 @@ class QuizService:
         """Помощник для сериализации объектов в JSON"""
         if isinstance(obj, datetime):
             return obj.isoformat()
+        if isinstance(obj, set):
+            return sorted(obj)
         raise TypeError(f"Type {type(obj)} not serializable")
 
     def restore_active_quizzes(self):
@@ -71,6 +91,9 @@ class QuizService:
                         if 'start_time' in quiz_data:
                             quiz_data['start_time'] = datetime.fromisoformat(quiz_data['start_time'])
 
+                        # JSON хранит ключи строками: возвращаем целые ID вопросов и множества
+                        self._restore_answer_keys(quiz_data)
+
                         # Добавляем в активные тесты
                         self.active_quizzes[user_id] = quiz_data
                     except Exception as e:
@@ -81,11 +104,55 @@ class QuizService:
             logger.error(f"Ошибка при восстановлении активных тестов: {e}")
 
 
+    @staticmethod
+    def _restore_answer_keys(quiz_data: Dict[str, Any]) -> None:
+        """Восстановление целых ключей ответов и множеств выбранных вариантов после JSON"""
+        quiz_data["answers"] = {int(qid): answer for qid, answer in quiz_data.get("answers", {}).items()}
+        quiz_data["selected"] = {int(qid): set(options) for qid, options in quiz_data.get("selected", {}).items()}
+        quiz_data["sequences"] = {int(qid): list(seq) for qid, seq in quiz_data.get("sequences", {}).items()}
+
+    def reload_topics(self) -> None:
+        """Загрузка всех тем в память (список и словарь по ID)"""
+        with get_session() as session:
+            topics = session.query(Topic.id, Topic.name, Topic.description).all()
+        topics_list = [{"id": t.id, "name": t.name, "description": t.description} for t in topics]
+        self._topics_by_id = {topic["id"]: topic for topic in topics_list}
+        self._topics_cache = topics_list
+        self._topics_cache_ts = time.monotonic()
+
+    def _topics_stale(self) -> bool:
+        """Кэш тем сброшен или устарел"""
+        return self._topics_cache is None or time.monotonic() - self._topics_cache_ts >= _TOPICS_TTL
+
+    def _ensure_topics(self) -> None:
+        """Перезагрузка тем, если кэш сброшен или устарел"""
+        if self._topics_stale():
+            self.reload_topics()
+
     def get_topics(self) -> List[Dict[str, Any]]:
         """Получение списка всех доступных тем для тестирования"""
-        with get_session() as session:
-            topics = session.query(Topic).all()
-            return [{"id": t.id, "name": t.name, "description": t.description} for t in topics]
+        self._ensure_topics()
+        return self._topics_cache
+
+    async def get_topics_async(self) -> List[Dict[str, Any]]:
+        """
+        Список тем для обработчиков бота
+
+        Пока кэш свежий, темы отдаются сразу; перезагрузка из базы выполняется в пуле
+        потоков, чтобы не блокировать цикл событий.
+        """
+        if self._topics_stale():
+            await run_db(self.reload_topics)
+        return self._topics_cache
+
+    def get_topic(self, topic_id: int) -> Optional[Dict[str, Any]]:
+        """Получение темы по ID из кэша в памяти"""
+        self._ensure_topics()
+        return self._topics_by_id.get(topic_id)
+
+    def invalidate_topics_cache(self) -> None:
+        """Сброс кэша списка тем (вызывается после изменения тем)"""
+        self._topics_cache = None
 
     def start_quiz(self, user_id: int, topic_id: int, question_count: int = None) -> Dict[str, Any]:
         """Начать новый тест для пользователя"""
@@ -126,23 +193,38 @@ class QuizService:
 
             end_time = start_time + timedelta(seconds=time_limit)
 
+            # Заготовки для ответов на вопросы с несколькими нажатиями: множество выбранных
+            # вариантов (множественный выбор и последовательность) и порядок выбора
+            selected = {q.id: set() for q in selected_questions if q.question_type in ("multiple", "sequence")}
+            sequences = {q.id: [] for q in selected_questions if q.question_type == "sequence"}
+
+            questions = [
+                {
+                    "id": q.id,
+                    "text": q.text,
+                    "options": json.loads(q.options),
+                    "correct_answer": json.loads(q.correct_answer),
+                    "question_type": q.question_type,
+                    "explanation": q.explanation,
+                    "media_url": q.media_url
+                }
+                for q in selected_questions
+            ]
+
+            # Неизменяемые части текста вопроса формируются один раз, а не при каждом показе
+            total = len(questions)
+            for number, question in enumerate(questions, 1):
+                question["title"] = f"*Вопрос {number}/{total}*"
+                question["body"] = f"\n\n{question['text']}{QUESTION_TYPE_HINTS.get(question['question_type'], '')}"
+
             # Создаём структуру теста
             quiz_data = {
                 "topic_id": topic_id,
-                "questions": [
-                    {
-                        "id": q.id,
-                        "text": q.text,
-                        "options": json.loads(q.options),
-                        "correct_answer": json.loads(q.correct_answer),
-                        "question_type": q.question_type,
-                        "explanation": q.explanation,
-                        "media_url": q.media_url
-                    }
-                    for q in selected_questions
-                ],
+                "questions": questions,
                 "current_question": 0,
                 "answers": {},
+                "selected": selected,
+                "sequences": sequences,
                 "start_time": start_time,
                 "end_time": end_time,
                 "time_limit": time_limit,
@@ -187,21 +269,21 @@ class QuizService:
         question_text = f"*Вопрос {question_num}/{total_questions}*\n\n{question['text']}"
 
         # Добавляем информацию о типе вопроса
-        if question["question_type"] == "multiple":
-            question_text += "\n\n_Выберите все правильные варианты ответов_"
-        elif question["question_type"] == "sequence":
-            question_text += "\n\n_Расположите варианты в правильном порядке_"
+        question_text += QUESTION_TYPE_HINTS.get(question["question_type"], "")
 
         # Формируем клавиатуру с вариантами ответов
         keyboard = []
         if question["question_type"] == "single" or question["question_type"] == "multiple":
             # Для одиночного или множественного выбора
+            selected_options = set()
+            if question["question_type"] == "multiple" and user_id is not None:
+                # Выбранные варианты получаем один раз, а не для каждой кнопки
+                selected_options = self.get_selected_options(user_id, question["id"])
             for i, option in enumerate(question["options"]):
                 button_text = option
                 if question["question_type"] == "multiple" and user_id is not None:
                     # Для множественного выбора добавляем чекбоксы
-                    selected = self.is_option_selected(user_id, question["id"], i)
-                    button_text = f"{'☑' if selected else '☐'} {option}"
+                    button_text = f"{'☑' if i in selected_options else '☐'} {option}"
                 callback_data = f"quiz_answer_{question['id']}_{i}"
                 keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
 
@@ -224,7 +306,8 @@ class QuizService:
                     [f"{i + 1}. {question['options'][int(opt)]}" for i, opt in enumerate(current_sequence)])
                 question_text += f"\n\nТекущая последовательность:\n{sequence_text}"
 
-                remaining_options = [i for i in range(len(question["options"])) if str(i) not in current_sequence]
+                chosen = set(current_sequence)
+                remaining_options = [i for i in range(len(question["options"])) if i not in chosen]
                 for i in remaining_options:
                     keyboard.append(
                         [InlineKeyboardButton(question["options"][i], callback_data=f"quiz_seq_{question['id']}_{i}")])
@@ -261,15 +344,49 @@ class QuizService:
     def is_option_selected(self, user_id: int, question_id: int, option_index: int) -> bool:
         """Проверка, выбран ли вариант ответа в вопросе с множественным выбором"""
         quiz_data = self.active_quizzes.get(user_id, {})
-        answers = quiz_data.get("answers", {})
-        question_answers = answers.get(str(question_id), [])
-        return option_index in question_answers
+        return option_index in quiz_data.get("selected", {}).get(question_id, ())
 
-    def get_current_sequence(self, user_id: int, question_id: int) -> List[str]:
+    def get_selected_options(self, user_id: int, question_id: int) -> set:
+        """Множество выбранных вариантов для вопроса с множественным выбором"""
+        quiz_data = self.active_quizzes.get(user_id, {})
+        return quiz_data.get("selected", {}).get(question_id, set())
+
+    def get_current_sequence(self, user_id: int, question_id: int) -> List[int]:
         """Получение текущей последовательности для вопроса с сортировкой"""
         quiz_data = self.active_quizzes.get(user_id, {})
-        answers = quiz_data.get("answers", {})
-        return answers.get(str(question_id), [])
+        return quiz_data.get("sequences", {}).get(question_id, [])
+
+    def toggle_option(self, user_id: int, question_id: int, option_index: int) -> None:
+        """Отметка или снятие отметки варианта в вопросе с множественным выбором"""
+        selected = self.active_quizzes[user_id].setdefault("selected", {}).setdefault(question_id, set())
+        if option_index in selected:
+            selected.discard(option_index)
+        else:
+            selected.add(option_index)
+
+    def add_to_sequence(self, user_id: int, question_id: int, option_index: int) -> bool:
+        """Добавление варианта в последовательность; False, если вариант уже выбран"""
+        quiz_data = self.active_quizzes[user_id]
+        # Множество выбранных вариантов дает проверку без просмотра списка
+        selected = quiz_data.setdefault("selected", {}).setdefault(question_id, set())
+        if option_index in selected:
+            return False
+        selected.add(option_index)
+        quiz_data.setdefault("sequences", {}).setdefault(question_id, []).append(option_index)
+        return True
+
+    def reset_sequence(self, user_id: int, question_id: int) -> None:
+        """Сброс текущей последовательности вопроса"""
+        quiz_data = self.active_quizzes[user_id]
+        quiz_data.setdefault("selected", {})[question_id] = set()
+        quiz_data.setdefault("sequences", {})[question_id] = []
+
+    def get_pending_answer(self, user_id: int, question_id: int, question_type: str) -> list:
+        """Ответ, собранный для вопроса с множественным выбором или последовательностью"""
+        if question_type == "sequence":
+            # Последовательность сравнивается и показывается в виде строк индексов
+            return [str(i) for i in self.get_current_sequence(user_id, question_id)]
+        return sorted(self.get_selected_options(user_id, question_id))
 
     def submit_answer(self, user_id: int, question_id: int, answer) -> Dict[str, Any]:
         """Обработка ответа пользователя"""
@@ -293,7 +410,7 @@ class QuizService:
         current_question = quiz_data["questions"][question_index]
 
         # Сохраняем ответ
-        quiz_data["answers"][str(current_question["id"])] = answer
+        quiz_data["answers"][current_question["id"]] = answer
 
         # Переходим к следующему вопросу
         quiz_data["current_question"] += 1
@@ -396,8 +513,7 @@ class QuizService:
         question_results = []
 
         for question in questions:
-            question_id = str(question["id"])
-            user_answer = answers.get(question_id, None)
+            user_answer = answers.get(question["id"])
             is_correct = False
 
             if user_answer is not None:
@@ -455,6 +571,10 @@ class QuizService:
             )
             session.add(test_result)
             session.commit()
+            self.results_version += 1
+            invalidate_user_stats(user_id)
+            # Отчеты родителей кэшируются по внутреннему id ученика
+            ParentService().invalidate_student_reports(user.id)
 
             # Обновляем статистику пользователя
             update_user_stats(user_id)
@@ -28,7 +28,6 @@ def set_setting(key: str, value):
             else:
                 setting = BotSettings(key=key, value=str(value))
                 session.add(setting)
-            session.commit()
             return True
     except Exception as e:
         logger.error(f"Ошибка при установке настройки {key}: {e}")
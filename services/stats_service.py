@@ -5,15 +5,50 @@ from io import BytesIO
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Tuple
 import logging
+import threading
 import traceback  # Для полной трассировки ошибок
+from cachetools import TTLCache
 
 from database.models import User, TestResult, Topic, Achievement
 from database.db_manager import get_session
 
 logger = logging.getLogger(__name__)
 
+# Кэш статистики по (telegram_id, период): при переключении периодов статистика
+# не пересчитывается; записи сбрасываются при сохранении нового результата теста
+_STATS_CACHE = TTLCache(maxsize=10_000, ttl=120)
+_STATS_CACHE_LOCK = threading.Lock()
+_STATS_PERIODS = ("week", "month", "year", "all")
+
+# Блокировка построения графиков matplotlib из разных потоков (общая для сервисов)
+PLOT_LOCK = threading.Lock()
+
 def get_user_stats(user_id: int, period: str = "all") -> Dict[str, Any]:
-    """Получение статистики пользователя за указанный период"""
+    """Получение статистики пользователя за указанный период (с кэшированием)"""
+    key = (user_id, period)
+    with _STATS_CACHE_LOCK:
+        cached = _STATS_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    result = _build_user_stats(user_id, period)
+
+    # Ошибки и пустую статистику не кэшируем, чтобы первый тест сразу появился в статистике
+    if result.get("success") and result.get("has_data"):
+        with _STATS_CACHE_LOCK:
+            _STATS_CACHE[key] = result
+    return result
+
+
+def invalidate_user_stats(user_id: int) -> None:
+    """Сброс кэша статистики пользователя за все периоды"""
+    with _STATS_CACHE_LOCK:
+        for period in _STATS_PERIODS:
+            _STATS_CACHE.pop((user_id, period), None)
+
+
+def _build_user_stats(user_id: int, period: str) -> Dict[str, Any]:
+    """Расчет статистики пользователя за указанный период"""
     try:
         with get_session() as session:
             # Находим пользователя
@@ -46,7 +81,7 @@ def get_user_stats(user_id: int, period: str = "all") -> Dict[str, Any]:
                 }
 
             # Получаем информацию о темах
-            topics = {topic.id: topic.name for topic in session.query(Topic).all()}
+            topics = dict(session.query(Topic.id, Topic.name).all())
 
             # Собираем данные для статистики
             results_data = []
@@ -91,62 +126,64 @@ def get_user_stats(user_id: int, period: str = "all") -> Dict[str, Any]:
 
             # График успеваемости по времени
             if len(df) > 1:
-                fig = plt.figure(figsize=(10, 6))
-                for topic_id, group in df.groupby("topic_id"):
-                    plt.plot(
-                        group["date"],
-                        group["percentage"],
-                        "o-",
-                        label=group["topic_name"].iloc[0]
-                    )
-
-                plt.title("Динамика успеваемости")
-                plt.xlabel("Дата")
-                plt.ylabel("Процент правильных ответов")
-                plt.grid(True)
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-
-                if len(df["topic_id"].unique()) > 1:
-                    plt.legend()
-
-                img_buf = BytesIO()
-                plt.savefig(img_buf, format='png')
-                img_buf.seek(0)
-                plt.close(fig)  # Явно закрываем фигуру
-
-                charts["progress_chart"] = img_buf
+                # pyplot хранит глобальное состояние, а статистика строится в пуле потоков
+                with PLOT_LOCK:
+                    fig = plt.figure(figsize=(10, 6))
+                    for topic_id, group in df.groupby("topic_id"):
+                        plt.plot(
+                            group["date"],
+                            group["percentage"],
+                            "o-",
+                            label=group["topic_name"].iloc[0]
+                        )
+
+                    plt.title("Динамика успеваемости")
+                    plt.xlabel("Дата")
+                    plt.ylabel("Процент правильных ответов")
+                    plt.grid(True)
+                    plt.xticks(rotation=45)
+                    plt.tight_layout()
+
+                    if len(df["topic_id"].unique()) > 1:
+                        plt.legend()
+
+                    img_buf = BytesIO()
+                    plt.savefig(img_buf, format='png')
+                    plt.close(fig)  # Явно закрываем фигуру
+
+                # Байты, а не BytesIO: результат кэшируется и может отправляться повторно
+                charts["progress_chart"] = img_buf.getvalue()
 
             # График результатов по темам
             if len(df["topic_id"].unique()) > 1:
                 topic_avg = df.groupby("topic_name")["percentage"].mean().sort_values(ascending=False)
 
-                fig = plt.figure(figsize=(10, 6))
-                bars = plt.bar(topic_avg.index, topic_avg.values)
-
-                # Добавляем значения над столбцами
-                for bar in bars:
-                    height = bar.get_height()
-                    plt.text(
-                        bar.get_x() + bar.get_width() / 2.,
-                        height + 1,
-                        f'{height:.1f}%',
-                        ha='center',
-                        va='bottom'
-                    )
-
-                plt.title("Средний результат по темам")
-                plt.ylabel("Процент правильных ответов")
-                plt.xticks(rotation=45, ha='right')
-                plt.tight_layout()
-                plt.ylim(0, 105)  # Чтобы поместились значения над столбцами
-
-                img_buf = BytesIO()
-                plt.savefig(img_buf, format='png')
-                img_buf.seek(0)
-                plt.close(fig)  # Добавляем закрытие конкретной фигуры
-
-                charts["topics_chart"] = img_buf
+                with PLOT_LOCK:
+                    fig = plt.figure(figsize=(10, 6))
+                    bars = plt.bar(topic_avg.index, topic_avg.values)
+
+                    # Добавляем значения над столбцами
+                    for bar in bars:
+                        height = bar.get_height()
+                        plt.text(
+                            bar.get_x() + bar.get_width() / 2.,
+                            height + 1,
+                            f'{height:.1f}%',
+                            ha='center',
+                            va='bottom'
+                        )
+
+                    plt.title("Средний результат по темам")
+                    plt.ylabel("Процент правильных ответов")
+                    plt.xticks(rotation=45, ha='right')
+                    plt.tight_layout()
+                    plt.ylim(0, 105)  # Чтобы поместились значения над столбцами
+
+                    img_buf = BytesIO()
+                    plt.savefig(img_buf, format='png')
+                    plt.close(fig)  # Добавляем закрытие конкретной фигуры
+
+                charts["topics_chart"] = img_buf.getvalue()
 
             # Получаем достижения пользователя
             achievements = [
@@ -186,63 +223,34 @@ def get_problematic_questions(limit: int = 10) -> Dict[str, Any]:
             from sqlalchemy import func, text, case
             import traceback
 
-            # Определяем, какую СУБД используем (SQLite или PostgreSQL)
-            from sqlalchemy import inspect
-            connection = session.connection()
-            inspector = inspect(connection)
-            dialect_name = inspector.engine.dialect.name.lower()
-
-            # Выбираем правильный SQL запрос в зависимости от диалекта
-            if dialect_name == 'postgresql':
-                # SQL для PostgreSQL
-                query = text("""
-                    SELECT 
-                        q.id AS question_id,
-                        q.text AS question_text,
-                        t.id AS topic_id,
-                        t.name AS topic_name,
-                        COUNT(qr.question_id) AS total_answers,
-                        SUM(CASE WHEN qr.is_correct = FALSE THEN 1 ELSE 0 END) AS wrong_answers,
-                        (SUM(CASE WHEN qr.is_correct = FALSE THEN 1 ELSE 0 END) * 100.0 / NULLIF(COUNT(qr.question_id), 0)) AS error_rate
-                    FROM 
-                        questions q
-                    JOIN
-                        topics t ON q.topic_id = t.id
-                    LEFT JOIN
-                        question_result qr ON q.id = qr.question_id
-                    GROUP BY 
-                        q.id, t.id, q.text, t.name
-                    HAVING 
-                        COUNT(qr.question_id) >= 5 -- минимум 5 ответов для статистической значимости
-                    ORDER BY 
-                        error_rate DESC NULLS LAST
-                    LIMIT :limit
-                """)
-            else:
-                # SQL для SQLite и других СУБД
-                query = text("""
-                    SELECT 
-                        q.id AS question_id,
-                        q.text AS question_text,
-                        t.id AS topic_id,
-                        t.name AS topic_name,
-                        COUNT(qr.question_id) AS total_answers,
-                        SUM(CASE WHEN qr.is_correct = 0 THEN 1 ELSE 0 END) AS wrong_answers,
-                        (SUM(CASE WHEN qr.is_correct = 0 THEN 1 ELSE 0 END) * 100.0 / COUNT(qr.question_id)) AS error_rate
-                    FROM 
-                        questions q
-                    JOIN
-                        topics t ON q.topic_id = t.id
-                    LEFT JOIN
-                        question_result qr ON q.id = qr.question_id
-                    GROUP BY 
-                        q.id, t.id, q.text, t.name
-                    HAVING 
-                        COUNT(qr.question_id) >= 5 -- минимум 5 ответов для статистической значимости
-                    ORDER BY 
-                        error_rate DESC
-                    LIMIT :limit
-                """)
+            # Один запрос для всех СУБД: булево значение передается связанным параметром,
+            # и драйвер сам подставляет FALSE (PostgreSQL) или 0 (SQLite). Текст запроса
+            # не зависит от значения, поэтому его план кэшируется как один запрос.
+            # error_rate не бывает NULL (HAVING отсекает вопросы без ответов), поэтому
+            # NULLS LAST не нужен
+            query = text("""
+                SELECT 
+                    q.id AS question_id,
+                    q.text AS question_text,
+                    t.id AS topic_id,
+                    t.name AS topic_name,
+                    COUNT(qr.question_id) AS total_answers,
+                    SUM(CASE WHEN qr.is_correct = :is_correct THEN 1 ELSE 0 END) AS wrong_answers,
+                    (SUM(CASE WHEN qr.is_correct = :is_correct THEN 1 ELSE 0 END) * 100.0 / NULLIF(COUNT(qr.question_id), 0)) AS error_rate
+                FROM 
+                    questions q
+                JOIN
+                    topics t ON q.topic_id = t.id
+                LEFT JOIN
+                    question_result qr ON q.id = qr.question_id
+                GROUP BY 
+                    q.id, t.id, q.text, t.name
+                HAVING 
+                    COUNT(qr.question_id) >= 5 -- минимум 5 ответов для статистической значимости
+                ORDER BY 
+                    error_rate DESC
+                LIMIT :limit
+            """).bindparams(is_correct=False)
 
             # Выполняем запрос
             results = session.execute(query, {"limit": limit}).fetchall()
@@ -340,7 +348,6 @@ def update_user_stats(user_id: int) -> Dict[str, Any]:
             # Можно добавить дополнительные обновления статистики,
             # например, общее время в системе, количество пройденных тестов и т.д.
 
-            session.commit()
             return {"success": True}
 
     except Exception as e:
@@ -440,7 +447,7 @@ def generate_topic_analytics() -> Dict[str, Any]:
                 }
 
             # Получаем информацию о темах
-            topics = {topic.id: topic.name for topic in session.query(Topic).all()}
+            topics = dict(session.query(Topic.id, Topic.name).all())
 
             # Группируем результаты по темам
             topic_results = {}
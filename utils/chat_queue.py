@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from functools import wraps
+from typing import Any, Awaitable, Dict, Hashable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class ChatTaskQueue:
+    """
+    Очередь задач с разбиением по ключу (обычно chat_id)
+
+    Задачи одного ключа выполняются строго по порядку, задачи разных ключей -
+    параллельно. Обработчик обновления только ставит работу в очередь и сразу
+    возвращает управление, поэтому медленный ответ в одном чате не задерживает
+    обработку остальных.
+
+    Ошибка задачи передается обработчику ошибок приложения
+    (context.application.process_error) - так же, как если бы ее выбросил сам
+    обработчик обновления, поэтому пользователь получает сообщение об ошибке.
+    """
+
+    def __init__(self):
+        self._queues: Dict[Hashable, asyncio.Queue] = {}
+        self._workers: Set[asyncio.Task] = set()
+
+    def submit(self, key: Hashable, coro: Awaitable[Any], update: Optional[object] = None,
+               context: Optional[Any] = None) -> None:
+        """
+        Добавление корутины в очередь ключа (воркер создается при необходимости)
+
+        Args:
+            key: ключ очереди (обычно chat_id)
+            coro: работа обработчика обновления
+            update: обновление, к которому относится работа
+            context: контекст обработчика; если передан, ошибка задачи уходит
+                в обработчик ошибок приложения, иначе только логируется
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue()
+            worker = asyncio.create_task(self._worker(key, queue))
+            # Храним ссылку на задачу, чтобы ее не удалил сборщик мусора
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        queue.put_nowait((coro, update, context))
+
+    async def _worker(self, key: Hashable, queue: asyncio.Queue) -> None:
+        """Последовательное выполнение задач ключа; завершается, когда очередь пуста"""
+        while not queue.empty():
+            coro, update, context = queue.get_nowait()
+            try:
+                await coro
+            except Exception as e:
+                await self._report_error(key, e, update, context)
+        # Между проверкой пустоты и удалением нет await, поэтому задача не потеряется
+        del self._queues[key]
+
+    @staticmethod
+    async def _report_error(key: Hashable, error: Exception, update, context) -> None:
+        """Передача ошибки задачи обработчику ошибок приложения"""
+        if context is None:
+            logger.error("Ошибка при выполнении задачи в очереди %s", key, exc_info=error)
+            return
+        try:
+            await context.application.process_error(update, error)
+        except Exception:
+            logger.exception("Ошибка в обработчике ошибок для задачи очереди %s", key)
+
+
+# Общая очередь обработки обновлений: все обработчики, работающие с данными чата
+# (context.user_data), выполняются в одной очереди и не пересекаются между собой
+chat_queue = ChatTaskQueue()
+
+
+def queued(handler):
+    """Обертка обработчика обновления: работа выполняется в общей очереди чата"""
+    @wraps(handler)
+    async def wrapper(update, context):
+        chat_queue.submit(update.effective_chat.id, handler(update, context), update, context)
+    return wrapper
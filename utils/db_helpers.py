@@ -1,20 +1,36 @@
 import logging
-from database.db_manager import get_session
+import threading
+import warnings
+from sqlalchemy import false, inspect, true
+from database.db_manager import get_engine
 
 logger = logging.getLogger(__name__)
 
+# Диалект движка не меняется во время работы: результат is_postgresql() запоминается
+_IS_POSTGRESQL = None
+
+# Типы столбцов по таблицам {таблица: {столбец: тип}}: схема за время работы
+# процесса не меняется, поэтому при первом обращении она отражается целиком
+_TABLE_COLUMNS = None
+_TABLE_COLUMNS_LOCK = threading.Lock()
+
+# SQL-константы false()/true(), индексируемые булевым значением
+_SQL_BOOLEANS = (false(), true())
+
 
 def is_postgresql():
     """Проверяет, используется ли PostgreSQL в качестве СУБД"""
+    global _IS_POSTGRESQL
+    if _IS_POSTGRESQL is not None:
+        return _IS_POSTGRESQL
+
     try:
-        with get_session() as session:
-            from sqlalchemy import inspect
-            connection = session.connection()
-            inspector = inspect(connection)
-            dialect_name = inspector.engine.dialect.name.lower()
-            return dialect_name == 'postgresql'
+        # Диалект известен движку без подключения к базе - сессия не нужна
+        _IS_POSTGRESQL = get_engine().dialect.name.lower() == 'postgresql'
+        return _IS_POSTGRESQL
     except Exception as e:
-        logger.error(f"Ошибка при определении диалекта БД: {e}")
+        # Ошибку не запоминаем - при следующем вызове диалект определяется заново
+        logger.error("Ошибка при определении диалекта БД: %s", e)
         return False
 
 
@@ -22,23 +38,28 @@ def adapt_boolean_comparison(value, for_postgres=None):
     """
     Адаптирует значение для сравнения с boolean-полем в зависимости от используемой СУБД
 
+    Возвращается SQL-выражение true()/false(): диалект сам выводит его как TRUE/FALSE
+    (PostgreSQL) или 1/0 (SQLite), поэтому склеивать SQL из строк не нужно, а запрос
+    вида column == adapt_boolean_comparison(True) остается кэшируемым.
+
+    Устарело: в выражениях SQLAlchemy сравнивайте столбец с обычным bool
+    (column.is_(True) или column == True), а в text() передавайте значение
+    связанным параметром: text("... WHERE is_active = :active").bindparams(active=True).
+
     Args:
         value (bool): Булево значение для сравнения
-        for_postgres (bool, optional): Принудительно использовать синтаксис для PostgreSQL
-                                     Если None, определяет автоматически
+        for_postgres (bool, optional): Оставлен для совместимости - синтаксис
+                                     определяется диалектом при компиляции запроса
 
     Returns:
-        str or bool: Значение, адаптированное для текущей СУБД
+        sqlalchemy.sql.elements.True_ | False_: Булева константа SQL
     """
-    if for_postgres is None:
-        for_postgres = is_postgresql()
-
-    if for_postgres:
-        # Для PostgreSQL используем TRUE/FALSE
-        return "TRUE" if value else "FALSE"
-    else:
-        # Для SQLite и других используем 1/0
-        return 1 if value else 0
+    warnings.warn(
+        "adapt_boolean_comparison устарела: передавайте bool связанным параметром запроса",
+        DeprecationWarning,
+        stacklevel=2
+    )
+    return _SQL_BOOLEANS[bool(value)]
 
 
 def get_db_type(column_name, table_name):
@@ -53,17 +74,25 @@ def get_db_type(column_name, table_name):
         str: Тип данных столбца
     """
     try:
-        with get_session() as session:
-            from sqlalchemy import inspect, text
+        return _schema_columns().get(table_name, {}).get(column_name, "unknown")
+    except Exception as e:
+        logger.error("Ошибка при получении типа столбца %s: %s", column_name, e)
+        return "unknown"
 
-            inspector = inspect(session.bind)
-            columns = inspector.get_columns(table_name)
 
-            for column in columns:
-                if column['name'] == column_name:
-                    return str(column['type'])
+def _schema_columns():
+    """Типы столбцов всех таблиц схемы (отражаются одним запросом при первом обращении)"""
+    global _TABLE_COLUMNS
+    if _TABLE_COLUMNS is not None:
+        return _TABLE_COLUMNS
 
-            return "unknown"
-    except Exception as e:
-        logger.error(f"Ошибка при получении типа столбца {column_name}: {e}")
-        return "unknown"
+    with _TABLE_COLUMNS_LOCK:
+        if _TABLE_COLUMNS is None:
+            # Инспектор движка сам берет соединение из пула только на время запроса схемы;
+            # get_multi_columns читает столбцы всех таблиц сразу, а не по одной таблице
+            inspector = inspect(get_engine())
+            _TABLE_COLUMNS = {
+                table_name: {column['name']: str(column['type']) for column in columns}
+                for (_, table_name), columns in inspector.get_multi_columns().items()
+            }
+        return _TABLE_COLUMNS
@@ -0,0 +1,76 @@
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable
+
+from cachetools import LRUCache
+
+# file_id уже загруженных изображений по хэшу содержимого
+_PHOTO_FILE_IDS = LRUCache(maxsize=512)
+
+# file_id изображений с диска по пути к файлу
+_PATH_FILE_IDS = LRUCache(maxsize=1024)
+
+
+def _photo_key(data: bytes) -> str:
+    """Ключ кэша - короткий хэш содержимого изображения"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+async def send_photo_cached(send: Callable[..., Awaitable[Any]], photo: bytes, **kwargs) -> Any:
+    """
+    Отправка изображения с повторным использованием file_id Telegram
+
+    Если такие же байты уже отправлялись, вместо повторной загрузки передается
+    сохраненный file_id. Иначе изображение загружается, а file_id из ответа
+    запоминается.
+
+    Args:
+        send: метод отправки (bot.send_photo, message.reply_photo и т.п.)
+        photo: содержимое изображения
+        **kwargs: остальные параметры метода отправки
+
+    Returns:
+        Отправленное сообщение
+    """
+    key = _photo_key(photo)
+    file_id = _PHOTO_FILE_IDS.get(key)
+    if file_id is not None:
+        return await send(photo=file_id, **kwargs)
+
+    message = await send(photo=photo, **kwargs)
+    if message is not None and message.photo:
+        # Самый крупный вариант изображения - последний в списке
+        _PHOTO_FILE_IDS[key] = message.photo[-1].file_id
+    return message
+
+
+def _read_file(path: str) -> bytes:
+    """Чтение файла целиком (выполняется в отдельном потоке)"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def send_photo_file_cached(send: Callable[..., Awaitable[Any]], path: str, **kwargs) -> Any:
+    """
+    Отправка изображения с диска с повторным использованием file_id Telegram
+
+    Файл читается (в отдельном потоке) и загружается только при первой отправке,
+    дальше передается сохраненный file_id.
+
+    Args:
+        send: метод отправки (bot.send_photo, message.reply_photo и т.п.)
+        path: путь к файлу изображения
+        **kwargs: остальные параметры метода отправки
+
+    Returns:
+        Отправленное сообщение
+    """
+    file_id = _PATH_FILE_IDS.get(path)
+    if file_id is not None:
+        return await send(photo=file_id, **kwargs)
+
+    photo = await asyncio.to_thread(_read_file, path)
+    message = await send(photo=photo, **kwargs)
+    if message is not None and message.photo:
+        _PATH_FILE_IDS[path] = message.photo[-1].file_id
+    return message
@@ -1,4 +1,6 @@
 import json
+from datetime import datetime
+from functools import lru_cache
 from typing import Dict, List, Any
 import markdown
 import re
@@ -213,4 +215,76 @@ def format_time_period(seconds: int) -> str:
     hours = minutes // 60
     minutes %= 60
 
-    return f"{hours} ч {minutes} мин {seconds} сек"
\ No newline at end of file
+    return f"{hours} ч {minutes} мин {seconds} сек"
+
+
+# Читаемые названия периодов отчетов и статистики
+PERIOD_NAMES = {
+    "week": "за неделю",
+    "month": "за месяц",
+    "year": "за год",
+    "all": "за всё время"
+}
+
+
+def get_period_name(period: str) -> str:
+    """
+    Возвращает читаемое название периода ("за неделю", "за месяц" и т.д.)
+
+    Args:
+        period: Код периода (week, month, year, all)
+
+    Returns:
+        str: Название периода; для неизвестного кода - "за всё время"
+    """
+    return PERIOD_NAMES.get(period, "за всё время")
+
+
+def format_minutes(minutes: int) -> str:
+    """
+    Форматирует время в минутах в часы и минуты
+
+    Args:
+        minutes: Время в минутах
+
+    Returns:
+        str: Отформатированное время
+    """
+    hours, mins = divmod(minutes, 60)
+    return f"{hours} ч {mins} мин" if hours > 0 else f"{mins} мин"
+
+
+@lru_cache(maxsize=4096)
+def _strftime_cached(value, fmt: str) -> str:
+    """strftime с кэшированием по значению и формату"""
+    return value.strftime(fmt)
+
+
+def format_date(value: datetime) -> str:
+    """
+    Форматирует дату в виде ДД.ММ.ГГГГ
+
+    Строка зависит только от дня, поэтому кэш общий для всех записей за этот день.
+
+    Args:
+        value: Дата или дата и время
+
+    Returns:
+        str: Отформатированная дата
+    """
+    day = value.date() if isinstance(value, datetime) else value
+    return _strftime_cached(day, "%d.%m.%Y")
+
+
+def format_datetime(value: datetime) -> str:
+    """
+    Форматирует дату и время в виде ДД.ММ.ГГГГ ЧЧ:ММ
+
+    Args:
+        value: Дата и время
+
+    Returns:
+        str: Отформатированные дата и время
+    """
+    # Секунды в строку не попадают - отбрасываем их, чтобы значения одной минуты совпадали в кэше
+    return _strftime_cached(value.replace(second=0, microsecond=0), "%d.%m.%Y %H:%M")
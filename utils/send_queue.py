@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Any, Awaitable, Dict, Hashable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Глобальный лимит Telegram Bot API - около 30 сообщений в секунду
+_DEFAULT_RATE = 30
+
+
+class TelegramSendQueue:
+    """
+    Очередь исходящих запросов к Telegram API
+
+    Обработчик ставит готовый вызов (например, query.edit_message_text(...)) в очередь
+    и сразу завершается. Очередь ограничивает частоту запуска запросов, но не ждет
+    ответа на один запрос перед запуском следующего: HTTP-запросы разных сообщений
+    выполняются параллельно. Ошибки отправки логируются; результат или ошибку можно
+    получить из future, который возвращает submit().
+
+    Запросы с одинаковым ключом объединения (например, правки одного сообщения) не
+    накапливаются: еще не отправленный запрос заменяется новым и сохраняет свое место
+    в очереди, поэтому частые нажатия превращаются в одну итоговую правку. Запросы с
+    одним ключом выполняются строго по порядку - следующий стартует после завершения
+    предыдущего.
+    """
+
+    def __init__(self, rate: int = _DEFAULT_RATE):
+        self._interval = 1 / rate
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._last_sent = 0.0
+        # Ожидающие отправки запросы по ключу объединения: (запрос, future результата)
+        self._pending: Dict[Hashable, Tuple[Awaitable[Any], asyncio.Future]] = {}
+        # Последний запущенный запрос по ключу: следующий с тем же ключом ждет его
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        # Ссылки на выполняющиеся запросы, чтобы задачи не собрал сборщик мусора
+        self._tasks: Set[asyncio.Task] = set()
+
+    def submit(self, coro: Awaitable[Any], key: Optional[Hashable] = None) -> asyncio.Future:
+        """
+        Добавление запроса в очередь (задача отправки запускается при необходимости)
+
+        Args:
+            coro: готовый вызов метода Telegram API
+            key: ключ объединения; ожидающий запрос с тем же ключом заменяется новым
+
+        Returns:
+            Future с результатом запроса (для замененного запроса - с результатом
+            заменившего его). Ждать его не обязательно: ошибки логируются очередью
+        """
+        if key is not None:
+            pending = self._pending.get(key)
+            if pending is not None:
+                # Устаревший запрос не будет отправлен; закрываем корутину без предупреждения
+                superseded, future = pending
+                superseded.close()
+                self._pending[key] = (coro, future)
+                return future
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = (coro, future)
+            self._queue.put_nowait((key, None, None))
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._queue.put_nowait((None, coro, future))
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._drain())
+        return future
+
+    async def _drain(self) -> None:
+        """Запуск запросов из очереди с ограничением частоты; задача завершается, когда очередь пуста"""
+        try:
+            while not self._queue.empty():
+                key, coro, future = self._queue.get_nowait()
+
+                # Выдерживаем минимальный интервал между запусками запросов
+                delay = self._last_sent + self._interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._last_sent = time.monotonic()
+
+                if key is None:
+                    self._start(coro, future, None)
+                    continue
+
+                # Запрос по ключу берем после паузы, чтобы за время ожидания его успела
+                # заменить новая версия
+                coro, future = self._pending.pop(key)
+                task = self._start(coro, future, self._inflight.get(key))
+                self._inflight[key] = task
+                task.add_done_callback(partial(self._release, key))
+        finally:
+            # Между проверкой пустоты и сбросом нет await, поэтому запрос не потеряется
+            self._worker = None
+
+    def _start(self, coro: Awaitable[Any], future: asyncio.Future,
+               previous: Optional[asyncio.Task]) -> asyncio.Task:
+        """Запуск запроса отдельной задачей"""
+        task = asyncio.create_task(self._send(coro, future, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _release(self, key: Hashable, task: asyncio.Task) -> None:
+        """Снятие завершенного запроса с учета, если после него по ключу ничего не запущено"""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    @staticmethod
+    async def _send(coro: Awaitable[Any], future: asyncio.Future,
+                    previous: Optional[asyncio.Task]) -> None:
+        """Выполнение запроса и передача результата в future"""
+        if previous is not None:
+            # Запросы с одним ключом идут по порядку; _send не выбрасывает исключений
+            await previous
+
+        try:
+            result = await coro
+        except Exception as e:
+            logger.exception("Ошибка при отправке запроса к Telegram из очереди")
+            if not future.done():
+                future.set_exception(e)
+                # Ошибка уже залогирована: если future никто не ждет, asyncio не должен
+                # сообщать о необработанном исключении
+                future.exception()
+        else:
+            if not future.done():
+                future.set_result(result)
+
+
+def message_key(query) -> Optional[Tuple[int, int]]:
+    """Ключ объединения для правок сообщения, к которому относится нажатая кнопка"""
+    message = query.message
+    return (message.chat_id, message.message_id) if message else None
+
+
+# Общая очередь исходящих запросов бота
+send_queue = TelegramSendQueue()